@@ -1,7 +1,15 @@
-from ui import app
+import sys
+
+import cli
 
 
 if __name__ == '__main__':
+    if cli.wants_cli(sys.argv[1:]):
+        # headless, so neither Tk nor the GUI's dependencies are loaded
+        sys.exit(cli.main(sys.argv[1:]))
+
+    from ui import app
+
     try:
         app.main()
     except KeyboardInterrupt:
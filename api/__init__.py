@@ -1,4 +1,5 @@
 from .imap import GenericIMAP, GmailIMAP
+from .index import SenderIndex
 from .service import CleanserService
 
-__all__ = ["GenericIMAP", "GmailIMAP", "CleanserService"]
\ No newline at end of file
+__all__ = ["GenericIMAP", "GmailIMAP", "SenderIndex", "CleanserService"]
\ No newline at end of file
@@ -0,0 +1,621 @@
+from __future__ import annotations
+
+import asyncio
+import base64
+import collections
+import functools
+import imaplib
+import json
+import socket
+import ssl
+import threading
+import time
+import typing
+
+from .imap import GenericIMAP, GmailIMAP, command_verb, response_payload_size
+import metrics
+
+if typing.TYPE_CHECKING:
+    from credentials import Credentials
+
+
+_loop: asyncio.AbstractEventLoop | None = None
+_loop_lock = threading.Lock()
+
+
+def event_loop() -> asyncio.AbstractEventLoop:
+    """
+    The event loop every asyncio IMAP connection runs on, started in a daemon thread of its own the
+    first time it is needed.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="aioimap", daemon=True).start()
+
+        return _loop
+
+
+def _quote(arg: str) -> str:
+    return '"' + arg.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+class Response:
+    """
+    The outcome of one command: its tagged status and text, and the untagged responses received
+    while it was the oldest command in flight, grouped by type the same way imaplib does.
+    """
+
+    status: str | None
+    text: bytes
+    untagged: dict[str, list]
+    bytes_sent: int
+    bytes_received: int
+
+    def __init__(self):
+        self.status = None
+        self.text = b""
+        self.untagged = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def append(self, typ: str, data: typing.Any):
+        self.untagged.setdefault(typ, []).append(data)
+
+    def pop(self, typ: str) -> list:
+        return self.untagged.pop(typ, [None])
+
+
+class AsyncIMAP4:
+    """
+    An IMAP4rev1 client connection on asyncio. Unlike imaplib, issuing a command doesn't wait for the
+    previous one to complete: each one is written as soon as it is issued and its response is matched
+    up by tag, so any number of commands can be in flight on the one connection.
+    """
+
+    error = imaplib.IMAP4.error
+    abort = imaplib.IMAP4.abort
+
+    __host: str
+    __port: int
+    __ssl_context: ssl.SSLContext | None
+    __reader: asyncio.StreamReader
+    __writer: asyncio.StreamWriter
+    __read_task: asyncio.Task | None
+    __pending: collections.OrderedDict[bytes, tuple[asyncio.Future, Response]]
+    __continuation: asyncio.Future | None
+    __tag_prefix: bytes
+    __tag_number: int
+    __closed: bool
+
+    capabilities: tuple[str, ...]
+
+    def __init__(self, host: str, port: int = 993, ssl_context: ssl.SSLContext | None = None):
+        self.__host = host
+        self.__port = port
+        self.__ssl_context = ssl_context
+        self.__read_task = None
+        self.__pending = collections.OrderedDict()
+        self.__continuation = None
+        self.__tag_prefix = imaplib.Int2AP(id(self) & 0xFFFF)
+        self.__tag_number = 0
+        self.__closed = True
+        self.capabilities = ()
+
+    async def connect(self):
+        # a single FETCH or SEARCH response line can get very long on big mailboxes
+        self.__reader, self.__writer = await asyncio.open_connection(
+            self.__host, self.__port, ssl=self.__ssl_context, limit=64 * 1024 * 1024
+        )
+        self.__closed = False
+
+        greeting = await self.__readline()
+        if not greeting.startswith((b"* OK", b"* PREAUTH")):
+            raise AsyncIMAP4.error("Unexpected greeting: %r" % greeting)
+
+        self.__read_task = asyncio.ensure_future(self.__read_loop())
+
+        response = await self.command("CAPABILITY")
+        self.capabilities = tuple(response.pop("CAPABILITY")[-1].decode("ascii").upper().split())
+
+    async def command(self, *args: str | bytes) -> Response:
+        """
+        Sends a command and waits for its completion. Raises `error` on BAD, but returns NO responses
+        like imaplib does.
+        """
+        started = time.perf_counter()
+        future, response = self.__send(*args)
+        try:
+            await self.__writer.drain()
+            await future
+        finally:
+            self.__record(args, response, started)
+
+        if response.status == "BAD":
+            raise AsyncIMAP4.error("%s command error: BAD %r" % (args[0], response.text))
+
+        return response
+
+    def __send(self, *args: str | bytes) -> tuple[asyncio.Future, Response]:
+        if self.__closed:
+            raise AsyncIMAP4.abort("connection closed")
+
+        self.__tag_number += 1
+        tag = self.__tag_prefix + str(self.__tag_number).encode("ascii")
+
+        future = asyncio.get_running_loop().create_future()
+        response = Response()
+        self.__pending[tag] = (future, response)
+
+        line = b" ".join([tag] + [arg.encode("utf-8") if isinstance(arg, str) else arg for arg in args])
+        self.__writer.write(line + b"\r\n")
+        response.bytes_sent = len(line) + 2
+        return future, response
+
+    @staticmethod
+    def __record(args: tuple, response: Response, started: float):
+        # with commands pipelined, the latency includes the time spent queued behind earlier ones
+        metrics.record_command(
+            command_verb(str(args[0]), args[1:]), time.perf_counter() - started, response.bytes_sent,
+            response.bytes_received, response_payload_size(response.untagged)
+        )
+
+    async def authenticate(self, mechanism: str, authobject: typing.Callable[[bytes], bytes | None]) -> Response:
+        """
+        Runs a SASL exchange; `authobject` works exactly as with imaplib.IMAP4.authenticate.
+        """
+        self.__continuation = asyncio.get_running_loop().create_future()
+        started = time.perf_counter()
+        future, response = self.__send("AUTHENTICATE", mechanism.upper())
+
+        while not future.done():
+            await asyncio.wait([future, self.__continuation], return_when=asyncio.FIRST_COMPLETED)
+            if self.__continuation.done() and not future.done():
+                challenge = base64.b64decode(self.__continuation.result())
+                self.__continuation = asyncio.get_running_loop().create_future()
+
+                answer = authobject(challenge)
+                if answer is None:
+                    self.__writer.write(b"*\r\n")
+                else:
+                    if isinstance(answer, str):
+                        answer = answer.encode("utf-8")
+                    self.__writer.write(base64.b64encode(answer) + b"\r\n")
+
+        self.__continuation = None
+        try:
+            await future
+        finally:
+            self.__record(("AUTHENTICATE",), response, started)
+
+        return response
+
+    async def close(self):
+        self.__closed = True
+        if self.__read_task:
+            self.__read_task.cancel()
+
+        try:
+            self.__writer.close()
+            await self.__writer.wait_closed()
+        except (ConnectionError, ssl.SSLError):
+            pass
+
+    async def __readline(self) -> bytes:
+        line = await self.__reader.readline()
+        if not line:
+            raise AsyncIMAP4.abort("socket error: EOF")
+
+        return line.rstrip(b"\r\n")
+
+    async def __read_loop(self):
+        try:
+            while True:
+                await self.__read_response()
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            error = exc if isinstance(exc, AsyncIMAP4.abort) else AsyncIMAP4.abort("socket error: %s" % str(exc))
+
+        self.__closed = True
+        for future, _ in self.__pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self.__pending.clear()
+
+        if self.__continuation and not self.__continuation.done():
+            self.__continuation.set_exception(error)
+
+    async def __read_response(self):
+        line = await self.__readline()
+
+        if line.startswith(b"+"):
+            if self.__continuation and not self.__continuation.done():
+                self.__continuation.set_result(line[2:])
+            return
+
+        if line.startswith(b"* "):
+            await self.__read_untagged(line)
+            return
+
+        tag, _, rest = line.partition(b" ")
+        status, _, text = rest.partition(b" ")
+
+        entry = self.__pending.pop(tag, None)
+        if entry is None:
+            raise AsyncIMAP4.abort("unexpected tagged response: %r" % line)
+
+        future, response = entry
+        response.bytes_received += len(line) + 2
+        response.status = status.decode("ascii", "replace").upper()
+        response.text = text
+
+        match = imaplib.Response_code.match(text)
+        if match:
+            response.append(match.group("type").decode("ascii"), match.group("data"))
+
+        if not future.done():
+            future.set_result(response)
+
+    async def __read_untagged(self, line: bytes):
+        # The server answers pipelined commands in order, so untagged data belongs to the oldest
+        # command still waiting for its tagged response. Data sent while nothing is waiting, e.g.
+        # EXISTS or EXPUNGE on an idle pooled connection, is read and dropped.
+        target = next(iter(self.__pending.values()))[1] if self.__pending else Response()
+
+        match = imaplib.Untagged_status.match(line)
+        if match:
+            typ, data, extra = match.group("type", "data", "data2")
+            if extra:
+                data = data + b" " + extra
+        else:
+            match = imaplib.Untagged_response.match(line)
+            if not match:
+                raise AsyncIMAP4.abort("unexpected response: %r" % line)
+            typ, data = match.group("type", "data")
+
+        typ = typ.decode("ascii")
+        data = data or b""
+        target.bytes_received += len(line) + 2
+
+        # same shape as imaplib: (line, literal) tuples followed by the rest of the line
+        literal_match = imaplib.Literal.match(data)
+        while literal_match:
+            literal = await self.__reader.readexactly(int(literal_match.group("size")))
+            target.append(typ, (data, literal))
+            data = await self.__readline()
+            target.bytes_received += len(literal) + len(data) + 2
+            literal_match = imaplib.Literal.match(data)
+
+        target.append(typ, data)
+
+        if typ in ("OK", "NO", "BAD", "BYE"):
+            match = imaplib.Response_code.match(data)
+            if match:
+                target.append(match.group("type").decode("ascii"), match.group("data"))
+
+    @property
+    def host(self) -> str:
+        return self.__host
+
+    @property
+    def closed(self) -> bool:
+        return self.__closed
+
+    @property
+    def in_flight(self) -> int:
+        return len(self.__pending)
+
+
+class SyncIMAP4:
+    """
+    An imaplib.IMAP4 look-alike on top of an AsyncIMAP4, so that code written against imaplib,
+    including GenericIMAP itself, works unchanged on the asyncio backend. Calls block the calling
+    thread, which must not be the event loop's.
+    """
+
+    error = imaplib.IMAP4.error
+    abort = imaplib.IMAP4.abort
+    readonly = imaplib.IMAP4.readonly
+
+    __connection: AsyncIMAP4
+    __loop: asyncio.AbstractEventLoop
+
+    state: str
+    untagged_responses: dict[str, list]
+    is_readonly: bool
+
+    def __init__(self, connection: AsyncIMAP4, loop: asyncio.AbstractEventLoop):
+        self.__connection = connection
+        self.__loop = loop
+        self.state = "NONAUTH"
+        self.untagged_responses = {}
+        self.is_readonly = False
+
+    def __run(self, coroutine: typing.Coroutine) -> typing.Any:
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+
+        if running is self.__loop:
+            coroutine.close()
+            raise RuntimeError("SyncIMAP4 can't block the event loop it runs on.")
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self.__loop).result()
+
+    def __merge(self, response: Response) -> tuple[str, list]:
+        for typ, values in response.untagged.items():
+            self.untagged_responses.setdefault(typ, []).extend(values)
+
+        return response.status, [response.text]
+
+    def _simple_command(self, name: str, *args: str) -> tuple[str, list]:
+        return self.__merge(self.__run(self.__connection.command(name, *(arg for arg in args if arg is not None))))
+
+    def _untagged_response(self, typ: str, dat: list, name: str) -> tuple[str, list]:
+        if typ == "NO":
+            return typ, dat
+
+        return typ, self.untagged_responses.pop(name, [None])
+
+    def response(self, code: str) -> tuple[str, list]:
+        return code, self.untagged_responses.pop(code.upper(), [None])
+
+    def capability(self) -> tuple[str, list]:
+        typ, dat = self._simple_command("CAPABILITY")
+        return self._untagged_response(typ, dat, "CAPABILITY")
+
+    def login(self, user: str, password: str) -> tuple[str, list]:
+        typ, dat = self._simple_command("LOGIN", user, _quote(password))
+        if typ != "OK":
+            raise self.error(dat[-1])
+
+        self.state = "AUTH"
+        return typ, dat
+
+    def authenticate(self, mechanism: str, authobject: typing.Callable[[bytes], bytes | None]) -> tuple[str, list]:
+        typ, dat = self.__merge(self.__run(self.__connection.authenticate(mechanism, authobject)))
+        if typ != "OK":
+            raise self.error(dat[-1].decode("utf-8", "replace"))
+
+        self.state = "AUTH"
+        return typ, dat
+
+    def enable(self, capability: str) -> tuple[str, list]:
+        if "ENABLE" not in self.capabilities:
+            raise self.error("Server does not support ENABLE")
+
+        return self._simple_command("ENABLE", capability)
+
+    def select(self, mailbox: str = "INBOX", readonly: bool = False) -> tuple[str, list]:
+        self.untagged_responses = {}
+        self.is_readonly = readonly
+
+        typ, dat = self._simple_command("EXAMINE" if readonly else "SELECT", mailbox)
+        if typ != "OK":
+            self.state = "AUTH"
+            return typ, dat
+
+        self.state = "SELECTED"
+        if "READ-ONLY" in self.untagged_responses and not readonly:
+            raise self.readonly("%s is not writable" % mailbox)
+
+        return typ, self.untagged_responses.get("EXISTS", [None])
+
+    def status(self, mailbox: str, names: str) -> tuple[str, list]:
+        typ, dat = self._simple_command("STATUS", mailbox, names)
+        return self._untagged_response(typ, dat, "STATUS")
+
+    def list(self, directory: str = '""', pattern: str = "*") -> tuple[str, list]:
+        typ, dat = self._simple_command("LIST", directory, pattern)
+        return self._untagged_response(typ, dat, "LIST")
+
+    def uid(self, command: str, *args: str) -> tuple[str, list]:
+        command = command.upper()
+        typ, dat = self._simple_command("UID", command, *args)
+        return self._untagged_response(typ, dat, command if command in ("SEARCH", "SORT", "THREAD") else "FETCH")
+
+    def search(self, charset: str | None, *criteria: str) -> tuple[str, list]:
+        typ, dat = self._simple_command("SEARCH", *((("CHARSET", charset) if charset else ()) + criteria))
+        return self._untagged_response(typ, dat, "SEARCH")
+
+    def fetch(self, message_set: str, message_parts: str) -> tuple[str, list]:
+        typ, dat = self._simple_command("FETCH", message_set, message_parts)
+        return self._untagged_response(typ, dat, "FETCH")
+
+    def store(self, message_set: str, command: str, flags: str) -> tuple[str, list]:
+        typ, dat = self._simple_command("STORE", message_set, command, flags)
+        return self._untagged_response(typ, dat, "FETCH")
+
+    def copy(self, message_set: str, new_mailbox: str) -> tuple[str, list]:
+        return self._simple_command("COPY", message_set, new_mailbox)
+
+    def expunge(self) -> tuple[str, list]:
+        typ, dat = self._simple_command("EXPUNGE")
+        return self._untagged_response(typ, dat, "EXPUNGE")
+
+    def noop(self) -> tuple[str, list]:
+        return self._simple_command("NOOP")
+
+    def logout(self) -> tuple[str, list]:
+        self.state = "LOGOUT"
+        try:
+            typ, dat = self._simple_command("LOGOUT")
+        except self.abort:
+            typ, dat = "NO", [b""]
+
+        self.__run(self.__connection.close())
+        return typ, dat
+
+    @property
+    def capabilities(self) -> tuple[str, ...]:
+        return self.__connection.capabilities
+
+    @capabilities.setter
+    def capabilities(self, capabilities: tuple[str, ...]):
+        self.__connection.capabilities = capabilities
+
+    @property
+    def host(self) -> str:
+        return self.__connection.host
+
+
+class AsyncGenericIMAP(GenericIMAP):
+    """
+    Base class for accounts on the asyncio backend. `imap` is an imaplib-compatible facade, so every
+    synchronous code path works as usual, while `connection` is the underlying AsyncIMAP4 for
+    pipelining commands. Coroutines using `connection` have to run on `loop`, e.g. through run().
+    """
+
+    __connection: AsyncIMAP4
+    __facade: SyncIMAP4
+
+    def __init__(self, host: str, port: int = 993, ssl_context: ssl.SSLContext | None = None):
+        self.__connection = AsyncIMAP4(host, port, ssl_context if ssl_context is not None else ssl.create_default_context())
+
+        try:
+            self.run(self.__connection.connect())
+        except (socket.gaierror, OSError) as err:
+            raise GenericIMAP.OperationError("Could not connect to host '%s': %s" % (host, str(err)))
+
+        self.__facade = SyncIMAP4(self.__connection, self.loop)
+
+    def run(self, coroutine: typing.Coroutine) -> typing.Any:
+        """
+        Runs a coroutine on the connection's event loop and waits for its result.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        return event_loop()
+
+    @property
+    def connection(self) -> AsyncIMAP4:
+        return self.__connection
+
+    @property
+    def imap(self) -> SyncIMAP4:
+        return self.__facade
+
+
+class AsyncManualIMAP(AsyncGenericIMAP):
+    __user: str
+    __password: str
+    __host: str
+    __authenticated: bool
+
+    def __init__(self, user: str, password: str, host: str, debug: bool = False):
+        self.__user = user
+        self.__password = password
+        self.__host = host
+        self.__authenticated = False
+        super().__init__(host)
+
+    def authenticate(self):
+        if self.__authenticated:
+            raise GenericIMAP.StateError("Already authenticated!")
+
+        self.imap.login(self.__user, self.__password)
+        self.__authenticated = True
+        self.refresh_capabilities()
+
+    def logout(self):
+        # LOGOUT is valid before authenticating too, and closes the connection either way
+        self.imap.logout()
+        self.__authenticated = False
+
+    def clone(self) -> AsyncManualIMAP:
+        return AsyncManualIMAP(self.__user, self.__password, self.__host)
+
+    def serialize(self) -> typing.Any:
+        return {
+            "user": self.__user,
+            "password": self.__password,
+            "host": self.__host
+        }
+
+    @classmethod
+    def build(cls, json_data: typing.Any, debug: bool = False) -> AsyncManualIMAP | None:
+        try:
+            return cls(
+                json_data["user"],
+                json_data["password"],
+                json_data["host"],
+                debug=debug
+            )
+        except KeyError:
+            return None
+
+    @property
+    def user(self) -> str:
+        return self.__user
+
+    @property
+    def authenticated(self) -> bool:
+        return self.__authenticated
+
+
+class AsyncGmailIMAP(AsyncGenericIMAP):
+    max_connections = GmailIMAP.max_connections
+
+    __user: str
+    __credentials: Credentials
+    __authenticated: bool
+
+    def __init__(self, user: str, credentials: Credentials, debug: bool = False):
+        self.__user = user
+        self.__credentials = credentials
+        self.__authenticated = False
+        super().__init__(GmailIMAP.GMAIL_IMAP_HOST)
+
+    def authenticate(self):
+        if self.__authenticated:
+            raise GenericIMAP.StateError("Already authenticated!")
+
+        self.imap.authenticate("XOAUTH2", functools.partial(GmailIMAP.gmail_auth_cbk, self.__user, GmailIMAP.current_token(self.__credentials)))
+        self.__authenticated = True
+        self.refresh_capabilities()
+
+    def logout(self):
+        # LOGOUT is valid before authenticating too, and closes the connection either way
+        self.imap.logout()
+        self.__authenticated = False
+
+    def clone(self) -> AsyncGmailIMAP:
+        return AsyncGmailIMAP(self.__user, self.__credentials)
+
+    def serialize(self) -> typing.Any:
+        data = json.loads(self.__credentials.to_json())
+        data["user"] = self.user
+        return data
+
+    @classmethod
+    def build(cls, json_data: typing.Any, debug: bool = False) -> AsyncGmailIMAP | None:
+        account = GmailIMAP.load_account(json_data)
+        if account is None:
+            return None
+
+        user, creds = account
+        client = cls(user, creds, debug=debug)
+        creds.keep_fresh()
+        return client
+
+    def verify_saved_user(self):
+        """
+        See GmailIMAP.verify_saved_user.
+        """
+        GmailIMAP.verify_user_later(self.__user, self.__credentials, self.__set_user)
+
+    def __set_user(self, user: str):
+        self.__user = user
+
+    @property
+    def user(self) -> str:
+        return self.__user
+
+    @property
+    def authenticated(self) -> bool:
+        return self.__authenticated
@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import base64
+import binascii
+import re
+
+
+# the From field of a header block, with its continuation lines
+FROM_FIELD_RE = re.compile(rb"^from[ \t]*:(.*(?:\r?\n[ \t].*)*)", re.IGNORECASE | re.MULTILINE)
+
+# the usual From field as fetched, a bare address or "Name <address>" on one line with nothing
+# quoted; anchored and starting with a literal, so that a mismatch is cheap
+TYPICAL_FROM_FIELD_RE = re.compile(
+    rb'From:[ \t]*(?:[^"(<>,:;\r\n]*<([^<>"(),:;\s]+)>|([^"(<>,:;\s=]+(?:=(?!\?)[^"(<>,:;\s=]*)*))[ \t]*\r?\n(?![ \t])'
+)
+
+# the common shapes of From field, a bare address or "Name <address>" (the name possibly quoted,
+# encoded or folded), settled in one match; anything else takes the general path. A bare token
+# holding an encoded word is left to the general path too, which decodes it.
+SIMPLE_FROM_FIELD_RE = re.compile(
+    rb'^[Ff][Rr][Oo][Mm][ \t]*:[ \t]*(?:([^"(<>,:;\s=]+(?:=(?!\?)[^"(<>,:;\s=]*)*)|[^"(<>,:;\r\n]*(?:(?:\r?\n[ \t]|"[^"\\\r\n]*(?:\\.[^"\\\r\n]*)*")[^"(<>,:;\r\n]*)*<[ \t]*([^<>"(),:;\s]+)[ \t]*>)[ \t]*\r?$(?!\n[ \t])',
+    re.MULTILINE  # IGNORECASE would slow down every character class, not just the field name
+)
+
+# parts of a field value that can't hold the address: quoted strings (an unterminated one runs to
+# the end of the value), comments (innermost first, for nested ones) and RFC 2047 encoded words
+NON_ADDRESS_RE = re.compile(rb'"(?:[^"\\]|\\.)*"?|\((?:[^()\\]|\\.)*\)|=\?[^?\s]+\?[bBqQ]\?[^?\s]*\?=', re.DOTALL)
+
+ANGLE_ADDR_RE = re.compile(rb"<([^<>]*)>?")
+
+ENCODED_WORD_RE = re.compile(rb"=\?([^?\s]+)\?([bBqQ])\?([^?\s]*)\?=")
+ENCODED_WORD_GAP_RE = re.compile(rb"(\?=)\s+(=\?)")
+
+FOLDING_RE = re.compile(rb"\r?\n(?=[ \t])")
+
+
+def parse_from_address(header_block: bytes) -> str | None:
+    """
+    Returns the address of the first mailbox in the From field of a raw header block, such as the
+    literal of a BODY[HEADER.FIELDS (FROM)] fetch, or None if there is no usable From field.
+
+    This only does as much of RFC 5322 as finding the address takes: quoted display names,
+    comments, folded lines and RFC 2047 encoded words are skipped over rather than decoded, and
+    bytes that aren't UTF-8 are read as Latin-1 rather than rejected.
+    """
+    match = TYPICAL_FROM_FIELD_RE.match(header_block) or SIMPLE_FROM_FIELD_RE.search(header_block)
+    if match:
+        # only one of the two alternatives' groups took part; this runs for nearly every message,
+        # so the decoding is inlined
+        address = match[match.lastindex]
+        try:
+            return address.decode("utf-8")
+        except UnicodeDecodeError:
+            return address.decode("latin-1")
+
+    match = FROM_FIELD_RE.search(header_block)
+    if not match:
+        return None
+
+    value = match.group(1)
+    address = _find_address(value)
+    if address is None and b"=?" in value:
+        # some mailers encode the whole field, address included
+        address = _find_address(decode_encoded_words(value).encode("utf-8"))
+
+    return _decode(address) if address else None
+
+
+def _find_address(value: bytes) -> bytes | None:
+    """
+    Returns the contents of the first mailbox's angle-addr or, if it has none, its bare addr-spec.
+    """
+    if b'"' in value or b"(" in value or b"=?" in value:
+        # blanked rather than removed, so that what was either side of them stays apart
+        stripped = NON_ADDRESS_RE.sub(b" ", value)
+        while stripped != value and b"(" in stripped:
+            value, stripped = stripped, NON_ADDRESS_RE.sub(b" ", stripped)
+        value = stripped
+
+    if b":" in value:
+        # a group: the name before the colon, the mailboxes up to the semicolon
+        value = value.partition(b":")[2].partition(b";")[0]
+
+    for mailbox in value.split(b",") if b"," in value else (value,):
+        angle = ANGLE_ADDR_RE.search(mailbox)
+        address = angle.group(1) if angle else mailbox
+        if b"\n" in address:
+            address = FOLDING_RE.sub(b"", address)
+
+        address = address.strip()
+        if address:
+            return address
+
+    return None
+
+
+def decode_encoded_words(value: bytes) -> str:
+    """
+    Decodes the RFC 2047 encoded words in a header value, leaving the rest as it is. Unknown
+    charsets and malformed words are decoded as well as possible instead of raising.
+    """
+    value = ENCODED_WORD_GAP_RE.sub(rb"\1\2", value)  # whitespace between adjacent encoded words isn't displayed
+
+    parts = []
+    position = 0
+    for match in ENCODED_WORD_RE.finditer(value):
+        parts.append(_decode(value[position:match.start()]))
+
+        charset, encoding, text = match.groups()
+        try:
+            if encoding in b"bB":
+                data = base64.b64decode(text + b"=" * (-len(text) % 4))
+            else:
+                data = binascii.a2b_qp(text, header=True)
+        except (binascii.Error, ValueError):
+            parts.append(_decode(match.group(0)))
+        else:
+            charset = charset.split(b"*", 1)[0].decode("ascii", "replace")  # drop an RFC 2231 language
+            try:
+                parts.append(data.decode(charset, "replace"))
+            except LookupError:
+                parts.append(_decode(data))
+
+        position = match.end()
+
+    parts.append(_decode(value[position:]))
+    return "".join(parts)
+
+
+def _decode(data: bytes) -> str:
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return data.decode("latin-1")
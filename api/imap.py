@@ -1,8 +1,7 @@
 from __future__ import annotations
 
-from googleapiclient.discovery import build
-
 from abc import ABCMeta, abstractclassmethod, abstractmethod
+import contextlib
 import datetime
 import functools
 import imaplib
@@ -10,11 +9,17 @@ import logging
 import json
 import re
 import socket
+import threading
+import time
 import typing
 import warnings
 
 import config
-from credentials import Credentials
+import metrics
+import util
+
+if typing.TYPE_CHECKING:
+    from credentials import Credentials
 
 
 class Registry(type):
@@ -49,6 +54,93 @@ class AbstractRegistry(ABCMeta, Registry):
         return super().__new__(cls, name, bases, dct)
 
 
+ProgressCallback = typing.Callable[[int, int], None]
+
+T = typing.TypeVar("T")
+
+
+def command_verb(name: str, args: tuple) -> str:
+    # UID commands are told apart by what they do, e.g. UID FETCH and UID MOVE
+    if name.upper() == "UID" and args:
+        return "UID %s" % str(args[0]).upper()
+
+    return name.upper()
+
+
+def response_payload_size(untagged_responses: dict[str, list]) -> int:
+    size = 0
+    for data in untagged_responses.values():
+        for item in data:
+            if isinstance(item, tuple):
+                size += sum(len(part) for part in item if part)
+            elif item:
+                size += len(item)
+
+    return size
+
+
+class InstrumentedIMAP4(imaplib.IMAP4):
+    """
+    imaplib.IMAP4, recording every command's latency and traffic with the metrics module.
+    """
+
+    __bytes_sent: int = 0
+    __bytes_received: int = 0
+    __payload_size: int = 0
+
+    # the mailbox last selected, whether read-only, and its UIDVALIDITY, so that a new connection can
+    # pick up where this one was if it drops
+    selected: tuple[str, bool, int | None] | None = None
+
+    def select(self, mailbox: str = "INBOX", readonly: bool = False):
+        status, data = super().select(mailbox, readonly)
+        if status == "OK":
+            # read without popping, since callers look for it in the responses themselves
+            uidvalidity = self.untagged_responses.get("UIDVALIDITY", [None])[-1]
+            self.selected = (mailbox, readonly, int(uidvalidity) if uidvalidity else None)
+        else:
+            self.selected = None
+
+        return status, data
+
+    def send(self, data: bytes):
+        self.__bytes_sent += len(data)
+        super().send(data)
+
+    def read(self, size: int) -> bytes:
+        data = super().read(size)
+        self.__bytes_received += len(data)
+        return data
+
+    def readline(self) -> bytes:
+        line = super().readline()
+        self.__bytes_received += len(line)
+        return line
+
+    def _append_untagged(self, typ: str, dat):
+        if isinstance(dat, tuple):
+            self.__payload_size += sum(len(part) for part in dat if part)
+        elif dat:
+            self.__payload_size += len(dat)
+
+        super()._append_untagged(typ, dat)
+
+    def _simple_command(self, name: str, *args):
+        sent, received, payload = self.__bytes_sent, self.__bytes_received, self.__payload_size
+        started = time.perf_counter()
+        try:
+            return super()._simple_command(name, *args)
+        finally:
+            metrics.record_command(
+                command_verb(name, args), time.perf_counter() - started, self.__bytes_sent - sent,
+                self.__bytes_received - received, self.__payload_size - payload
+            )
+
+
+class InstrumentedIMAP4_SSL(InstrumentedIMAP4, imaplib.IMAP4_SSL):
+    pass
+
+
 class GenericIMAP(metaclass=AbstractRegistry):
     # Courtesy of https://pymotw.com/3/imaplib/
     LIST_RESPONSE_PATTERN = re.compile(
@@ -57,6 +149,23 @@ class GenericIMAP(metaclass=AbstractRegistry):
 
     _abstract_ = True
 
+    max_command_bytes: int = config.IMAP_MAX_COMMAND_BYTES
+
+    # simultaneous connections the server allows per account; many servers default to 10
+    max_connections: int = 10
+
+    # times a dropped connection is reopened before an operation gives up, waiting RECONNECT_DELAY
+    # after the first failed attempt and twice as long after every other
+    reconnect_attempts: int = 3
+    RECONNECT_DELAY = 1.0  # seconds
+
+    __capabilities: frozenset[str] | None = None
+    __enabled: frozenset[str] = frozenset()
+
+    # the mailbox selected and the extensions enabled before the connection dropped, kept until a
+    # reconnect succeeds, since a failed one leaves a new connection without them
+    __unrestored: tuple[tuple[str, bool, int | None] | None, frozenset[str]] | None = None
+
     @abstractmethod
     def authenticate(self):
         raise NotImplementedError()
@@ -72,7 +181,27 @@ class GenericIMAP(metaclass=AbstractRegistry):
     @abstractclassmethod
     def build(cls, json_data: typing.Any, debug: bool = False) -> GenericIMAP:
         raise NotImplementedError()
+
+    @abstractmethod
+    def clone(self) -> GenericIMAP:
+        """
+        Opens a new, unauthenticated connection to the same account.
+        """
+        raise NotImplementedError()
     
+    def reopen(self):
+        """
+        Replaces the connection with a new, unauthenticated one to the same account. Only accounts
+        that implement this are reconnected when their connection drops.
+        """
+        raise NotImplementedError()
+
+    def verify_saved_user(self):
+        """
+        Checks in the background that the saved address is still the account's, for accounts that
+        look it up. Does nothing for the others.
+        """
+
     @property
     @abstractmethod
     def imap(self) -> imaplib.IMAP4:
@@ -83,49 +212,307 @@ class GenericIMAP(metaclass=AbstractRegistry):
     def user(self) -> str:
         raise NotImplementedError()
     
+    def reconnect(self):
+        """
+        Replaces a dropped connection: opens a new one, authenticates, enables the extensions that
+        were enabled and selects the mailbox that was selected, retrying with a growing delay if the
+        server can't be reached. Raises OperationError if the mailbox's UIDVALIDITY changed, as the
+        UIDs known from before would then refer to other messages. If reconnecting fails, what was
+        selected and enabled is kept, so that calling it again, e.g. through run_reconnecting, can
+        finish the job.
+        """
+        if self.__unrestored is None:
+            self.__unrestored = (getattr(self.imap, "selected", None) if self.authenticated else None, self.__enabled)
+
+        selected, enabled = self.__unrestored
+        delay = self.RECONNECT_DELAY
+
+        for attempt in range(1, self.reconnect_attempts + 1):
+            if attempt > 1:
+                time.sleep(delay)
+                delay *= 2
+
+            try:
+                self.reopen()
+                self.__capabilities = None
+                self.__enabled = frozenset()
+                self.authenticate()
+
+                for extension in enabled:
+                    self.enable_extension(extension)
+
+                if selected:
+                    status, _ = self.imap.select(selected[0], readonly=selected[1])
+                    if status != "OK":
+                        raise GenericIMAP.OperationError("Could not select mailbox '%s'" % selected[0])
+                break
+            except (imaplib.IMAP4.abort, OSError, GenericIMAP.OperationError) as err:
+                if attempt == self.reconnect_attempts:
+                    raise
+
+                logging.warning("Could not reconnect %s (attempt %d): %s" % (self.user, attempt, str(err)))
+
+        self.__unrestored = None
+        logging.info("Reconnected %s" % self.user)
+
+        if selected and selected[2] is not None:
+            reselected = getattr(self.imap, "selected", None)
+            if reselected and reselected[2] != selected[2]:
+                raise GenericIMAP.OperationError("UIDVALIDITY of '%s' changed while reconnecting." % selected[0])
+
+    def run_reconnecting(self, operation: typing.Callable[[], T]) -> T:
+        """
+        Runs `operation`, which issues commands through `imap`, and if the connection drops on the
+        way (imaplib.IMAP4.abort, or a socket error), reconnects and runs it again, up to
+        `reconnect_attempts` times. `operation` must look up `imap` on every call, since reconnecting
+        replaces it, and must be safe to repeat, e.g. fetching or moving one chunk of UIDs.
+        """
+        for attempt in range(self.reconnect_attempts + 1):
+            try:
+                if self.__unrestored is not None:
+                    # an earlier reconnect failed halfway, e.g. refreshing the token to authenticate
+                    self.reconnect()
+
+                return operation()
+            except (imaplib.IMAP4.abort, OSError) as err:
+                if attempt == self.reconnect_attempts:
+                    raise
+
+                logging.warning("Connection of %s dropped: %s. Reconnecting." % (self.user, str(err)))
+
+                try:
+                    self.reconnect()
+                except NotImplementedError:
+                    raise err from None
+
     def check_folder(self, folder: str) -> bool:
-        _, folder_list = self.imap.list()
+        _, folder_list = self.run_reconnecting(lambda: self.imap.list())
         folder_names = [
             GenericIMAP.LIST_RESPONSE_PATTERN.match(item.decode('utf-8')).group('name')[1:-1] for item in folder_list
         ]
         return folder in folder_names
-    
-    def delete_messages(self, messages: set[int], source_mailbox: str = 'Inbox'):
-        self.imap.select(source_mailbox)
 
-        message_set = ",".join([str(message) for message in messages])
+    def refresh_capabilities(self) -> frozenset[str]:
+        """
+        Reads the server's capabilities, which usually change once authenticated, so this should be
+        called again after authenticating. Most servers include them in the response to LOGIN or
+        AUTHENTICATE, which saves a round trip.
+        """
+        _, data = self.imap.response("CAPABILITY")
+        if not data or not data[-1]:
+            status, data = self.imap.capability()
+            if status != "OK":
+                raise GenericIMAP.OperationError("Could not read server capabilities.")
+
+        capabilities = frozenset(data[-1].decode("utf-8").upper().split())
+
+        # imaplib only knows the pre-authentication capabilities and checks them in e.g. enable()
+        self.imap.capabilities = tuple(capabilities)
+        self.__capabilities = capabilities
+        return capabilities
+
+    @property
+    def capabilities(self) -> frozenset[str]:
+        if self.__capabilities is None:
+            return self.refresh_capabilities()
+
+        return self.__capabilities
+
+    def has_capability(self, capability: str) -> bool:
+        return capability.upper() in self.capabilities
+
+    def enable_extension(self, extension: str) -> bool:
+        """
+        Enables an RFC 5161 extension such as QRESYNC for the rest of the session. Returns whether
+        the extension is enabled; servers that don't support it are not asked.
+        """
+        extension = extension.upper()
+        if extension in self.__enabled:
+            return True
+
+        if not self.has_capability("ENABLE") or not self.has_capability(extension):
+            return False
 
         try:
-            status, _ = self.imap.store(message_set, "+FLAGS", "\\Deleted")
+            status, _ = self.imap.enable(extension)
+        except imaplib.IMAP4.error:
+            return False
+
+        _, data = self.imap.response("ENABLED")
+        enabled = {item.upper() for line in data if line for item in line.decode("utf-8").split()}
+        if status != "OK" or extension not in enabled:
+            return False
+
+        self.__enabled = self.__enabled | {extension}
+        return True
+
+    def select_mailbox(self, mailbox: str = 'Inbox', readonly: bool = False) -> GenericIMAP.MailboxState:
+        status, response = self.run_reconnecting(lambda: self.imap.select(mailbox, readonly=readonly))
+        if status != "OK":
+            raise GenericIMAP.OperationError("Could not select mailbox '%s'" % mailbox)
+
+        exists = int(response[0]) if response and response[0] else 0
+        uidvalidity = self.__response_int("UIDVALIDITY")
+        uidnext = self.__response_int("UIDNEXT")
+
+        # servers without CONDSTORE, or mailboxes without persistent mod-sequences (NOMODSEQ),
+        # simply don't send HIGHESTMODSEQ
+        highestmodseq = self.__response_int("HIGHESTMODSEQ")
+
+        if uidvalidity is None or uidnext is None:
+            # UIDNEXT is only a SHOULD in the SELECT response, but STATUS has to answer it.
+            status, response = self.run_reconnecting(lambda: self.imap.status(mailbox, "(UIDNEXT UIDVALIDITY)"))
             if status != "OK":
-                raise GenericIMAP.OperationError("Delete failed: could not mark messages as deleted.")
-            
-            status, _ = self.imap.expunge()
-            if status != "OK":
-                raise GenericIMAP.OperationError("Expunge failed: could not expunge deleted messages")
+                raise GenericIMAP.OperationError("Could not get status of mailbox '%s'" % mailbox)
+
+            match = re.search(rb"UIDNEXT (\d+)", response[0])
+            uidnext = int(match.group(1)) if match else 1
+            match = re.search(rb"UIDVALIDITY (\d+)", response[0])
+            uidvalidity = int(match.group(1)) if match else 0
+
+        return GenericIMAP.MailboxState(mailbox, exists, uidvalidity, uidnext, highestmodseq)
+
+    def __response_int(self, code: str) -> int | None:
+        _, data = self.imap.response(code)
+        if data and data[-1]:
+            try:
+                return int(data[-1])
+            except ValueError:
+                return None
+
+        return None
+
+    def fetch_vanished(self, since_modseq: int, highest_uid: int) -> list[int]:
+        """
+        Lists the UIDs up to `highest_uid` that were expunged since `since_modseq`, using the
+        QRESYNC (RFC 7162) VANISHED modifier. QRESYNC must have been enabled with enable_extension
+        before the mailbox was selected.
+        """
+        if highest_uid <= 0:
+            return []
+
+        try:
+            status, _ = self.run_reconnecting(lambda: self.imap.uid(
+                "FETCH", "1:%d" % highest_uid, "(UID)", "(CHANGEDSINCE %d VANISHED)" % since_modseq
+            ))
+        except imaplib.IMAP4.error as err:
+            raise GenericIMAP.OperationError("Could not fetch expunged messages: %s" % str(err))
+
+        if status != "OK":
+            raise GenericIMAP.OperationError("Could not fetch expunged messages.")
+
+        vanished = []
+        _, data = self.imap.response("VANISHED")
+        for line in data:
+            if line:
+                vanished.extend(util.parse_sequence_set(line.replace(b"(EARLIER)", b"")))
+
+        return vanished
+    
+    def delete_messages(self, uids: set[int], source_mailbox: str = 'Inbox', progress: ProgressCallback | None = None,
+                        token: util.CancellationToken | None = None):
+        self.run_reconnecting(lambda: self.imap.select(source_mailbox))
+
+        total = len(uids)
+        done = 0
+
+        try:
+            for message_set, count in self.__split(uids):
+                if token:
+                    token.raise_if_cancelled()
+
+                self.run_reconnecting(functools.partial(self.__remove, message_set, "Delete failed"))
+
+                done += count
+                if progress:
+                    progress(done, total)
         except imaplib.IMAP4.error as err:
             raise GenericIMAP.OperationError("Delete failed: IMAP error. Message: " + str(err))
     
-    def move(self, messages: set[int], mailbox: str, source_mailbox: str = 'Inbox'):
-        self.imap.select(source_mailbox)
+    def move(self, uids: set[int], mailbox: str, source_mailbox: str = 'Inbox', progress: ProgressCallback | None = None,
+             token: util.CancellationToken | None = None):
+        """
+        Moves the messages in as many commands as it takes to keep each one short. If `token` is
+        cancelled, this stops between commands, leaving every message either moved or untouched.
+
+        If the connection drops, the command in flight is sent again once reconnected, which is
+        harmless for UIDs already moved. Without MOVE, a COPY whose response was lost is repeated
+        too, and may leave duplicates in `mailbox`.
+        """
+        self.run_reconnecting(lambda: self.imap.select(source_mailbox))
 
-        message_set = ",".join([str(message) for message in messages])
+        total = len(uids)
+        done = 0
 
         try:
-            status, _ = self.imap.copy(message_set, mailbox)
-            if status != "OK":
-                raise GenericIMAP.OperationError("Move failed: could not copy messages to mailbox '%s'" % mailbox)
-            
-            status, _ = self.imap.store(message_set, "+FLAGS", "\\Deleted")
-            if status != "OK":
-                raise GenericIMAP.OperationError("Move failed: could not mark messages as deleted.")
-            
-            status, _ = self.imap.expunge()
-            if status != "OK":
-                raise GenericIMAP.OperationError("Expunge failed: could not expunge deleted messages")
+            for message_set, count in self.__split(uids, overhead=len(mailbox)):
+                if token:
+                    token.raise_if_cancelled()
+
+                if self.has_capability("MOVE"):
+                    # RFC 6851: a single round trip, and the server doesn't have to store a copy
+                    self.run_reconnecting(functools.partial(self.__move, message_set, mailbox))
+                else:
+                    # each step is retried on its own, so that dropping the connection after the
+                    # copy doesn't copy the messages again
+                    self.run_reconnecting(functools.partial(self.__copy, message_set, mailbox))
+                    self.run_reconnecting(functools.partial(self.__remove, message_set, "Move failed"))
+
+                done += count
+                if progress:
+                    progress(done, total)
         except imaplib.IMAP4.error as err:
             raise GenericIMAP.OperationError("Move failed: IMAP error. Message: " + str(err))
+
+    def __move(self, message_set: str, mailbox: str):
+        status, _ = self.imap.uid("MOVE", message_set, mailbox)
+        if status != "OK":
+            raise GenericIMAP.OperationError("Move failed: could not move messages to mailbox '%s'" % mailbox)
+
+        self.__discard_expunge_responses()
+
+    def __copy(self, message_set: str, mailbox: str):
+        status, _ = self.imap.uid("COPY", message_set, mailbox)
+        if status != "OK":
+            raise GenericIMAP.OperationError("Move failed: could not copy messages to mailbox '%s'" % mailbox)
+
+    def __remove(self, message_set: str, failure: str):
+        status, _ = self.imap.uid("STORE", message_set, "+FLAGS.SILENT", "\\Deleted")
+        if status != "OK":
+            raise GenericIMAP.OperationError("%s: could not mark messages as deleted." % failure)
+
+        self.__expunge(message_set)
+
+    def __split(self, uids: set[int], overhead: int = 0) -> typing.Generator[tuple[str, int], None, None]:
+        # leave room for the tag, the command and its other arguments
+        budget = max(self.max_command_bytes - overhead - 64, 64)
+        return util.split_sequence_set(uids, budget)
+
+    def __expunge(self, message_set: str):
+        if self.has_capability("UIDPLUS"):
+            # only expunges our messages, not ones another client happens to have marked \Deleted
+            status, _ = self.imap.uid("EXPUNGE", message_set)
+        else:
+            status, _ = self.imap.expunge()
+
+        if status != "OK":
+            raise GenericIMAP.OperationError("Expunge failed: could not expunge deleted messages")
+
+        self.__discard_expunge_responses()
+
+    def __discard_expunge_responses(self):
+        # imaplib keeps every untagged EXPUNGE/VANISHED response until the next SELECT,
+        # which adds up over a large purge
+        self.imap.response("EXPUNGE")
+        self.imap.response("VANISHED")
     
+    class MailboxState(typing.NamedTuple):
+        mailbox: str
+        exists: int
+        uidvalidity: int
+        uidnext: int
+        highestmodseq: int | None = None
+
     class StateError(Exception):
         def __init__(self, msg):
             super().__init__(msg)
@@ -138,40 +525,60 @@ class GenericIMAP(metaclass=AbstractRegistry):
 class GmailIMAP(GenericIMAP):
     GMAIL_IMAP_HOST = "imap.gmail.com"
 
+    max_connections = 15
+
+    # how long after startup the saved address is checked against Google, so that the check doesn't
+    # compete with connecting and scanning
+    VERIFY_USER_DELAY = 30.0  # seconds
+
     __user: str
     __credentials: Credentials
     __client: imaplib.IMAP4
     __authenticated: bool
+    __debug: bool
 
     def __init__(self, user: str, credentials: Credentials, debug: bool = False):
         self.__user = user
         self.__credentials = credentials
+        self.__debug = debug
+        self.__client = self.__connect()
+        self.__authenticated = False
 
-        if debug:
+    def __connect(self) -> imaplib.IMAP4:
+        if self.__debug:
             imaplib.Debug = 4
 
         try:
-            self.__client = imaplib.IMAP4_SSL(GmailIMAP.GMAIL_IMAP_HOST)
+            return InstrumentedIMAP4_SSL(GmailIMAP.GMAIL_IMAP_HOST)
         except socket.gaierror:
             raise GenericIMAP.OperationError("Could not connect to host.")
+        finally:
+            if self.__debug:
+                imaplib.Debug = 0
 
-        if debug:
-            imaplib.Debug = 0
+    def reopen(self):
+        with contextlib.suppress(OSError):
+            self.__client.shutdown()
 
         self.__authenticated = False
+        self.__client = self.__connect()
     
     def authenticate(self):
         if self.authenticated:
             raise GenericIMAP.StateError("Already authenticated!")
 
-        self.__client.authenticate("XOAUTH2", functools.partial(GmailIMAP.gmail_auth_cbk, self.__user, self.__credentials.token))
+        self.__client.authenticate("XOAUTH2", functools.partial(GmailIMAP.gmail_auth_cbk, self.__user, GmailIMAP.current_token(self.__credentials)))
         self.__authenticated = True
+        self.refresh_capabilities()
 
     def logout(self):
-        self.__require_auth()
+        # LOGOUT is valid before authenticating too, and closes the connection either way
         self.__client.logout()
         self.__authenticated = False
 
+    def clone(self) -> GmailIMAP:
+        return GmailIMAP(self.__user, self.__credentials, debug=self.__debug)
+
     def __require_auth(self):
         if not self.__authenticated:
             raise GenericIMAP.StateError("Must be authenticated first.")
@@ -191,14 +598,54 @@ class GmailIMAP(GenericIMAP):
         data["user"] = self.user
         return data
     
-    @classmethod
+    @staticmethod
+    def current_token(credentials: Credentials) -> str:
+        # connections opened late in a long operation, by the pool or to reconnect, mustn't be
+        # handed an expired token if keep_fresh fell behind, e.g. while the computer slept
+        if not credentials.valid and credentials.refresh_token:
+            if credentials.refresh_error is not None:
+                # keep_fresh gave up on a revoked refresh token; there's nothing to retry
+                raise GenericIMAP.OperationError("Sign in again, the account's access was revoked: %s" % str(credentials.refresh_error))
+
+            GmailIMAP.refresh_credentials(credentials)
+
+        return credentials.token
+
+    @staticmethod
     def refresh_credentials(credentials: Credentials):
-        credentials.refresh()
+        # only needed for credentials without a refresh token, which Google refreshes itself
+        from google.auth.transport.requests import Request
+
+        credentials.refresh(Request())
     
     @classmethod
     def build(cls, json_data: typing.Any, debug: bool = False) -> GmailIMAP | None:
+        account = cls.load_account(json_data)
+        if account is None:
+            return None
+
+        user, creds = account
+        client = cls(
+            user,
+            creds,
+            debug=debug
+        )
+        creds.keep_fresh()
+        return client
+
+    @classmethod
+    def load_account(cls, json_data: typing.Any) -> tuple[str, Credentials] | None:
+        """
+        Rebuilds the credentials in serialized account data, refreshing them if they expired, and
+        returns them with the account's address, which is only looked up if the data doesn't have
+        it. Returns None if the account can't be used anymore.
+        """
+        # google-auth is only loaded for Gmail accounts
+        from credentials import Credentials
+
         try:
-            expiry_raw = json_data.get("expiry_date")
+            # saved by to_json as an ISO string under "expiry", or by the auth service in milliseconds
+            expiry_raw = json_data.get("expiry_date") or json_data.get("expiry")
             if expiry_raw and isinstance(expiry_raw, int):
                 utc_expiry = datetime.datetime.fromtimestamp(expiry_raw // 1000, tz=datetime.timezone.utc)
                 utc_expiry = utc_expiry.replace(tzinfo=None)
@@ -222,26 +669,58 @@ class GmailIMAP(GenericIMAP):
             if not creds.valid:
                 if creds.expired and creds.refresh_token:
                     logging.info("Credentials expired, refreshing.")
-                    cls.refresh_credentials(creds)
+                    try:
+                        cls.refresh_credentials(creds)
+                    except Exception:
+                        if creds.refresh_error is None:
+                            raise
+
+                        warnings.warn("Could not refresh credentials: \"%s\"" % str(creds.refresh_error))
+                        return None
                 else:
                     return None
             
-            try:
-                user = cls.get_user_email(creds)
-            except Exception as exc:
-                logging.exception(str(exc))
-                return None
+            # The address is saved with the account, so it only has to be looked up (which loads the
+            # discovery client and takes an HTTP round trip) for data saved without it.
+            user = json_data.get("user")
+            if not user:
+                try:
+                    user = cls.get_user_email(creds)
+                except Exception as exc:
+                    logging.exception(str(exc))
+                    return None
 
-            return cls(
-                user,
-                creds,
-                debug=debug
-            )
+            return user, creds
         else:
             return None
     
+    @staticmethod
+    def verify_user_later(user: str, credentials: Credentials, on_changed: typing.Callable[[str], None]):
+        """
+        Looks up the account's address again after VERIFY_USER_DELAY, on a background thread, and
+        calls `on_changed` with the new address if it is no longer `user`. If the lookup fails, the
+        saved address stays in use.
+        """
+        def verify():
+            try:
+                current = GmailIMAP.get_user_email(credentials)
+            except Exception:
+                logging.info("Could not verify the address of %s" % user, exc_info=True)
+                return
+
+            if current != user:
+                logging.warning("Account %s now signs in as %s" % (user, current))
+                on_changed(current)
+
+        timer = threading.Timer(GmailIMAP.VERIFY_USER_DELAY, verify)
+        timer.daemon = True
+        timer.start()
+
     @staticmethod
     def get_user_email(credentials: Credentials) -> str:
+        # the discovery client takes a good fraction of a second to import
+        from googleapiclient.discovery import build
+
         userinfo_service = build(
             serviceName="oauth2", version="v2", credentials=credentials
         )
@@ -250,6 +729,16 @@ class GmailIMAP(GenericIMAP):
 
         return response["email"]
     
+    def verify_saved_user(self):
+        """
+        Checks the saved address against Google in the background, VERIFY_USER_DELAY from now. Only
+        the interactive app does this, as a headless run may well be over before the check is due.
+        """
+        GmailIMAP.verify_user_later(self.__user, self.__credentials, self.__set_user)
+
+    def __set_user(self, user: str):
+        self.__user = user
+
     @property
     def user(self) -> str:
         return self.__user
@@ -270,22 +759,35 @@ class ManualIMAP(GenericIMAP):
     __authenticated: bool
 
     __password: str
+    __host: str
+    __debug: bool
 
     def __init__(self, user: str, password: str, host: str, debug: bool = False):
         self.__user = user
         self.__password = password
+        self.__host = host
+        self.__debug = debug
         self.__authenticated = False
+        self.__client = self.__connect()
 
-        if debug:
+    def __connect(self) -> imaplib.IMAP4:
+        if self.__debug:
             imaplib.Debug = 4
 
         try:
-            self.__client = imaplib.IMAP4_SSL(host)
+            return InstrumentedIMAP4_SSL(self.__host)
         except socket.gaierror:
-            raise GenericIMAP.OperationError("Could not connect to host '%s'" % host)
+            raise GenericIMAP.OperationError("Could not connect to host '%s'" % self.__host)
+        finally:
+            if self.__debug:
+                imaplib.Debug = 0
 
-        if debug:
-            imaplib.Debug = 0
+    def reopen(self):
+        with contextlib.suppress(OSError):
+            self.__client.shutdown()
+
+        self.__authenticated = False
+        self.__client = self.__connect()
 
     def authenticate(self):
         if self.authenticated:
@@ -293,12 +795,16 @@ class ManualIMAP(GenericIMAP):
 
         self.__client.login(self.__user, self.__password)
         self.__authenticated = True
+        self.refresh_capabilities()
     
     def logout(self):
-        self.__require_auth()
+        # LOGOUT is valid before authenticating too, and closes the connection either way
         self.__client.logout()
         self.__authenticated = False
 
+    def clone(self) -> ManualIMAP:
+        return ManualIMAP(self.__user, self.__password, self.__host, debug=self.__debug)
+
     def __require_auth(self):
         if not self.__authenticated:
             raise GenericIMAP.StateError("Must be authenticated first.")
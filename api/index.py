@@ -0,0 +1,367 @@
+from __future__ import annotations
+
+import array
+import bisect
+import typing
+
+import persist
+import util
+
+
+SENDERS_KEY = "sender-index"
+STATE_KEY = "sender-index-state"
+
+# sender id of a removed row, until the columns are next compacted
+_REMOVED = 0xFFFFFFFF
+
+
+class SenderIndex:
+    """
+    The senders seen in a mailbox and the UIDs of their messages, along with the UIDVALIDITY,
+    highest UID and HIGHESTMODSEQ they were synced up to, so that a later sync only has to fetch
+    what changed since.
+
+    Per-message data is kept in array-backed columns ordered by UID, which is far more compact than
+    an object per message and cheap to aggregate into per-sender statistics.
+
+    Messages whose sender couldn't be parsed are kept under UNKNOWN_SENDER, so that the index still
+    accounts for every message in the mailbox; that sender is left out of `senders` and `stats`.
+    """
+
+    UNKNOWN_SENDER = ""
+
+    class Message(typing.NamedTuple):
+        uid: int
+        sender: str
+        size: int
+        date: int  # INTERNALDATE, as a Unix timestamp
+
+    class Stats(typing.NamedTuple):
+        count: int
+        size: int
+        oldest: int
+        newest: int
+
+    __uidvalidity: int | None
+    __highest_uid: int
+    __highestmodseq: int | None
+
+    __names: list[str]
+    __ids: dict[str, int]
+    __senders: dict[str, set[int]]
+
+    __uid_column: array.array
+    __sender_column: array.array
+    __size_column: array.array
+    __date_column: array.array
+    __sorted_rows: int
+    __unsorted_uids: set[int]
+    __removed_rows: int
+    __stats: dict[str, Stats] | None
+
+    __changed: set[str]
+    __replaced: bool
+
+    def __init__(self, uidvalidity: int | None = None, highest_uid: int = 0, highestmodseq: int | None = None,
+                 messages: typing.Iterable[Message] = ()):
+        self.__uidvalidity = uidvalidity
+        self.__highest_uid = highest_uid
+        self.__highestmodseq = highestmodseq
+        self.__clear()
+
+        self.update(messages)
+
+    def __clear(self):
+        self.__names = []
+        self.__ids = {}
+        self.__senders = {}
+        self.__uid_column = array.array("L")
+        self.__sender_column = array.array("L")
+        self.__size_column = array.array("Q")
+        self.__date_column = array.array("q")
+        self.__sorted_rows = 0  # rows below this are ordered by UID, the rest are in the order they were added
+        self.__unsorted_uids = set()
+        self.__removed_rows = 0
+        self.__stats = None
+        self.__changed = set()
+        self.__replaced = True
+
+    def is_valid_for(self, uidvalidity: int) -> bool:
+        return self.__uidvalidity is not None and self.__uidvalidity == uidvalidity
+
+    def reset(self, uidvalidity: int):
+        self.__uidvalidity = uidvalidity
+        self.__highest_uid = 0
+        self.__highestmodseq = None
+        self.__clear()
+
+    def update(self, chunk: typing.Iterable[Message]):
+        for uid, sender, size, date in chunk:
+            sender_id = self.__ids.get(sender)
+            if sender_id is None:
+                sender_id = self.__ids[sender] = len(self.__names)
+                self.__names.append(sender)
+
+            row = self.__find(uid)
+            if row is None and uid in self.__unsorted_uids:
+                # sent again out of order, e.g. rescanned after a cancelled parallel sync
+                self.__normalize()
+                row = self.__find(uid)
+
+            if row is None:
+                # a sequential scan only ever appends to the ordered rows
+                in_order = self.__sorted_rows == len(self.__uid_column) and (not self.__uid_column or uid > self.__uid_column[-1])
+
+                self.__uid_column.append(uid)
+                self.__sender_column.append(sender_id)
+                self.__size_column.append(size)
+                self.__date_column.append(date)
+
+                if in_order:
+                    self.__sorted_rows += 1
+                else:
+                    self.__unsorted_uids.add(uid)
+            else:
+                previous = self.__names[self.__sender_column[row]]
+                if previous != sender:
+                    self.__drop_uid(previous, uid)
+
+                self.__sender_column[row] = sender_id
+                self.__size_column[row] = size
+                self.__date_column[row] = date
+
+            self.__senders.setdefault(sender, set()).add(uid)
+            self.__changed.add(sender)
+            self.__highest_uid = max(self.__highest_uid, uid)
+
+        self.__stats = None
+
+    def remove_uids(self, uids: typing.Iterable[int]):
+        self.__normalize()
+        for uid in uids:
+            row = self.__find(uid)
+            if row is not None:
+                self.__drop_uid(self.__names[self.__sender_column[row]], uid)
+                self.__remove_row(row)
+
+        self.__stats = None
+
+    def retain_uids(self, uids: typing.Iterable[int]):
+        """
+        Drops every message that is not in `uids`, which should be the complete list of UIDs
+        currently in the mailbox.
+        """
+        current = set(uids)
+        self.__normalize()
+        self.remove_uids([
+            uid for uid, sender_id in zip(self.__uid_column, self.__sender_column)
+            if sender_id != _REMOVED and uid not in current
+        ])
+
+    def discard(self, senders: typing.Iterable[str]):
+        self.__normalize()
+        for sender in senders:
+            for uid in self.__senders.pop(sender, ()):
+                row = self.__find(uid)
+                if row is not None:
+                    self.__remove_row(row)
+            self.__changed.add(sender)
+
+        self.__stats = None
+
+    def uids_for(self, senders: typing.Iterable[str]) -> set[int]:
+        """
+        Returns the UIDs of every message from `senders`, matching addresses exactly.
+        """
+        uids = set()
+        for sender in senders:
+            uids.update(self.__senders.get(sender, ()))
+        return uids
+
+    def __contains__(self, sender: str) -> bool:
+        return sender in self.__senders
+
+    def stats(self) -> dict[str, Stats]:
+        """
+        Returns the message count, total size and oldest and newest message date of every sender.
+        The result is cached until the index next changes.
+        """
+        if self.__stats is None:
+            senders = len(self.__names)
+            counts = [0] * senders
+            sizes = [0] * senders
+            oldest = [0] * senders
+            newest = [0] * senders
+
+            for sender_id, size, date in zip(self.__sender_column, self.__size_column, self.__date_column):
+                if sender_id == _REMOVED:
+                    continue
+
+                if not counts[sender_id]:
+                    oldest[sender_id] = newest[sender_id] = date
+                elif date < oldest[sender_id]:
+                    oldest[sender_id] = date
+                elif date > newest[sender_id]:
+                    newest[sender_id] = date
+
+                counts[sender_id] += 1
+                sizes[sender_id] += size
+
+            self.__stats = {
+                self.__names[sender_id]: SenderIndex.Stats(counts[sender_id], sizes[sender_id], oldest[sender_id], newest[sender_id])
+                for sender_id in range(senders) if counts[sender_id] and self.__names[sender_id] != SenderIndex.UNKNOWN_SENDER
+            }
+
+        return self.__stats
+
+    def __find(self, uid: int) -> int | None:
+        # only the ordered rows are searched; update and the callers that may see rows added out of
+        # order normalize first
+        row = bisect.bisect_left(self.__uid_column, uid, 0, self.__sorted_rows)
+        if row < self.__sorted_rows and self.__uid_column[row] == uid and self.__sender_column[row] != _REMOVED:
+            return row
+        return None
+
+    def __drop_uid(self, sender: str, uid: int):
+        sender_uids = self.__senders.get(sender)
+        if sender_uids is None:
+            return
+
+        sender_uids.discard(uid)
+        if not sender_uids:
+            del self.__senders[sender]
+        self.__changed.add(sender)
+
+    def __remove_row(self, row: int):
+        self.__sender_column[row] = _REMOVED
+        self.__removed_rows += 1
+
+    def __normalize(self):
+        """
+        Orders every row by UID and, once enough have piled up, drops removed rows.
+        """
+        rows = len(self.__uid_column)
+        if self.__sorted_rows == rows and self.__removed_rows * 4 <= rows:
+            return
+
+        uid_column = self.__uid_column
+        sender_column = self.__sender_column
+        order = sorted(range(rows), key=uid_column.__getitem__)
+
+        columns = (array.array("L"), array.array("L"), array.array("Q"), array.array("q"))
+        for position, row in enumerate(order):
+            sender_id = sender_column[row]
+            if sender_id == _REMOVED:
+                continue
+
+            # the same UID added twice out of order: the later row wins
+            uid = uid_column[row]
+            following = order[position + 1] if position + 1 < rows else None
+            if following is not None and uid_column[following] == uid and sender_column[following] != _REMOVED:
+                if sender_column[following] != sender_id:
+                    self.__drop_uid(self.__names[sender_id], uid)
+                continue
+
+            columns[0].append(uid)
+            columns[1].append(sender_id)
+            columns[2].append(self.__size_column[row])
+            columns[3].append(self.__date_column[row])
+
+        self.__uid_column, self.__sender_column, self.__size_column, self.__date_column = columns
+        self.__sorted_rows = len(self.__uid_column)
+        self.__unsorted_uids = set()
+        self.__removed_rows = 0
+
+    def save(self, account: str):
+        """
+        Persists the index for `account`, writing only the senders that changed since it was loaded
+        or last saved.
+        """
+        self.__normalize()
+
+        changed = self.__senders.keys() if self.__replaced else self.__changed
+
+        values = {}
+        for sender in changed:
+            if sender not in self.__senders:
+                continue
+
+            rows = [self.__find(uid) for uid in sorted(self.__senders[sender])]
+            values[sender] = {
+                "uids": util.to_sequence_set(self.__uid_column[row] for row in rows),
+                "sizes": [self.__size_column[row] for row in rows],
+                "dates": [self.__date_column[row] for row in rows]
+            }
+
+        # Senders are written before the sync state: if the second write never happens, the next
+        # sync just rescans from the previous state, and rescanning a message is harmless.
+        persist.setitems(
+            SENDERS_KEY, account, values,
+            removed=[sender for sender in changed if sender not in self.__senders],
+            replace=self.__replaced
+        )
+        persist.setitems(STATE_KEY, account, {
+            "uidvalidity": self.__uidvalidity,
+            "highest_uid": self.__highest_uid,
+            "highestmodseq": self.__highestmodseq
+        }, replace=True)
+
+        self.__changed = set()
+        self.__replaced = False
+
+    @classmethod
+    def load(cls, account: str) -> SenderIndex:
+        """
+        Loads the index persisted for `account`, or returns an empty one if there is none or it is
+        malformed, in which case the next sync is a full one.
+        """
+        state = persist.getitems(STATE_KEY, account)
+        if not state:
+            return cls()
+
+        try:
+            messages = []
+            for sender, data in persist.getitems(SENDERS_KEY, account).items():
+                uids = util.parse_sequence_set(data["uids"])
+                if len(uids) != len(data["sizes"]) or len(uids) != len(data["dates"]):
+                    raise ValueError("Columns of '%s' differ in length." % sender)
+
+                messages.extend(map(SenderIndex.Message, uids, [sender] * len(uids), data["sizes"], data["dates"]))
+
+            messages.sort()
+            index = cls(state.get("uidvalidity"), int(state.get("highest_uid") or 0), state.get("highestmodseq"), messages)
+        except (KeyError, TypeError, ValueError):
+            return cls()
+
+        index.__changed = set()
+        index.__replaced = False
+        return index
+
+    @property
+    def uidvalidity(self) -> int | None:
+        return self.__uidvalidity
+
+    @property
+    def highest_uid(self) -> int:
+        return self.__highest_uid
+
+    @highest_uid.setter
+    def highest_uid(self, highest_uid: int):
+        self.__highest_uid = highest_uid
+
+    @property
+    def highestmodseq(self) -> int | None:
+        return self.__highestmodseq
+
+    @highestmodseq.setter
+    def highestmodseq(self, highestmodseq: int | None):
+        self.__highestmodseq = highestmodseq
+
+    @property
+    def message_count(self) -> int:
+        self.__normalize()
+        return len(self.__uid_column) - self.__removed_rows
+
+    @property
+    def senders(self) -> set[str]:
+        return set(self.__senders) - {SenderIndex.UNKNOWN_SENDER}
@@ -0,0 +1,125 @@
+from __future__ import annotations
+
+import concurrent.futures
+import contextlib
+import imaplib
+import logging
+import queue
+import threading
+import typing
+
+from .imap import GenericIMAP
+
+
+T = typing.TypeVar("T")
+R = typing.TypeVar("R")
+
+
+class ConnectionPool:
+    """
+    A set of authenticated sessions to the same account, each handed out to one thread at a time.
+    The client the pool is created from is its first session; the others are cloned from it and
+    authenticated the first time they are needed.
+    """
+
+    __client: GenericIMAP
+    __size: int
+    __opened: int
+    __idle: queue.Queue
+    __sessions: list[GenericIMAP]
+    __lock: threading.Lock
+
+    def __init__(self, client: GenericIMAP, size: int):
+        self.__client = client
+
+        # stay below the server's limit, so other clients (or a reconnect) still get a connection
+        self.__size = max(1, min(size, client.max_connections - 1))
+
+        self.__opened = 1
+        self.__idle = queue.Queue()
+        self.__idle.put(client)
+        self.__sessions = [client]
+        self.__lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def session(self) -> typing.Generator[GenericIMAP, None, None]:
+        try:
+            session = self.__idle.get_nowait()
+        except queue.Empty:
+            try:
+                session = self.__open()
+            except GenericIMAP.OperationError as err:
+                # the server may allow fewer connections than we asked for; make do with the ones we have
+                logging.warning(str(err))
+                session = None
+
+            if session is None:
+                session = self.__idle.get()
+
+        try:
+            yield session
+        finally:
+            self.__idle.put(session)
+
+    def __open(self) -> GenericIMAP | None:
+        with self.__lock:
+            if self.__opened >= self.__size:
+                return None
+            self.__opened += 1
+
+        try:
+            session = self.__client.clone()
+            session.authenticate()
+        except (imaplib.IMAP4.error, OSError, GenericIMAP.OperationError) as err:
+            with self.__lock:
+                self.__opened -= 1
+            raise GenericIMAP.OperationError("Could not open another connection: %s" % str(err))
+
+        with self.__lock:
+            self.__sessions.append(session)
+
+        return session
+
+    def map(self, fn: typing.Callable[[GenericIMAP, T], R], items: typing.Iterable[T]) -> typing.Iterator[R]:
+        """
+        Calls `fn(session, item)` for every item, spread across the pool's sessions, and yields
+        the results as they complete.
+        """
+        def run(item: T) -> R:
+            with self.session() as session:
+                return fn(session, item)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.__size) as executor:
+            futures = [executor.submit(run, item) for item in items]
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    yield future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def close(self):
+        """
+        Logs out every session except the client the pool was created from. The pool must not be
+        in use while closing.
+        """
+        with self.__lock:
+            sessions = self.__sessions[1:]
+            self.__sessions = self.__sessions[:1]
+            self.__opened = 1
+            self.__idle = queue.Queue()
+            self.__idle.put(self.__client)
+
+        for session in sessions:
+            try:
+                session.logout()
+            except (imaplib.IMAP4.error, OSError, GenericIMAP.StateError):
+                pass
+
+    @property
+    def size(self) -> int:
+        return self.__size
+
+    @property
+    def client(self) -> GenericIMAP:
+        return self.__client
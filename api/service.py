@@ -1,16 +1,95 @@
-import email
+import calendar
+import collections
+import datetime
 import imaplib
+import queue
 import re
+import threading
+import time
+import typing
 
-from .imap import GenericIMAP
+from .headers import parse_from_address
+from .imap import GenericIMAP, ProgressCallback
+from .index import SenderIndex
+from .pool import ConnectionPool
+import metrics
 import util
 
+if typing.TYPE_CHECKING:
+    from .aioimap import AsyncGenericIMAP
 
-def get_address_from_header(from_header: str) -> str:
-    if '<' in from_header:
-        return re.match(r"^.*?<(.+?)>$", from_header, re.DOTALL).group(1).strip()
-    else:
-        return from_header
+
+SendersCallback = typing.Callable[[list[str]], None]
+
+
+FETCH_UID_RE = re.compile(rb"\bUID (\d+)")
+FETCH_SIZE_RE = re.compile(rb"\bRFC822\.SIZE (\d+)")
+
+FETCH_INTERNALDATE_RE = re.compile(rb'INTERNALDATE "\s?(\d{1,2})-(\w{3})-(\d{4}) (\d\d):(\d\d):(\d\d) ([-+])(\d\d)(\d\d)"')
+
+MONTHS = {month.encode(): number for number, month in enumerate(calendar.month_abbr) if month}
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+# everything the sender index keeps about a message, fetched in a single pass
+FETCH_MESSAGE_ITEMS = "(UID RFC822.SIZE INTERNALDATE BODY.PEEK[HEADER.FIELDS (FROM)])"
+
+
+def parse_internaldate(metadata: bytes) -> int | None:
+    """
+    Returns the INTERNALDATE in a FETCH response as a Unix timestamp. This does the same as
+    imaplib.Internaldate2tuple without the round trip through local time, which adds up over a
+    whole mailbox.
+    """
+    match = FETCH_INTERNALDATE_RE.search(metadata)
+    if not match:
+        return None
+
+    day, month, year, hour, minute, second, sign, zone_hours, zone_minutes = match.groups()
+    try:
+        days = datetime.date(int(year), MONTHS[month.capitalize()], int(day)).toordinal() - EPOCH_ORDINAL
+    except (KeyError, ValueError):
+        return None
+
+    offset = int(zone_hours) * 3600 + int(zone_minutes) * 60
+    if sign == b"-":
+        offset = -offset
+
+    return days * 86400 + int(hour) * 3600 + int(minute) * 60 + int(second) - offset
+
+
+def split_fetch_response(response: list) -> typing.Generator[tuple[bytes, bytes | None], None, None]:
+    """
+    Groups an imaplib FETCH response into one (metadata, literal) pair per message. Servers are free
+    to order data items however they like, so items such as UID may come before or after the literal.
+    """
+    pending = None
+    for item in response:
+        if isinstance(item, tuple):
+            if pending:
+                yield pending
+            pending = (item[0], item[1])
+        elif isinstance(item, bytes):
+            if pending and not item[:1].isdigit():
+                yield pending[0] + item, pending[1]
+                pending = None
+            else:
+                if pending:
+                    yield pending
+                pending = (item, None)
+
+    if pending:
+        yield pending
+
+
+def response_size(response: list) -> int:
+    size = 0
+    for item in response:
+        if isinstance(item, tuple):
+            size += sum(len(part) for part in item)
+        elif isinstance(item, bytes):
+            size += len(item)
+
+    return size
 
 
 class CleanserService:
@@ -18,79 +97,494 @@ class CleanserService:
     
     __junk_folder: str | None
 
+    __connections: int
+    __pool: ConnectionPool | None
+
     class ServiceError(RuntimeError):
         """
         An error raised when service functions encounter errors.
         """
 
-    def __init__(self, client: GenericIMAP, junk_folder: str | None = None):
+    def __init__(self, client: GenericIMAP, junk_folder: str | None = None, connections: int = 1):
         self.__client = client
         self.__junk_folder = junk_folder
+        self.__connections = max(1, connections)
+        self.__pool = None
     
-    def get_unique_senders(self) -> set[str]:
-        client = self.__client
+    @metrics.timed("discovery")
+    def get_unique_senders(self, source_mailbox: str = 'Inbox') -> set[str]:
+        return set(self.iter_unique_senders(source_mailbox=source_mailbox))
+
+    def iter_unique_senders(self, source_mailbox: str = 'Inbox',
+                            chunk_sizer: util.ChunkSizer | None = None) -> typing.Generator[str, None, None]:
+        """
+        Yields every distinct sender in the mailbox exactly once, as soon as the chunk containing its
+        first message has been fetched.
+        """
+        seen = {SenderIndex.UNKNOWN_SENDER}
+        for chunk in self.iter_sender_chunks(source_mailbox=source_mailbox, chunk_sizer=chunk_sizer):
+            for message in chunk:
+                if message.sender not in seen:
+                    seen.add(message.sender)
+                    yield message.sender
+
+    @metrics.timed("discovery")
+    def sync_senders(self, index: SenderIndex, source_mailbox: str = 'Inbox',
+                     on_senders: SendersCallback | None = None, token: util.CancellationToken | None = None) -> SenderIndex:
+        """
+        Brings `index` up to date with the mailbox. Only messages above the highest UID already in the
+        index are fetched, unless the mailbox's UIDVALIDITY changed, in which case it is rebuilt.
+        Messages expunged since the last sync are dropped using QRESYNC when the server supports it,
+        or by comparing the message count otherwise.
+
+        `on_senders` is called with the senders new to the index after every chunk, so they can be
+        shown before the scan is done. If `token` is cancelled, the scan stops after the current
+        chunk, and the index is left in a state the next sync can resume from.
+        """
+        # QRESYNC has to be enabled before SELECT for the server to track VANISHED messages
+        qresync = self.__client.enable_extension("QRESYNC")
+
+        state = self.__client.select_mailbox(source_mailbox, readonly=True)
+        if not index.is_valid_for(state.uidvalidity):
+            index.reset(state.uidvalidity)
+        elif state.highestmodseq is not None and state.highestmodseq == index.highestmodseq:
+            # nothing was added, expunged or even flagged since the last sync
+            return index
+        elif qresync and index.highestmodseq is not None and state.highestmodseq is not None:
+            index.remove_uids(self.__client.fetch_vanished(index.highestmodseq, index.highest_uid))
+
+        synced_uid = index.highest_uid
+        try:
+            for chunk in self.iter_sender_chunks(source_mailbox, start_uid=synced_uid + 1, state=state):
+                if token:
+                    token.raise_if_cancelled()
+                self.__update_index(index, chunk, on_senders)
+        except BaseException:
+            # parallel chunks arrive out of order, so only what was synced before is known to be complete
+            index.highest_uid = synced_uid
+            raise
+
+        # everything below UIDNEXT has been scanned, even UIDs that belonged to no message
+        index.highest_uid = max(index.highest_uid, state.uidnext - 1)
+
+        if index.message_count != state.exists:
+            # Either the server can't report expunged messages, or something changed while syncing.
+            # Listing the UIDs is still much cheaper than fetching every header again.
+            index.retain_uids(self.__search_uids("ALL"))
+
+        index.highestmodseq = state.highestmodseq
+        return index
+
+    @staticmethod
+    def __update_index(index: SenderIndex, chunk: list[SenderIndex.Message], on_senders: SendersCallback | None):
+        if on_senders is None:
+            index.update(chunk)
+            return
 
-        client.imap.select()
-        status, response = client.imap.search(None, "ALL")
+        new_senders = list({
+            message.sender for message in chunk
+            if message.sender not in index and message.sender != SenderIndex.UNKNOWN_SENDER
+        })
+        index.update(chunk)
+        if new_senders:
+            on_senders(new_senders)
+
+    def __search_uids(self, *criteria: str, client: GenericIMAP | None = None) -> list[int]:
+        client = client or self.__client
+        try:
+            status, response = client.run_reconnecting(lambda: client.imap.uid("SEARCH", *criteria))
+        except imaplib.IMAP4.error as err:
+            raise CleanserService.ServiceError("Search returned error: %s" % str(err))
 
         if status != "OK":
-            raise CleanserService.ServiceError("Failed to fetch message list.")
+            raise CleanserService.ServiceError("Search returned non-OK status: %s" % status)
+
+        return [int(uid) for uid in b" ".join(item for item in response if item).split()]
+
+    def iter_sender_chunks(self, source_mailbox: str = 'Inbox', start_uid: int = 1,
+                           chunk_sizer: util.ChunkSizer | None = None,
+                           state: GenericIMAP.MailboxState | None = None) -> typing.Generator[list[SenderIndex.Message], None, None]:
+        """
+        Fetches the sender, size and date of every message in UID-range chunks, yielding a list of
+        messages per chunk. Only a few chunks are held in memory at a time, and the chunk size adapts
+        to the observed round-trip time and bytes per message. With more than one connection, chunks
+        are fetched in parallel and may arrive out of order. Messages whose sender can't be parsed
+        are yielded with SenderIndex.UNKNOWN_SENDER. `state` may be passed if the mailbox has just
+        been selected.
+        """
+        if state is None or state.mailbox != source_mailbox:
+            state = self.__client.select_mailbox(source_mailbox, readonly=True)
+
+        sizer = chunk_sizer or util.ChunkSizer()
+
+        def uid_ranges():
+            low = max(start_uid, 1)
+            while low < state.uidnext:
+                high = min(low + sizer.size - 1, state.uidnext - 1)
+                yield low, high
+                low = high + 1
+
+        if self.__parallel:
+            yield from self.__parallel_sender_chunks(source_mailbox, state, uid_ranges(), sizer)
+        else:
+            for low, high in uid_ranges():
+                yield self.__fetch_sender_chunk(self.__client, low, high, sizer)
+
+    def __parallel_sender_chunks(self, source_mailbox: str, state: GenericIMAP.MailboxState,
+                                 uid_ranges: typing.Iterator[tuple[int, int]],
+                                 sizer: util.ChunkSizer) -> typing.Generator[list[SenderIndex.Message], None, None]:
+        pool = self.pool
+        results = queue.Queue(maxsize=pool.size * 2)  # bounds memory if the consumer is slower than the network
+        ranges_lock = threading.Lock()
+        stop = threading.Event()
+        failed = threading.Event()  # set by the first session to fail, so that the others stop claiming ranges
+        finished = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    results.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def scan(session: GenericIMAP, _):
+            try:
+                session_state = session.select_mailbox(source_mailbox, readonly=True)
+                if session_state.uidvalidity != state.uidvalidity:
+                    raise CleanserService.ServiceError("UIDVALIDITY of '%s' changed while scanning." % source_mailbox)
+
+                while not stop.is_set() and not failed.is_set():
+                    with ranges_lock:
+                        claimed = next(uid_ranges, None)
+
+                    if claimed is None:
+                        return
 
-        response = b",".join(response[0].split(b" "))
+                    put(self.__fetch_sender_chunk(session, claimed[0], claimed[1], sizer))
+            except BaseException:
+                failed.set()
+                raise
 
-        status, response = client.imap.fetch(response, "(BODY.PEEK[HEADER.FIELDS (FROM)])")
+        def run():
+            try:
+                for _ in pool.map(scan, range(pool.size)):
+                    pass
+            except Exception as exc:
+                put(exc)
+            else:
+                put(finished)
+
+        worker = threading.Thread(target=run, daemon=True)
+        worker.start()
+
+        try:
+            while True:
+                item = results.get()
+                if item is finished:
+                    return
+                elif isinstance(item, Exception):
+                    raise item
+
+                yield item
+        finally:
+            stop.set()
+            worker.join()
+
+    def __fetch_sender_chunk(self, client: GenericIMAP, low: int, high: int, sizer: util.ChunkSizer) -> list[SenderIndex.Message]:
+        def fetch():
+            # timed per attempt, so that reconnecting doesn't shrink the chunks that follow
+            started = time.monotonic()
+            status, response = client.imap.uid("FETCH", "%d:%d" % (low, high), FETCH_MESSAGE_ITEMS)
+            return status, response, time.monotonic() - started
+
+        try:
+            status, response, elapsed = client.run_reconnecting(fetch)
+        except imaplib.IMAP4.error as err:
+            raise CleanserService.ServiceError("Failed to fetch headers: %s" % str(err))
 
         if status != "OK":
             raise CleanserService.ServiceError("Failed to fetch headers.")
 
-        unique_senders = set()
+        sizer.observe(high - low + 1, response_size(response), elapsed)
+        return self.__parse_messages(response)
 
-        header_parser = email.parser.HeaderParser()
-        for item in response:
-            if isinstance(item, tuple):
-                parsed = header_parser.parsestr(item[1].decode('utf-8'))
-                unique_senders.add(get_address_from_header(parsed.get("From")))
-        
-        return unique_senders
+    @staticmethod
+    @metrics.timed("parse")
+    def __parse_messages(response: list) -> list[SenderIndex.Message]:
+        messages = []
 
-    def find_emails_to_cleanse(self, senders: set[str], source_mailbox: str = 'Inbox') -> set[int]:
-        self.__client.imap.select(source_mailbox)
+        for metadata, literal in split_fetch_response(response):
+            match = FETCH_UID_RE.search(metadata)
+            if not match or literal is None:
+                continue
 
-        email_ids = set()
+            # kept even without a sender, or the index would never match the mailbox's message count
+            size = FETCH_SIZE_RE.search(metadata)
+            messages.append(SenderIndex.Message(
+                int(match.group(1)),
+                parse_from_address(literal) or SenderIndex.UNKNOWN_SENDER,
+                int(size.group(1)) if size else 0,
+                parse_internaldate(metadata) or 0
+            ))
+
+        return messages
+
+    @metrics.timed("search")
+    def find_emails_to_cleanse(self, senders: set[str], source_mailbox: str = 'Inbox',
+                               index: SenderIndex | None = None, token: util.CancellationToken | None = None) -> set[int]:
+        """
+        Returns the UIDs of every message from `senders`. Unlike sequence numbers, UIDs stay valid
+        when other messages are expunged, so the result can be kept around and acted on later.
+
+        Given the mailbox's sender index, it is synced and the UIDs are looked up locally, which
+        skips the searches and only matches the exact addresses. Without one, the server is
+        searched, and FROM matches any address containing a sender's.
+        """
+        if index is not None:
+            return self.sync_senders(index, source_mailbox, token=token).uids_for(senders)
 
         # Servers don't seem to like extremely large search queries, so we'll break down large groups of
         # senders into smaller batches.
-        for sender_batch in util.produce_batches(senders, 25):
-            clauses = ["OR" for _ in range(max(0, len(sender_batch) - 1))]
+        batches = [self.__sender_clauses(batch) for batch in util.produce_batches(senders, 25)]
 
-            for sender in sender_batch:
-                clauses.append("FROM \"%s\"" % sender)
+        email_ids = set()
 
-            try:
-                status, response = self.__client.imap.search(None, *clauses)
-            except imaplib.IMAP4.error as err:
-                raise CleanserService.ServiceError("Search returned error: %s" % str(err))
+        if self.__parallel and len(batches) > 1:
+            selected = set()
+
+            def search(session: GenericIMAP, clauses: list[str]) -> list[int]:
+                if token:
+                    token.raise_if_cancelled()
+
+                if session not in selected:
+                    session.run_reconnecting(lambda: session.imap.select(source_mailbox))
+                    selected.add(session)
+
+                return self.__search_uids(*clauses, client=session)
 
-            if status != "OK":
-                raise CleanserService.ServiceError("Search returned non-OK status: %s" % status)
+            for uids in self.pool.map(search, batches):
+                email_ids.update(uids)
+        else:
+            self.__client.run_reconnecting(lambda: self.__client.imap.select(source_mailbox))
 
-            email_ids |= {int(uid) for uid in response[0].decode('utf-8').split(' ')}
+            for clauses in batches:
+                if token:
+                    token.raise_if_cancelled()
+                email_ids.update(self.__search_uids(*clauses))
         
         return email_ids
+
+    @staticmethod
+    def __sender_clauses(senders: list[str]) -> list[str]:
+        clauses = ["OR" for _ in range(max(0, len(senders) - 1))]
+
+        for sender in senders:
+            clauses.append("FROM \"%s\"" % sender)
+
+        return clauses
     
-    def cleanse_emails(self, uids: set[int], source_mailbox: str = 'Inbox'):
+    @metrics.timed("move")
+    def cleanse_emails(self, uids: set[int], source_mailbox: str = 'Inbox', progress: ProgressCallback | None = None,
+                       token: util.CancellationToken | None = None):
+        """
+        Moves the messages to the junk folder, or deletes them if there is none, in as many commands
+        as it takes to keep each one short. `progress` is called with the number of messages done
+        so far and the total after every command. If `token` is cancelled, this stops between commands.
+        """
         if self.__junk_folder:
             folder_exists = self.__client.check_folder(self.__junk_folder)
             if not folder_exists:
                 raise GenericIMAP.OperationError("Folder '%s' does not exist" % self.__junk_folder)
             
-            self.__client.move(uids, self.__junk_folder, source_mailbox=source_mailbox)
+            self.__client.move(uids, self.__junk_folder, source_mailbox=source_mailbox, progress=progress, token=token)
         else:
-            self.__client.delete_messages(uids, source_mailbox=source_mailbox)
+            self.__client.delete_messages(uids, source_mailbox=source_mailbox, progress=progress, token=token)
+
+    # Async variants of the scan, search and purge, run by benchmarks.service with --backend async.
+    # These need a client on the asyncio backend and must run on its event loop, e.g. through
+    # AsyncGenericIMAP.run. Steps that take a single round trip reuse the synchronous
+    # code from a worker thread; the bulk FETCH, SEARCH and MOVE traffic is pipelined instead.
+    # asyncio and the backend are only imported here, so that the app doesn't load them on startup.
+
+    async def iter_sender_chunks_async(self, source_mailbox: str = 'Inbox', start_uid: int = 1,
+                                       chunk_sizer: util.ChunkSizer | None = None,
+                                       state: GenericIMAP.MailboxState | None = None,
+                                       depth: int = 4) -> typing.AsyncGenerator[list[SenderIndex.Message], None]:
+        """
+        Like iter_sender_chunks, but keeps up to `depth` FETCH commands in flight on the one
+        connection, so each chunk doesn't cost a full round trip.
+        """
+        import asyncio
+
+        client = self.__async_client()
+        if state is None or state.mailbox != source_mailbox:
+            state = await asyncio.to_thread(client.select_mailbox, source_mailbox, True)
+
+        sizer = chunk_sizer or util.ChunkSizer()
+        in_flight = collections.deque()
+        last_completed = time.monotonic()
+
+        low = max(start_uid, 1)
+        while low < state.uidnext or in_flight:
+            while low < state.uidnext and len(in_flight) < depth:
+                high = min(low + sizer.size - 1, state.uidnext - 1)
+                fetch = client.connection.command("UID", "FETCH", "%d:%d" % (low, high), FETCH_MESSAGE_ITEMS)
+                in_flight.append((high - low + 1, time.monotonic(), asyncio.ensure_future(fetch)))
+                low = high + 1
+
+            count, started, pending = in_flight.popleft()
+            try:
+                response = await pending
+            except imaplib.IMAP4.error as err:
+                for _, _, other in in_flight:
+                    other.cancel()
+                raise CleanserService.ServiceError("Failed to fetch headers: %s" % str(err))
+
+            if response.status != "OK":
+                raise CleanserService.ServiceError("Failed to fetch headers.")
+
+            # with pipelining, a response's latency overlaps the ones before it; only the time since
+            # the previous one completed says anything about this chunk's size
+            now = time.monotonic()
+            fetched = response.untagged.get("FETCH", [])
+            sizer.observe(count, response_size(fetched), now - max(started, last_completed))
+            last_completed = now
+
+            yield self.__parse_messages(fetched)
+
+    @metrics.timed("search")
+    async def find_emails_to_cleanse_async(self, senders: set[str], source_mailbox: str = 'Inbox',
+                                           depth: int = 8) -> set[int]:
+        """
+        Like find_emails_to_cleanse without an index, with up to `depth` sender batches searched at
+        once.
+        """
+        import asyncio
+
+        client = self.__async_client()
+        await asyncio.to_thread(client.imap.select, source_mailbox)
+
+        async def search(clauses: list[str]) -> list[int]:
+            async with window:
+                try:
+                    response = await client.connection.command("UID", "SEARCH", *clauses)
+                except imaplib.IMAP4.error as err:
+                    raise CleanserService.ServiceError("Search returned error: %s" % str(err))
+
+            if response.status != "OK":
+                raise CleanserService.ServiceError("Search returned non-OK status: %s" % response.status)
+
+            return [int(uid) for uid in b" ".join(item for item in response.pop("SEARCH") if item).split()]
+
+        window = asyncio.Semaphore(depth)
+        results = await asyncio.gather(*(
+            search(self.__sender_clauses(batch)) for batch in util.produce_batches(senders, 25)
+        ))
+
+        return {uid for uids in results for uid in uids}
+
+    @metrics.timed("move")
+    async def cleanse_emails_async(self, uids: set[int], source_mailbox: str = 'Inbox',
+                                   progress: ProgressCallback | None = None, depth: int = 4):
+        """
+        Like cleanse_emails, with up to `depth` chunks being moved or deleted at once.
+        """
+        import asyncio
+
+        client = self.__async_client()
+
+        target = self.__junk_folder
+        if target and not await asyncio.to_thread(client.check_folder, target):
+            raise GenericIMAP.OperationError("Folder '%s' does not exist" % target)
+
+        await asyncio.to_thread(client.imap.select, source_mailbox)
+
+        use_move = target and client.has_capability("MOVE")
+        expunge = ("UID", "EXPUNGE") if client.has_capability("UIDPLUS") else ("EXPUNGE",)
+        budget = max(client.max_command_bytes - len(target or "") - 64, 64)
+
+        async def run(*commands: tuple[str, ...]):
+            # the server runs pipelined commands in order, so these only cost one round trip
+            responses = await asyncio.gather(*(client.connection.command(*command) for command in commands))
+            for command, response in zip(commands, responses):
+                if response.status != "OK":
+                    raise GenericIMAP.OperationError("%s failed: %r" % (" ".join(command[:2]), response.text))
+
+        async def process(message_set: str):
+            async with window:
+                if use_move:
+                    await run(("UID", "MOVE", message_set, target))
+                    return
+
+                if target:
+                    # never flag messages as deleted before knowing they were copied
+                    await run(("UID", "COPY", message_set, target))
+
+                await run(
+                    ("UID", "STORE", message_set, "+FLAGS.SILENT", "\\Deleted"),
+                    expunge + ((message_set,) if len(expunge) == 2 else ())
+                )
+
+        window = asyncio.Semaphore(depth)
+        chunks = list(util.split_sequence_set(uids, budget))
+        tasks = [asyncio.ensure_future(process(message_set)) for message_set, _ in chunks]
+
+        done = 0
+        total = len(uids)
+        try:
+            for task, (_, count) in zip(tasks, chunks):
+                try:
+                    await task
+                except imaplib.IMAP4.error as err:
+                    raise GenericIMAP.OperationError("Purge failed: IMAP error. Message: " + str(err))
+
+                done += count
+                if progress:
+                    progress(done, total)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def __async_client(self) -> "AsyncGenericIMAP":
+        from .aioimap import AsyncGenericIMAP
+
+        if not isinstance(self.__client, AsyncGenericIMAP):
+            raise CleanserService.ServiceError("Async methods need a client on the asyncio backend.")
+
+        return self.__client
+
+    def close(self):
+        """
+        Logs out of any extra connections opened for parallel operations.
+        """
+        if self.__pool:
+            self.__pool.close()
+            self.__pool = None
 
     @property
     def imap(self) -> GenericIMAP:
         return self.__client
+
+    @property
+    def pool(self) -> ConnectionPool:
+        if self.__pool is None:
+            self.__pool = ConnectionPool(self.__client, self.__connections)
+
+        return self.__pool
+
+    @property
+    def __parallel(self) -> bool:
+        return self.__connections > 1 and self.pool.size > 1
+
+    @property
+    def connections(self) -> int:
+        return self.__connections
+
+    @connections.setter
+    def connections(self, connections: int):
+        self.close()
+        self.__connections = max(1, connections)
     
     @property
     def junk_folder(self) -> str | None:
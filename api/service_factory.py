@@ -39,7 +39,12 @@ def create_service_versioned(data: dict[str, typing.Any], debug: bool = False):
             warnings.warn("No IMAP class specified. Account data: %s" % str(data))
             return None
 
-        imap_class = service.GenericIMAP[imap_class_name]
+        try:
+            imap_class = service.GenericIMAP[imap_class_name]
+        except KeyError:
+            # the asyncio backend's classes are only registered once it's imported
+            from . import aioimap
+            imap_class = service.GenericIMAP[imap_class_name]
     except KeyError as ke:
         warnings.warn("Service configuration file exists, but references unknown IMAP service %s" % str(ke))
         return None
@@ -84,6 +89,18 @@ def create_service(service_config: dict[str, typing.Any], debug: bool = False) -
         return None
 
 
+def load_service_config() -> dict[str, typing.Any] | None:
+    try:
+        with open(SERVICE_CONFIG_FILE, "r") as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        warnings.warn("Service configuration file does not exist.")
+    except json.decoder.JSONDecodeError:
+        warnings.warn("Service configuration file exists, but is not valid JSON.")
+
+    return None
+
+
 def save_service_config(data: dict[str, typing.Any]):
     with open(SERVICE_CONFIG_FILE, "w") as fp:
         json.dump(data, fp)
@@ -0,0 +1,124 @@
+"""
+Measures how fast From headers are parsed, comparing api.headers with the email.parser based path
+it replaced. Run from the project root:
+
+    python -m benchmarks.headers [--count N]
+"""
+
+import argparse
+import email.parser
+import random
+import re
+import time
+
+from api.headers import parse_from_address
+
+
+# the shapes of From field seen in real mailboxes, roughly in proportion
+SAMPLES = [
+    b"From: %(name)s <%(address)s>\r\n\r\n",
+    b"From: %(name)s <%(address)s>\r\n\r\n",
+    b"From: \"%(name)s, Jr.\" <%(address)s>\r\n\r\n",
+    b"From: %(address)s\r\n\r\n",
+    b"From: =?UTF-8?B?w4Ryc3RpIE3DvGxsZXI=?= <%(address)s>\r\n\r\n",
+    b"From: =?iso-8859-1?Q?J=F6rg_%(name)s?= <%(address)s>\r\n\r\n",
+    b"From: %(name)s\r\n <%(address)s>\r\n\r\n",
+    b"From: \"Caf\xe9 %(name)s\" <%(address)s>\r\n\r\n",
+]
+
+NAMES = [b"Alice Example", b"Newsletter", b"Bob", b"Support Team", b"No Reply"]
+
+# fields the fast paths must leave to the general one, with the address it should find
+EDGE_CASES = [
+    (b"From: =?utf-8?q?a=40b.com?=\r\n", "a@b.com"),
+    (b"From: =?utf-8?b?YUBiLmNvbQ==?=\r\n\r\n", "a@b.com"),
+    (b"From: bounce+sender=example.com@lists.example.org\r\n\r\n", "bounce+sender=example.com@lists.example.org"),
+    (b"From: Alice <alice@example.com>\r\n (Example)\r\n\r\n", "alice@example.com"),
+    (b"from: \"Doe, Jane\" <jane@example.com>\r\n\r\n", "jane@example.com"),
+    (b"Subject: hello\r\nFrom: Bob <bob@example.com>\r\n\r\n", "bob@example.com"),
+]
+
+# the previous path shared one parser across a whole FETCH response
+_header_parser = email.parser.HeaderParser()
+
+
+def legacy_parse_from_address(header_block: bytes) -> str | None:
+    """
+    The previous path: a message object per header block and an uncompiled regex per address.
+    """
+    from_header = _header_parser.parsestr(header_block.decode("utf-8")).get("From")
+    if not from_header:
+        return None
+
+    if '<' in from_header:
+        return re.match(r"^.*?<(.+?)>$", from_header, re.DOTALL).group(1).strip()
+    else:
+        return from_header
+
+
+def make_headers(count: int, utf8_only: bool) -> list[bytes]:
+    generator = random.Random(0)
+    samples = [sample for sample in SAMPLES if not utf8_only or _is_utf8(sample)]
+
+    headers = []
+    for number in range(count):
+        headers.append(generator.choice(samples) % {
+            b"name": generator.choice(NAMES),
+            b"address": b"sender%d@example%d.com" % (number % 5000, number % 50)
+        })
+
+    return headers
+
+
+def _is_utf8(data: bytes) -> bool:
+    try:
+        data.decode("utf-8")
+        return True
+    except UnicodeDecodeError:
+        return False
+
+
+def measure(parsers: list, headers: list[bytes], repeat: int) -> list[float]:
+    """
+    Returns each parser's best rate of `repeat` runs, the one least disturbed by whatever else the
+    machine was doing. The parsers take turns, so that they are compared under the same conditions.
+    """
+    best = [float("inf")] * len(parsers)
+    for _ in range(repeat):
+        for number, parse in enumerate(parsers):
+            started = time.perf_counter()
+            for header in headers:
+                parse(header)
+            best[number] = min(best[number], time.perf_counter() - started)
+
+    return [len(headers) / seconds for seconds in best]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks From header parsing.")
+    parser.add_argument("--count", type=int, default=100000, help="number of header blocks to parse")
+    parser.add_argument("--repeat", type=int, default=7, help="number of runs to take the best of")
+    args = parser.parse_args()
+
+    # the previous path raises on headers that aren't UTF-8, so it is only given those that are
+    headers = make_headers(args.count, utf8_only=True)
+
+    mismatches = sum(1 for header in headers if parse_from_address(header) != legacy_parse_from_address(header))
+    if mismatches:
+        print("warning: %d of %d headers parsed differently" % (mismatches, len(headers)))
+
+    for header, expected in EDGE_CASES:
+        address = parse_from_address(header)
+        if address != expected:
+            print("warning: %r parsed as %r instead of %r" % (header, address, expected))
+
+    legacy_rate, rate = measure([legacy_parse_from_address, parse_from_address], headers, args.repeat)
+    mixed_rate, = measure([parse_from_address], make_headers(args.count, utf8_only=False), args.repeat)
+
+    print("email.parser:        %10.0f headers/s" % legacy_rate)
+    print("api.headers:         %10.0f headers/s (%.1fx)" % (rate, rate / legacy_rate))
+    print("api.headers, Latin-1: %9.0f headers/s (the previous path fails on these)" % mixed_rate)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,900 @@
+"""
+A small IMAP4rev1 server that serves synthetic mailboxes, for benchmarking without a live account.
+
+It implements the subset of IMAP4rev1 that purgetool uses, along with CONDSTORE/QRESYNC, MOVE,
+UIDPLUS and ENABLE, over plain TCP or TLS with a throwaway self-signed certificate, and can inject a
+fixed network latency into every response. Run it to serve a mailbox on the command line:
+
+    python -m benchmarks.imapserver --messages 100000 --latency 0.02
+
+or use FakeIMAPServer, or ServerProcess to keep it out of the measured process, from a benchmark.
+"""
+from __future__ import annotations
+
+import argparse
+import array
+import asyncio
+import base64
+import bisect
+import collections
+import datetime
+import multiprocessing
+import multiprocessing.connection
+import os
+import random
+import re
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import typing
+
+
+DEFAULT_CAPABILITIES = ("IMAP4rev1", "ENABLE", "CONDSTORE", "QRESYNC", "MOVE", "UIDPLUS", "AUTH=PLAIN", "AUTH=XOAUTH2")
+
+FIRST_NAMES = ["Alice", "Bob", "Carol", "Dave", "Erin", "Frank", "Grace", "Heidi", "Ivan", "Judy", "Mallory", "Zoë", "José"]
+DOMAINS = ["example.com", "example.org", "mail.example.net", "news.example.com", "shop.example.co.uk"]
+
+
+class SyntheticMailbox:
+    """
+    A mailbox whose messages are stored column-wise, so that a million of them fit comfortably in
+    memory. Senders are drawn from a Zipf distribution, so a few senders account for most messages.
+    """
+
+    def __init__(self, name: str, uidvalidity: int = 1):
+        self.name = name
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.highestmodseq = 1
+
+        self.uids = array.array("Q")
+        self.senders = array.array("I")
+        self.sizes = array.array("I")
+        self.dates = array.array("d")
+        self.modseqs = array.array("Q")
+        self.deleted = bytearray()
+
+        # (modseq, uid) of every expunged message, for VANISHED (EARLIER)
+        self.expunged: list[tuple[int, int]] = []
+
+    def append(self, sender: int, size: int, date: float, uid: int | None = None) -> int:
+        uid = uid if uid is not None else self.uidnext
+        self.uidnext = max(self.uidnext, uid + 1)
+        self.highestmodseq += 1
+
+        self.uids.append(uid)
+        self.senders.append(sender)
+        self.sizes.append(size)
+        self.dates.append(date)
+        self.modseqs.append(self.highestmodseq)
+        self.deleted.append(0)
+        return uid
+
+    def index_of(self, uid: int) -> int | None:
+        position = bisect.bisect_left(self.uids, uid)
+        if position < len(self.uids) and self.uids[position] == uid:
+            return position
+
+        return None
+
+    def expunge(self, positions: typing.Iterable[int]) -> list[int]:
+        """
+        Removes the messages at `positions` and returns their UIDs, in ascending order.
+        """
+        doomed = set(positions)
+        if not doomed:
+            return []
+
+        self.highestmodseq += 1
+        removed = [self.uids[position] for position in sorted(doomed)]
+        self.expunged.extend((self.highestmodseq, uid) for uid in removed)
+
+        # the runs between removed messages are copied whole, which keeps this fast on large mailboxes
+        ordered = sorted(doomed)
+        starts = [0] + [position + 1 for position in ordered]
+        ends = ordered + [len(self.uids)]
+        for column in ("uids", "senders", "sizes", "dates", "modseqs", "deleted"):
+            values = getattr(self, column)
+            kept = array.array(values.typecode) if isinstance(values, array.array) else bytearray()
+            for start, end in zip(starts, ends):
+                kept += values[start:end]
+            setattr(self, column, kept)
+
+        return removed
+
+    def __len__(self) -> int:
+        return len(self.uids)
+
+
+class SyntheticAccount:
+    def __init__(self, messages: int = 1000, senders: int = 100, skew: float = 1.1, seed: int = 0,
+                 uid_gap: int = 0, mailboxes: typing.Iterable[str] = ("INBOX", "Junk")):
+        self.rng = random.Random(seed)
+        self.sender_headers = [self.__make_sender(index) for index in range(senders)]
+
+        self.mailboxes: dict[str, SyntheticMailbox] = {}
+        for offset, name in enumerate(mailboxes):
+            self.mailboxes[name] = SyntheticMailbox(name, uidvalidity=1000 + offset)
+
+        weights = [1.0 / (rank ** skew) for rank in range(1, senders + 1)]
+        chosen = self.rng.choices(range(senders), weights=weights, k=messages)
+
+        inbox = self.mailboxes["INBOX"]
+        now = time.time()
+        uid = 0
+        for sender in chosen:
+            uid += 1 + (self.rng.randint(0, uid_gap) if uid_gap else 0)
+            inbox.append(sender, self.rng.randint(2_000, 200_000), now - self.rng.random() * 5 * 365 * 86400, uid=uid)
+
+    def __make_sender(self, index: int) -> bytes:
+        name = self.rng.choice(FIRST_NAMES)
+        address = "%s%d@%s" % (name.lower().encode("ascii", "ignore").decode() or "user", index, self.rng.choice(DOMAINS))
+
+        style = index % 5
+        if style == 0:
+            header = address
+        elif style == 1:
+            header = "%s <%s>" % (name, address)
+        elif style == 2:
+            header = "\"%s, Newsletter\" <%s>" % (name, address)
+        elif style == 3:
+            encoded = base64.b64encode(("%s Ünïcode" % name).encode("utf-8")).decode("ascii")
+            header = "=?UTF-8?B?%s?=\r\n <%s>" % (encoded, address)
+        else:
+            return ("From: %s Latin <%s>\r\n" % (name, address)).encode("latin-1", "replace")
+
+        return ("From: %s\r\n" % header).encode("utf-8")
+
+    def mailbox(self, name: str) -> SyntheticMailbox | None:
+        if name.upper() == "INBOX":
+            return self.mailboxes.get("INBOX")
+
+        return self.mailboxes.get(name)
+
+
+class ServerStats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.connections = 0
+        self.commands = collections.Counter()
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+    def as_dict(self) -> dict[str, typing.Any]:
+        return {
+            "connections": self.connections,
+            "commands": dict(self.commands),
+            "round_trips": sum(self.commands.values()),
+            "bytes_received": self.bytes_received,
+            "bytes_sent": self.bytes_sent
+        }
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def tokenize(line: bytes) -> list[typing.Any]:
+    """
+    Splits a command line into atoms, quoted strings and (nested) parenthesized lists. Section
+    specifiers such as BODY.PEEK[HEADER.FIELDS (FROM)] are kept as a single atom.
+    """
+    stack: list[list[typing.Any]] = [[]]
+    position = 0
+    length = len(line)
+
+    while position < length:
+        char = line[position:position + 1]
+        if char == b" ":
+            position += 1
+        elif char == b"(":
+            stack.append([])
+            position += 1
+        elif char == b")":
+            if len(stack) == 1:
+                raise ProtocolError("Unbalanced parentheses")
+            closed = stack.pop()
+            stack[-1].append(closed)
+            position += 1
+        elif char == b"\"":
+            value = bytearray()
+            position += 1
+            while position < length and line[position:position + 1] != b"\"":
+                if line[position:position + 1] == b"\\":
+                    position += 1
+                value += line[position:position + 1]
+                position += 1
+            position += 1
+            stack[-1].append(bytes(value).decode("utf-8", "replace"))
+        else:
+            start = position
+            depth = 0
+            while position < length:
+                char = line[position:position + 1]
+                if char == b"[":
+                    depth += 1
+                elif char == b"]":
+                    depth -= 1
+                elif depth == 0 and char in (b" ", b"(", b")"):
+                    break
+                position += 1
+            stack[-1].append(line[start:position].decode("utf-8", "replace"))
+
+    if len(stack) != 1:
+        raise ProtocolError("Unbalanced parentheses")
+
+    return stack[0]
+
+
+def parse_set(value: str, largest: int) -> typing.Callable[[int], bool]:
+    ranges = []
+    for part in value.split(","):
+        bounds = [largest if bound == "*" else int(bound) for bound in part.split(":")]
+        low, high = min(bounds), max(bounds)
+        ranges.append((low, high))
+
+    return lambda number: any(low <= number <= high for low, high in ranges)
+
+
+def iter_set(value: str, largest: int) -> typing.Generator[tuple[int, int], None, None]:
+    for part in value.split(","):
+        bounds = [largest if bound == "*" else int(bound) for bound in part.split(":")]
+        yield min(bounds), max(bounds)
+
+
+def format_set(numbers: typing.Iterable[int]) -> str:
+    ranges = []
+    start = end = None
+    for number in sorted(numbers):
+        if end is not None and number == end + 1:
+            end = number
+            continue
+        if start is not None:
+            ranges.append(str(start) if start == end else "%d:%d" % (start, end))
+        start = end = number
+    if start is not None:
+        ranges.append(str(start) if start == end else "%d:%d" % (start, end))
+
+    return ",".join(ranges)
+
+
+class Session:
+    def __init__(self, server: FakeIMAPServer, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.server = server
+        self.account = server.account
+        self.reader = reader
+        self.writer = writer
+
+        self.authenticated = False
+        self.selected: SyntheticMailbox | None = None
+        self.readonly = False
+        self.enabled: set[str] = set()
+
+        self.__outgoing: asyncio.Queue = asyncio.Queue()
+        self.__sender = asyncio.ensure_future(self.__send_loop())
+
+    async def __send_loop(self):
+        while True:
+            due, data = await self.__outgoing.get()
+            if data is None:
+                return
+
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            self.writer.write(data)
+            self.server.stats.bytes_sent += len(data)
+            await self.writer.drain()
+
+    def send(self, data: bytes):
+        # Responses are delayed by the configured latency without holding up the next command, so
+        # pipelined commands overlap their round trips just like they would over a real link.
+        self.__outgoing.put_nowait((time.monotonic() + self.server.latency, data))
+
+    async def run(self):
+        self.send(b"* OK [CAPABILITY %s] fake IMAP server ready\r\n" % self.capability_string())
+
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+
+                self.server.stats.bytes_received += len(line)
+                line = line.rstrip(b"\r\n")
+                if not line:
+                    continue
+
+                if len(line) > self.server.max_line:
+                    self.send(b"* BAD Command line too long\r\n")
+                    continue
+
+                if not await self.handle(line):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            await self.__outgoing.put((0, None))
+            try:
+                await self.__sender
+                self.writer.close()
+            except ConnectionError:
+                pass
+
+    def capability_string(self) -> bytes:
+        return " ".join(self.server.capabilities).encode("ascii")
+
+    async def handle(self, line: bytes) -> bool:
+        tag, _, rest = line.partition(b" ")
+        tag = tag.decode("ascii", "replace")
+        try:
+            tokens = tokenize(rest)
+        except ProtocolError as err:
+            self.send(b"%s BAD %s\r\n" % (tag.encode(), str(err).encode()))
+            return True
+
+        if not tokens:
+            self.send(b"%s BAD Empty command\r\n" % tag.encode())
+            return True
+
+        command = str(tokens[0]).upper()
+        args = tokens[1:]
+        uid = False
+        if command == "UID" and args:
+            uid = True
+            command = str(args[0]).upper()
+            args = args[1:]
+
+        self.server.stats.commands[("UID " if uid else "") + command] += 1
+
+        handler = getattr(self, "cmd_" + command.lower(), None)
+        if handler is None:
+            self.send(b"%s BAD Unknown command %s\r\n" % (tag.encode(), command.encode()))
+            return True
+
+        needs_auth = command not in ("CAPABILITY", "LOGIN", "AUTHENTICATE", "LOGOUT", "NOOP")
+        if needs_auth and not self.authenticated:
+            self.send(b"%s NO Not authenticated\r\n" % tag.encode())
+            return True
+
+        try:
+            result = handler(tag, args, uid) if command in ("FETCH", "SEARCH", "STORE", "COPY", "MOVE", "EXPUNGE") \
+                else handler(tag, args)
+            if asyncio.iscoroutine(result):
+                result = await result
+        except (ProtocolError, IndexError, ValueError) as err:
+            self.send(b"%s BAD %s\r\n" % (tag.encode(), str(err).encode()))
+            return True
+
+        return result is not False
+
+    def ok(self, tag: str, text: str = "Completed"):
+        self.send(("%s OK %s\r\n" % (tag, text)).encode())
+
+    def cmd_capability(self, tag, args):
+        self.send(b"* CAPABILITY %s\r\n" % self.capability_string())
+        self.ok(tag)
+
+    def cmd_noop(self, tag, args):
+        self.ok(tag)
+
+    def cmd_check(self, tag, args):
+        self.ok(tag)
+
+    def cmd_logout(self, tag, args):
+        self.send(b"* BYE logging out\r\n")
+        self.ok(tag)
+        return False
+
+    def cmd_login(self, tag, args):
+        self.authenticated = True
+        self.ok(tag, "[CAPABILITY %s] Logged in" % self.capability_string().decode())
+
+    async def cmd_authenticate(self, tag, args):
+        self.send(b"+ \r\n")
+        response = await self.reader.readline()
+        self.server.stats.bytes_received += len(response)
+        self.authenticated = True
+        self.ok(tag, "[CAPABILITY %s] Authenticated" % self.capability_string().decode())
+
+    def cmd_enable(self, tag, args):
+        enabled = [str(arg).upper() for arg in args if str(arg).upper() in self.server.capabilities]
+        if "QRESYNC" in enabled:
+            enabled.append("CONDSTORE")
+        self.enabled.update(enabled)
+        self.send(("* ENABLED %s\r\n" % " ".join(enabled)).encode())
+        self.ok(tag)
+
+    def cmd_list(self, tag, args):
+        for name in self.account.mailboxes:
+            self.send(("* LIST (\\HasNoChildren) \"/\" \"%s\"\r\n" % name).encode())
+        self.ok(tag)
+
+    def cmd_status(self, tag, args):
+        mailbox = self.account.mailbox(str(args[0]))
+        if mailbox is None:
+            self.send(b"%s NO No such mailbox\r\n" % tag.encode())
+            return
+
+        values = {
+            "MESSAGES": len(mailbox),
+            "UIDNEXT": mailbox.uidnext,
+            "UIDVALIDITY": mailbox.uidvalidity,
+            "UNSEEN": 0,
+            "RECENT": 0,
+            "HIGHESTMODSEQ": mailbox.highestmodseq
+        }
+        items = " ".join("%s %d" % (item.upper(), values[item.upper()]) for item in args[1])
+        self.send(("* STATUS \"%s\" (%s)\r\n" % (mailbox.name, items)).encode())
+        self.ok(tag)
+
+    def cmd_select(self, tag, args, readonly=False):
+        mailbox = self.account.mailbox(str(args[0]))
+        if mailbox is None:
+            self.selected = None
+            self.send(b"%s NO No such mailbox\r\n" % tag.encode())
+            return
+
+        self.selected = mailbox
+        self.readonly = readonly
+        self.send(b"* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)\r\n")
+        self.send(b"* %d EXISTS\r\n* 0 RECENT\r\n" % len(mailbox))
+        self.send(b"* OK [UIDVALIDITY %d] UIDs valid\r\n" % mailbox.uidvalidity)
+        self.send(b"* OK [UIDNEXT %d] Predicted next UID\r\n" % mailbox.uidnext)
+        if "CONDSTORE" in self.server.capabilities:
+            self.send(b"* OK [HIGHESTMODSEQ %d] Highest\r\n" % mailbox.highestmodseq)
+        self.ok(tag, "[%s] %s completed" % ("READ-ONLY" if readonly else "READ-WRITE", "EXAMINE" if readonly else "SELECT"))
+
+    def cmd_examine(self, tag, args):
+        return self.cmd_select(tag, args, readonly=True)
+
+    def cmd_close(self, tag, args):
+        self.selected = None
+        self.ok(tag)
+
+    def cmd_unselect(self, tag, args):
+        self.selected = None
+        self.ok(tag)
+
+    def require_selected(self) -> SyntheticMailbox:
+        if self.selected is None:
+            raise ProtocolError("No mailbox selected")
+
+        return self.selected
+
+    def resolve(self, mailbox: SyntheticMailbox, value: str, uid: bool) -> list[int]:
+        """
+        Turns a sequence set into a sorted list of positions in the mailbox.
+        """
+        positions = []
+        if uid:
+            largest = mailbox.uids[-1] if len(mailbox) else 0
+            for low, high in iter_set(value, largest):
+                start = bisect.bisect_left(mailbox.uids, low)
+                stop = bisect.bisect_right(mailbox.uids, high)
+                positions.extend(range(start, stop))
+        else:
+            for low, high in iter_set(value, len(mailbox)):
+                positions.extend(range(max(low, 1) - 1, min(high, len(mailbox))))
+
+        return sorted(set(positions))
+
+    def cmd_fetch(self, tag, args, uid):
+        mailbox = self.require_selected()
+        positions = self.resolve(mailbox, str(args[0]), uid)
+        items = args[1] if isinstance(args[1], list) else [args[1]]
+        items = [str(item).upper() for item in items]
+        if uid and "UID" not in items:
+            items.insert(0, "UID")
+
+        changed_since = None
+        vanished = False
+        if len(args) > 2 and isinstance(args[2], list):
+            modifiers = [str(item).upper() for item in args[2]]
+            if "CHANGEDSINCE" in modifiers:
+                changed_since = int(modifiers[modifiers.index("CHANGEDSINCE") + 1])
+                if "MODSEQ" not in items:
+                    items.append("MODSEQ")
+            vanished = "VANISHED" in modifiers
+
+        if vanished:
+            if "QRESYNC" not in self.enabled or not uid:
+                raise ProtocolError("VANISHED requires UID FETCH with QRESYNC enabled")
+
+            largest = max(mailbox.uidnext - 1, 1)
+            in_set = parse_set(str(args[0]), largest)
+            gone = [expunged_uid for modseq, expunged_uid in mailbox.expunged if modseq > changed_since and in_set(expunged_uid)]
+            if gone:
+                self.send(("* VANISHED (EARLIER) %s\r\n" % format_set(gone)).encode())
+
+        out = bytearray()
+        for position in positions:
+            if changed_since is not None and mailbox.modseqs[position] <= changed_since:
+                continue
+
+            out += self.fetch_message(mailbox, position, items)
+            if len(out) > 65536:
+                self.send(bytes(out))
+                out = bytearray()
+
+        if out:
+            self.send(bytes(out))
+
+        self.ok(tag)
+
+    def fetch_message(self, mailbox: SyntheticMailbox, position: int, items: list[str]) -> bytes:
+        parts = []
+        literal = None
+        for item in items:
+            if item == "UID":
+                parts.append(b"UID %d" % mailbox.uids[position])
+            elif item == "FLAGS":
+                parts.append(b"FLAGS (%s)" % (b"\\Deleted" if mailbox.deleted[position] else b""))
+            elif item == "RFC822.SIZE":
+                parts.append(b"RFC822.SIZE %d" % mailbox.sizes[position])
+            elif item == "INTERNALDATE":
+                date = datetime.datetime.fromtimestamp(mailbox.dates[position], tz=datetime.timezone.utc)
+                parts.append(b"INTERNALDATE \"%s\"" % date.strftime("%d-%b-%Y %H:%M:%S +0000").encode())
+            elif item == "MODSEQ":
+                parts.append(b"MODSEQ (%d)" % mailbox.modseqs[position])
+            elif item.startswith("BODY"):
+                header = self.account.sender_headers[mailbox.senders[position]] + b"\r\n"
+                literal = b"BODY[HEADER.FIELDS (FROM)] {%d}\r\n%s" % (len(header), header)
+            else:
+                raise ProtocolError("Unsupported FETCH item %s" % item)
+
+        # like Gmail, put the literal first and the remaining items after it, so clients can't
+        # rely on UID preceding the body
+        if literal is not None:
+            return b"* %d FETCH (%s %s)\r\n" % (position + 1, literal, b" ".join(parts))
+
+        return b"* %d FETCH (%s)\r\n" % (position + 1, b" ".join(parts))
+
+    def cmd_search(self, tag, args, uid):
+        mailbox = self.require_selected()
+        if args and str(args[0]).upper() == "CHARSET":
+            args = args[2:]
+
+        matcher = self.parse_criteria(mailbox, list(args))
+        results = []
+        for position in range(len(mailbox)):
+            if matcher(position):
+                results.append(mailbox.uids[position] if uid else position + 1)
+
+        self.send(("* SEARCH%s\r\n" % "".join(" %d" % result for result in results)).encode())
+        self.ok(tag)
+
+    def parse_criteria(self, mailbox: SyntheticMailbox, args: list) -> typing.Callable[[int], bool]:
+        criteria = []
+        while args:
+            criteria.append(self.parse_criterion(mailbox, args))
+
+        return lambda position: all(criterion(position) for criterion in criteria)
+
+    def parse_criterion(self, mailbox: SyntheticMailbox, args: list) -> typing.Callable[[int], bool]:
+        token = args.pop(0)
+        if isinstance(token, list):
+            return self.parse_criteria(mailbox, list(token))
+
+        key = str(token).upper()
+        if key == "ALL":
+            return lambda position: True
+        if key == "OR":
+            left = self.parse_criterion(mailbox, args)
+            right = self.parse_criterion(mailbox, args)
+            return lambda position: left(position) or right(position)
+        if key == "NOT":
+            inner = self.parse_criterion(mailbox, args)
+            return lambda position: not inner(position)
+        if key == "FROM":
+            needle = str(args.pop(0)).lower().encode("utf-8")
+            matching = {sender for sender, header in enumerate(self.account.sender_headers) if needle in header.lower()}
+            return lambda position: mailbox.senders[position] in matching
+        if key == "DELETED":
+            return lambda position: bool(mailbox.deleted[position])
+        if key == "UNDELETED":
+            return lambda position: not mailbox.deleted[position]
+        if key == "UID":
+            largest = mailbox.uids[-1] if len(mailbox) else 0
+            in_set = parse_set(str(args.pop(0)), largest)
+            return lambda position: in_set(mailbox.uids[position])
+        if re.match(r"^[0-9*:,]+$", key):
+            in_set = parse_set(key, len(mailbox))
+            return lambda position: in_set(position + 1)
+
+        raise ProtocolError("Unsupported search key %s" % key)
+
+    def cmd_store(self, tag, args, uid):
+        mailbox = self.require_selected()
+        if self.readonly:
+            self.send(b"%s NO Mailbox is read-only\r\n" % tag.encode())
+            return
+
+        positions = self.resolve(mailbox, str(args[0]), uid)
+        action = str(args[1]).upper()
+        flags = args[2] if isinstance(args[2], list) else [args[2]]
+        deleted = "\\DELETED" in [str(flag).upper() for flag in flags]
+
+        for position in positions:
+            if action.startswith("+FLAGS"):
+                value = 1 if deleted else mailbox.deleted[position]
+            elif action.startswith("-FLAGS"):
+                value = 0 if deleted else mailbox.deleted[position]
+            else:
+                value = 1 if deleted else 0
+
+            mailbox.highestmodseq += 1
+            mailbox.modseqs[position] = mailbox.highestmodseq
+            mailbox.deleted[position] = value
+
+            if not action.endswith(".SILENT"):
+                self.send(b"* %d FETCH (%sFLAGS (%s))\r\n" % (
+                    position + 1, b"UID %d " % mailbox.uids[position] if uid else b"", b"\\Deleted" if value else b""
+                ))
+
+        self.ok(tag)
+
+    def copy_to(self, mailbox: SyntheticMailbox, positions: list[int], target_name: str) -> str | None:
+        target = self.account.mailbox(target_name)
+        if target is None:
+            return None
+
+        source_uids = []
+        target_uids = []
+        for position in positions:
+            source_uids.append(mailbox.uids[position])
+            target_uids.append(target.append(mailbox.senders[position], mailbox.sizes[position], mailbox.dates[position]))
+
+        if not source_uids:
+            return ""
+
+        return "[COPYUID %d %s %s] " % (target.uidvalidity, format_set(source_uids), format_set(target_uids))
+
+    def cmd_copy(self, tag, args, uid):
+        mailbox = self.require_selected()
+        positions = self.resolve(mailbox, str(args[0]), uid)
+        response = self.copy_to(mailbox, positions, str(args[1]))
+        if response is None:
+            self.send(b"%s NO [TRYCREATE] No such mailbox\r\n" % tag.encode())
+            return
+
+        self.ok(tag, response + "COPY completed")
+
+    def cmd_move(self, tag, args, uid):
+        if "MOVE" not in self.server.capabilities:
+            raise ProtocolError("MOVE not supported")
+
+        mailbox = self.require_selected()
+        positions = self.resolve(mailbox, str(args[0]), uid)
+        response = self.copy_to(mailbox, positions, str(args[1]))
+        if response is None:
+            self.send(b"%s NO [TRYCREATE] No such mailbox\r\n" % tag.encode())
+            return
+
+        if response:
+            self.send(("* OK %s\r\n" % response.strip()).encode())
+        self.send_expunged(mailbox, positions)
+        self.ok(tag, "MOVE completed")
+
+    def cmd_expunge(self, tag, args, uid):
+        mailbox = self.require_selected()
+        if uid:
+            if "UIDPLUS" not in self.server.capabilities:
+                raise ProtocolError("UID EXPUNGE not supported")
+            candidates = set(self.resolve(mailbox, str(args[0]), True))
+        else:
+            candidates = None
+
+        positions = [
+            position for position in range(len(mailbox))
+            if mailbox.deleted[position] and (candidates is None or position in candidates)
+        ]
+        self.send_expunged(mailbox, positions)
+        self.ok(tag)
+
+    def send_expunged(self, mailbox: SyntheticMailbox, positions: list[int]):
+        if not positions:
+            return
+
+        sequence_numbers = [position + 1 for position in positions]
+        removed = mailbox.expunge(positions)
+
+        if "QRESYNC" in self.enabled:
+            self.send(("* VANISHED %s\r\n" % format_set(removed)).encode())
+        else:
+            # highest first, so that each sequence number is still valid when the client sees it
+            self.send(b"".join(b"* %d EXPUNGE\r\n" % number for number in reversed(sequence_numbers)))
+
+
+class FakeIMAPServer:
+    def __init__(self, account: SyntheticAccount, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0,
+                 tls: bool = False, capabilities: typing.Iterable[str] = DEFAULT_CAPABILITIES, max_line: int = 1024 * 1024,
+                 max_connections: int | None = None):
+        self.account = account
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.tls = tls
+        self.capabilities = tuple(capability.upper() for capability in capabilities)
+        self.max_line = max_line
+        self.max_connections = max_connections
+        self.stats = ServerStats()
+
+        self.certificate: str | None = None
+        self.__server: asyncio.AbstractServer | None = None
+        self.__active = 0
+        self.__tempdir: tempfile.TemporaryDirectory | None = None
+
+    def __ssl_context(self) -> ssl.SSLContext:
+        self.__tempdir = tempfile.TemporaryDirectory()
+        key = os.path.join(self.__tempdir.name, "key.pem")
+        self.certificate = os.path.join(self.__tempdir.name, "cert.pem")
+        subprocess.run([
+            "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-keyout", key,
+            "-out", self.certificate, "-subj", "/CN=localhost", "-addext", "subjectAltName=DNS:localhost,IP:127.0.0.1"
+        ], check=True, capture_output=True)
+
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(self.certificate, key)
+        return context
+
+    async def start(self) -> int:
+        self.__server = await asyncio.start_server(
+            self.__accept, self.host, self.port, ssl=self.__ssl_context() if self.tls else None, limit=64 * 1024 * 1024
+        )
+        self.port = self.__server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def __accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if self.max_connections is not None and self.__active >= self.max_connections:
+            writer.write(b"* BYE Too many simultaneous connections\r\n")
+            writer.close()
+            return
+
+        self.__active += 1
+        self.stats.connections += 1
+        try:
+            await Session(self, reader, writer).run()
+        finally:
+            self.__active -= 1
+
+    async def stop(self):
+        if self.__server:
+            self.__server.close()
+            await self.__server.wait_closed()
+        if self.__tempdir:
+            self.__tempdir.cleanup()
+
+
+class ServerProcess:
+    """
+    Runs a FakeIMAPServer in a child process, so that the mailbox's memory and the server's CPU time
+    aren't counted against the client being measured. Its statistics are fetched over a pipe.
+    """
+
+    __options: dict[str, typing.Any]
+    __process: multiprocessing.Process | None
+    __connection: multiprocessing.connection.Connection | None
+
+    port: int | None
+    certificate: str | None
+
+    def __init__(self, **options):
+        self.__options = options
+        self.__process = None
+        self.__connection = None
+        self.port = None
+        self.certificate = None
+
+    def start(self):
+        self.__connection, child = multiprocessing.Pipe()
+        self.__process = multiprocessing.Process(target=_serve_process, args=(child, self.__options), daemon=True)
+        self.__process.start()
+
+        ready = self.__connection.recv()
+        if isinstance(ready, BaseException):
+            raise ready
+
+        self.port, self.certificate = ready
+
+    def stats(self) -> dict[str, typing.Any]:
+        return self.__request("stats")
+
+    def reset_stats(self):
+        self.__request("reset")
+
+    def stop(self):
+        if self.__process is None:
+            return
+
+        try:
+            self.__request("stop")
+        except (EOFError, OSError):
+            pass
+
+        self.__process.join(5)
+        if self.__process.is_alive():
+            self.__process.terminate()
+
+        self.__process = None
+
+    def __request(self, command: str) -> typing.Any:
+        self.__connection.send(command)
+        return self.__connection.recv()
+
+    def __enter__(self) -> ServerProcess:
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stop()
+
+
+def _serve_process(connection: multiprocessing.connection.Connection, options: dict[str, typing.Any]):
+    account_options = {key: options.pop(key) for key in ("messages", "senders", "skew", "seed", "uid_gap") if key in options}
+
+    try:
+        server = FakeIMAPServer(SyntheticAccount(**account_options), **options)
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(server.start())
+    except Exception as exc:
+        connection.send(exc)
+        return
+
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    connection.send((server.port, server.certificate))
+
+    async def handle(command: str) -> typing.Any:
+        if command == "stats":
+            return server.stats.as_dict()
+        if command == "reset":
+            server.stats.reset()
+        elif command == "stop":
+            await server.stop()
+
+    while True:
+        try:
+            command = connection.recv()
+        except EOFError:
+            # the benchmark went away without stopping the server
+            asyncio.run_coroutine_threadsafe(handle("stop"), loop).result()
+            break
+
+        connection.send(asyncio.run_coroutine_threadsafe(handle(command), loop).result())
+        if command == "stop":
+            break
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a synthetic mailbox over IMAP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1143)
+    parser.add_argument("--messages", type=int, default=10_000)
+    parser.add_argument("--senders", type=int, default=1_000)
+    parser.add_argument("--skew", type=float, default=1.1, help="Zipf exponent of the sender distribution")
+    parser.add_argument("--latency", type=float, default=0.0, help="one-way latency added to every response, in seconds")
+    parser.add_argument("--tls", action="store_true")
+    parser.add_argument("--capabilities", default=" ".join(DEFAULT_CAPABILITIES))
+    args = parser.parse_args()
+
+    account = SyntheticAccount(args.messages, args.senders, skew=args.skew)
+    server = FakeIMAPServer(account, args.host, args.port, latency=args.latency, tls=args.tls, capabilities=args.capabilities.split())
+
+    async def serve():
+        port = await server.start()
+        print("Serving %d messages on %s:%d%s" % (args.messages, args.host, port, " (TLS, certificate %s)" % server.certificate if args.tls else ""))
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
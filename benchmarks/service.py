@@ -0,0 +1,338 @@
+"""
+Measures scanning, finding and purging against a synthetic mailbox served by benchmarks.imapserver,
+reporting wall time, IMAP round trips, bytes on the wire and peak memory for each phase. Run from
+the project root:
+
+    python -m benchmarks.service --messages 100000 --latency 0.02 [--tls] [--backend async]
+
+With --save, the results are written as JSON; with --baseline, they are compared with a saved run
+and the exit status is non-zero if a phase got slower or chattier by more than --tolerance.
+"""
+from __future__ import annotations
+
+import argparse
+import contextlib
+import imaplib
+import json
+import ssl
+import sys
+import time
+import typing
+
+from api.aioimap import AsyncGenericIMAP
+from api.imap import GenericIMAP, InstrumentedIMAP4, InstrumentedIMAP4_SSL
+from api.index import SenderIndex
+from api.service import CleanserService
+import util
+
+from .imapserver import DEFAULT_CAPABILITIES, ServerProcess
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class LocalIMAP(GenericIMAP):
+    """
+    An account on the benchmark server, over plain TCP or TLS trusting its certificate.
+    """
+
+    __host: str
+    __port: int
+    __certificate: str | None
+    __client: imaplib.IMAP4
+    __authenticated: bool
+
+    def __init__(self, host: str, port: int, certificate: str | None = None):
+        self.__host = host
+        self.__port = port
+        self.__certificate = certificate
+        self.__authenticated = False
+        self.__client = self.__connect()
+
+    def __connect(self) -> imaplib.IMAP4:
+        if self.__certificate:
+            return InstrumentedIMAP4_SSL(self.__host, self.__port, ssl_context=ssl.create_default_context(cafile=self.__certificate))
+
+        return InstrumentedIMAP4(self.__host, self.__port)
+
+    def reopen(self):
+        with contextlib.suppress(OSError):
+            self.__client.shutdown()
+
+        self.__authenticated = False
+        self.__client = self.__connect()
+
+    def authenticate(self):
+        self.__client.login("benchmark", "benchmark")
+        self.__authenticated = True
+        self.refresh_capabilities()
+
+    def logout(self):
+        self.__client.logout()
+        self.__authenticated = False
+
+    def clone(self) -> LocalIMAP:
+        return LocalIMAP(self.__host, self.__port, self.__certificate)
+
+    def serialize(self) -> typing.Any:
+        return {"host": self.__host, "port": self.__port, "certificate": self.__certificate}
+
+    @classmethod
+    def build(cls, json_data: typing.Any, debug: bool = False) -> LocalIMAP:
+        return cls(json_data["host"], json_data["port"], json_data["certificate"])
+
+    @property
+    def imap(self) -> imaplib.IMAP4:
+        return self.__client
+
+    @property
+    def user(self) -> str:
+        return "benchmark"
+
+    @property
+    def authenticated(self) -> bool:
+        return self.__authenticated
+
+
+class AsyncLocalIMAP(AsyncGenericIMAP):
+    """
+    An account on the benchmark server on the asyncio backend, which only speaks TLS.
+    """
+
+    __host: str
+    __port: int
+    __certificate: str
+    __authenticated: bool
+
+    def __init__(self, host: str, port: int, certificate: str):
+        self.__host = host
+        self.__port = port
+        self.__certificate = certificate
+        self.__authenticated = False
+        super().__init__(host, port, ssl.create_default_context(cafile=certificate))
+
+    def authenticate(self):
+        self.imap.login("benchmark", "benchmark")
+        self.__authenticated = True
+        self.refresh_capabilities()
+
+    def logout(self):
+        self.imap.logout()
+        self.__authenticated = False
+
+    def clone(self) -> AsyncLocalIMAP:
+        return AsyncLocalIMAP(self.__host, self.__port, self.__certificate)
+
+    def serialize(self) -> typing.Any:
+        return {"host": self.__host, "port": self.__port, "certificate": self.__certificate}
+
+    @classmethod
+    def build(cls, json_data: typing.Any, debug: bool = False) -> AsyncLocalIMAP:
+        return cls(json_data["host"], json_data["port"], json_data["certificate"])
+
+    @property
+    def user(self) -> str:
+        return "benchmark"
+
+    @property
+    def authenticated(self) -> bool:
+        return self.__authenticated
+
+
+class Result(typing.NamedTuple):
+    phase: str
+    seconds: float
+    round_trips: int
+    bytes_sent: int
+    bytes_received: int
+    peak_rss: int | None  # bytes, over the phase where the platform can tell, otherwise since the start
+    detail: str
+
+
+def reset_peak_rss():
+    # Linux resets the high water mark when 5 is written here; elsewhere the peak is since the start
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss() -> int | None:
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def measure(server: ServerProcess, phase: str, action: typing.Callable[[], str]) -> Result:
+    server.reset_stats()
+    reset_peak_rss()
+
+    started = time.perf_counter()
+    detail = action()
+    seconds = time.perf_counter() - started
+
+    stats = server.stats()
+    # the server sends what the client receives and vice versa
+    return Result(phase, seconds, stats["round_trips"], stats["bytes_received"], stats["bytes_sent"], peak_rss(), detail)
+
+
+def run(args: argparse.Namespace) -> list[Result]:
+    options = {
+        "messages": args.messages,
+        "senders": args.senders,
+        "skew": args.skew,
+        "seed": args.seed,
+        "latency": args.latency,
+        "tls": args.tls or args.backend == "async",
+        "capabilities": args.capabilities.split()
+    }
+
+    with ServerProcess(**options) as server:
+        if args.backend == "async":
+            client = AsyncLocalIMAP("127.0.0.1", server.port, server.certificate)
+        else:
+            client = LocalIMAP("127.0.0.1", server.port, server.certificate)
+        client.authenticate()
+
+        service = CleanserService(client, junk_folder="Junk", connections=args.connections)
+        # the async phases have to run on the backend's event loop, which owns the connection
+        pipelined = isinstance(client, AsyncGenericIMAP)
+        results = []
+        try:
+            senders = set()
+
+            def scan() -> str:
+                if pipelined:
+                    senders.update(client.run(unique_senders_async(service, "INBOX")))
+                else:
+                    senders.update(service.get_unique_senders("INBOX"))
+                return "%d senders" % len(senders)
+
+            results.append(measure(server, "scan", scan))
+
+            # the senders with the most mail are the likeliest to be purged, and the costliest
+            chosen = set(sorted(senders, key=sender_rank)[:args.purge_senders])
+            uids = set()
+
+            def find() -> str:
+                if pipelined:
+                    uids.update(client.run(service.find_emails_to_cleanse_async(chosen, "INBOX")))
+                else:
+                    uids.update(service.find_emails_to_cleanse(chosen, "INBOX"))
+                return "%d messages from %d senders" % (len(uids), len(chosen))
+
+            results.append(measure(server, "find", find))
+
+            def purge() -> str:
+                if pipelined:
+                    client.run(service.cleanse_emails_async(uids, "INBOX"))
+                else:
+                    service.cleanse_emails(uids, "INBOX")
+                return "%d messages moved" % len(uids)
+
+            results.append(measure(server, "purge", purge))
+        finally:
+            service.close()
+            client.logout()
+
+    return results
+
+
+async def unique_senders_async(service: CleanserService, mailbox: str) -> set[str]:
+    senders = set()
+    async for chunk in service.iter_sender_chunks_async(mailbox):
+        senders.update(message.sender for message in chunk)
+
+    senders.discard(SenderIndex.UNKNOWN_SENDER)
+    return senders
+
+
+def sender_rank(sender: str) -> int:
+    # synthetic senders are numbered by rank in the distribution, e.g. alice3@example.com
+    digits = "".join(char for char in sender.partition("@")[0] if char.isdigit())
+    return int(digits) if digits else sys.maxsize
+
+
+def format_bytes(size: int | None) -> str:
+    return util.format_size(size) if size is not None else "n/a"
+
+
+def report(results: list[Result]):
+    print("%-6s %9s %11s %10s %10s %10s  %s" % ("phase", "seconds", "round trips", "sent", "received", "peak RSS", "detail"))
+    for result in results:
+        print("%-6s %9.3f %11d %10s %10s %10s  %s" % (
+            result.phase, result.seconds, result.round_trips, format_bytes(result.bytes_sent),
+            format_bytes(result.bytes_received), format_bytes(result.peak_rss), result.detail
+        ))
+
+
+def compare(results: list[Result], baseline_path: str, tolerance: float) -> list[str]:
+    """
+    Returns a description of every phase that took longer, or made more round trips, than in the
+    baseline by more than `tolerance` (a fraction).
+    """
+    with open(baseline_path) as baseline_file:
+        baseline = {entry["phase"]: entry for entry in json.load(baseline_file)["results"]}
+
+    regressions = []
+    for result in results:
+        before = baseline.get(result.phase)
+        if before is None:
+            continue
+
+        for metric in ("seconds", "round_trips"):
+            previous, current = before[metric], getattr(result, metric)
+            if previous and current > previous * (1 + tolerance):
+                regressions.append("%s: %s went from %s to %s" % (result.phase, metric, previous, current))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks scanning and purging a synthetic mailbox.")
+    parser.add_argument("--messages", type=int, default=10_000, help="messages in the mailbox, e.g. 1000 to 1000000")
+    parser.add_argument("--senders", type=int, default=1_000, help="distinct senders")
+    parser.add_argument("--skew", type=float, default=1.1, help="Zipf exponent of the sender distribution")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0, help="one-way latency added to every response, in seconds")
+    parser.add_argument("--tls", action="store_true", help="connect over TLS (always on for the async backend)")
+    parser.add_argument("--backend", choices=("sync", "async"), default="sync")
+    parser.add_argument("--connections", type=int, default=1, help="connections to scan and search with")
+    parser.add_argument("--purge-senders", type=int, default=10, help="number of the busiest senders to find and purge")
+    parser.add_argument("--capabilities", default=" ".join(DEFAULT_CAPABILITIES), help="capabilities the server advertises")
+    parser.add_argument("--save", metavar="PATH", help="write the results to PATH as JSON")
+    parser.add_argument("--baseline", metavar="PATH", help="compare with results saved by --save")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="slowdown allowed against the baseline, as a fraction")
+    args = parser.parse_args()
+
+    results = run(args)
+    report(results)
+
+    if args.save:
+        with open(args.save, "w") as save_file:
+            json.dump({"arguments": vars(args), "results": [result._asdict() for result in results]}, save_file, indent=2)
+
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        for regression in regressions:
+            print("regression: %s" % regression)
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
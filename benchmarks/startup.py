@@ -0,0 +1,196 @@
+"""
+Measures how long the app takes to start, in fresh interpreters: interpreter startup, importing the
+app, and until the main window is first painted (or, with --mode cli, until the command line is
+parsed). Run from the project root:
+
+    python -m benchmarks.startup [--mode gui|cli] [--repeat 5] [--imports 15]
+
+The GUI mode needs a display. --imports also lists the modules that took the longest to import, and
+every run reports which of the heavy, optional dependencies were loaded by then. With --save, the
+results are written as JSON; with --baseline, they are compared with a saved run and the exit status
+is non-zero if startup got slower by more than --tolerance or loads a heavy module it didn't before.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import typing
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# dependencies that cost a good fraction of a second between them, and that only some accounts or
+# dialogs need
+HEAVY_MODULES = ("googleapiclient", "google.oauth2", "requests", "PIL", "ttkthemes")
+
+_REPORT = """
+def report(**times):
+    import json, sys
+    heavy = [name for name in %r if name in sys.modules]
+    sys.stdout.write(json.dumps(dict(times, modules=heavy)) + "\\n")
+    sys.stdout.flush()
+""" % (HEAVY_MODULES,)
+
+CHILDREN = {
+    "gui": _REPORT + """
+import time
+started = time.time()
+
+import config
+from ui import app
+imported = time.time()
+
+root, window = app.create_window(config.load_settings(), None)
+
+def painted(_):
+    window.unbind("<Expose>")
+    root.update_idletasks()
+    report(started=started, imported=imported, ready=time.time())
+    root.quit()
+
+window.bind("<Expose>", painted)
+root.after(30000, root.quit)
+root.mainloop()
+""",
+    "cli": _REPORT + """
+import time
+started = time.time()
+
+import cli
+imported = time.time()
+
+cli.build_parser().parse_args(["purge", "--dry-run"])
+report(started=started, imported=imported, ready=time.time())
+"""
+}
+
+
+class Result(typing.NamedTuple):
+    interpreter: float  # seconds from spawning the process until it runs the first line
+    imports: float  # seconds importing the app
+    window: float  # seconds from the imports until the window is painted (or the arguments parsed)
+    total: float
+    modules: list[str]  # the HEAVY_MODULES loaded by then
+
+
+def run_once(mode: str, importtime: bool = False) -> tuple[Result, str]:
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", CHILDREN[mode]]
+
+    spawned = time.time()
+    process = subprocess.run(command, cwd=ROOT, capture_output=True, text=True)
+    lines = process.stdout.strip().splitlines()
+    if process.returncode != 0 or not lines:
+        raise RuntimeError("Startup failed:\n%s" % process.stderr.strip())
+
+    times = json.loads(lines[-1])
+    result = Result(
+        times["started"] - spawned, times["imported"] - times["started"], times["ready"] - times["imported"],
+        times["ready"] - spawned, times["modules"]
+    )
+    return result, process.stderr
+
+
+def slowest_imports(importtime: str, count: int) -> list[tuple[str, int, int]]:
+    """
+    Returns the `count` modules with the longest import time of their own, along with that time and
+    the cumulative time including what they imported, in microseconds, from -X importtime output.
+    """
+    imports = []
+    for line in importtime.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+
+        own, cumulative, name = line[len("import time:"):].split("|")
+        if own.strip().isdigit():
+            imports.append((name.strip(), int(own), int(cumulative)))
+
+    return sorted(imports, key=lambda entry: entry[1], reverse=True)[:count]
+
+
+def summarize(results: list[Result]) -> dict[str, typing.Any]:
+    summary = {}
+    for field in ("interpreter", "imports", "window", "total"):
+        values = [getattr(result, field) for result in results]
+        summary[field] = {"median": statistics.median(values), "best": min(values)}
+
+    summary["modules"] = sorted({name for result in results for name in result.modules})
+    return summary
+
+
+def report(mode: str, summary: dict[str, typing.Any]):
+    print("%-12s %10s %10s" % (mode, "median ms", "best ms"))
+    for field in ("interpreter", "imports", "window", "total"):
+        print("%-12s %10.1f %10.1f" % (field, summary[field]["median"] * 1000, summary[field]["best"] * 1000))
+    print("heavy modules loaded: %s" % (", ".join(summary["modules"]) or "none"))
+
+
+def compare(summary: dict[str, typing.Any], baseline_path: str, tolerance: float) -> list[str]:
+    """
+    Returns a description of every way startup regressed against the baseline: a median that grew
+    by more than `tolerance` (a fraction), or a heavy module that is now loaded.
+    """
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)["summary"]
+
+    regressions = []
+    for field in ("imports", "total"):
+        previous, current = baseline[field]["median"], summary[field]["median"]
+        if previous and current > previous * (1 + tolerance):
+            regressions.append("%s went from %.1f ms to %.1f ms" % (field, previous * 1000, current * 1000))
+
+    for name in sorted(set(summary["modules"]) - set(baseline["modules"])):
+        regressions.append("%s is now loaded at startup" % name)
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the app's startup.")
+    parser.add_argument("--mode", choices=tuple(CHILDREN), default="gui", help="until the window is painted, or until the command line is parsed")
+    parser.add_argument("--repeat", type=int, default=5, help="fresh interpreters to start")
+    parser.add_argument("--imports", type=int, default=0, metavar="N", help="also list the N slowest imports")
+    parser.add_argument("--save", metavar="PATH", help="write the results to PATH as JSON")
+    parser.add_argument("--baseline", metavar="PATH", help="compare with results saved by --save")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="slowdown allowed against the baseline, as a fraction")
+    args = parser.parse_args()
+
+    try:
+        # the first run warms the OS's file cache, and isn't counted
+        run_once(args.mode)
+        results = [run_once(args.mode)[0] for _ in range(args.repeat)]
+    except RuntimeError as err:
+        print(err, file=sys.stderr)
+        sys.exit(2)
+
+    summary = summarize(results)
+    report(args.mode, summary)
+
+    if args.imports:
+        _, importtime = run_once(args.mode, importtime=True)
+        print()
+        print("%-40s %10s %14s" % ("slowest imports", "own ms", "cumulative ms"))
+        for name, own, cumulative in slowest_imports(importtime, args.imports):
+            print("%-40s %10.1f %14.1f" % (name, own / 1000, cumulative / 1000))
+
+    if args.save:
+        with open(args.save, "w") as save_file:
+            json.dump({
+                "arguments": vars(args), "summary": summary, "results": [result._asdict() for result in results]
+            }, save_file, indent=2)
+
+    if args.baseline:
+        regressions = compare(summary, args.baseline, args.tolerance)
+        for regression in regressions:
+            print("regression: %s" % regression)
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,350 @@
+"""
+Purges mail without the GUI, e.g. from cron on a machine with no display:
+
+    python . purge --senders-file senders.txt [--pattern "*@news.example.com"] [--dry-run]
+
+The sender file has an address per line; blank lines and lines starting with # are skipped. Patterns
+are shell-style, matched case-insensitively against the senders in the mailbox. The account is the
+one the GUI last signed in to, unless --account names another by id or address; --all-accounts
+works on every configured account at once, each on its own connections.
+
+Progress is written to stdout as JSON lines, each an object with an "event" key, so that a wrapper
+can follow it; log messages go to stderr and the log file. The exit status is 0 on success, 1 if
+the account couldn't be used or the purge failed, and 130 if it was interrupted.
+"""
+from __future__ import annotations
+
+import argparse
+import concurrent.futures
+import fnmatch
+import imaplib
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import typing
+
+from api import CleanserService, GenericIMAP, SenderIndex, service_factory
+import config
+import persist
+import util
+
+
+COMMANDS = ("purge",)
+
+DEFAULT_MAILBOX = "Inbox"  # the mailbox the GUI scans, and the only one with a cached index
+
+# the latest result of every account that was purged from here, and its totals over every run
+RESULTS_KEY = "purge-results"
+
+_output_lock = threading.Lock()
+_config_lock = threading.Lock()
+
+
+class CommandError(Exception):
+    """
+    An error that ends the command, reported as an "error" event.
+    """
+
+
+def emit(event: str, **fields):
+    """
+    Writes one progress event to stdout as a line of JSON.
+    """
+    line = json.dumps({"event": event, "time": round(time.time(), 3)} | fields)
+    with _output_lock:
+        sys.stdout.write(line + "\n")
+        sys.stdout.flush()
+
+
+def read_senders(path: str) -> list[str]:
+    """
+    Reads a sender file, or stdin if `path` is "-".
+    """
+    if path == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(path, "r", encoding="utf-8") as sender_file:
+            lines = sender_file.read().splitlines()
+
+    senders = []
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            senders.append(line)
+
+    return senders
+
+
+def match_senders(known: typing.Iterable[str], addresses: typing.Iterable[str],
+                  patterns: typing.Iterable[str]) -> tuple[set[str], list[str]]:
+    """
+    Returns the senders in `known` that are one of `addresses` or match one of `patterns`, both
+    compared case-insensitively, along with the addresses that matched none of them.
+    """
+    by_address: dict[str, list[str]] = {}
+    for sender in known:
+        by_address.setdefault(sender.lower(), []).append(sender)
+
+    matched = set()
+    unmatched = []
+    for address in addresses:
+        spellings = by_address.get(address.lower())
+        if spellings:
+            matched.update(spellings)
+        else:
+            unmatched.append(address)
+
+    for pattern in patterns:
+        for address in fnmatch.filter(by_address, pattern.lower()):
+            matched.update(by_address[address])
+
+    return matched, unmatched
+
+
+class AccountResult(typing.NamedTuple):
+    account: str
+    status: str  # "purged", "planned" (a dry run or nothing to purge), "cancelled" or "failed"
+    senders: int = 0
+    messages: int = 0
+    size: int = 0
+    purged: int = 0
+    seconds: float = 0.0
+    error: str | None = None
+
+
+def load_accounts(service_config: dict[str, typing.Any] | None, account: str | None = None,
+                  all_accounts: bool = False) -> tuple[dict[str, typing.Any], list[dict[str, typing.Any]]]:
+    """
+    Returns the service configuration, in the current format, and the entries of the accounts to
+    use: the active one, the one named by `account` (an id or address), or all of them.
+    """
+    if not service_config:
+        raise CommandError("No account is configured. Sign in with the GUI first.")
+
+    version = service_config.get("version", "1")
+    service_config = service_factory.format_service_config(service_config, version=version)
+    accounts = service_config.get("accounts", [])
+
+    if all_accounts:
+        entries = accounts
+    elif account is not None:
+        entries = [entry for entry in accounts if account in (str(entry.get("id")), entry.get("data", {}).get("user"))][:1]
+        if not entries:
+            raise CommandError("No account '%s' is configured." % account)
+    else:
+        entries = [entry for entry in accounts if entry.get("id") == service_config.get("active")]
+
+    if not entries:
+        raise CommandError("No account is configured. Sign in with the GUI first.")
+
+    return service_config, entries
+
+
+def build_client(service_config: dict[str, typing.Any], entry: dict[str, typing.Any], debug: bool = False) -> GenericIMAP:
+    """
+    Builds the client of one of the configured accounts, and saves its data back in case building
+    it refreshed its credentials.
+    """
+    # create_service consumes the version
+    client = service_factory.create_service(
+        service_config | {"active": entry["id"], "version": service_factory.CONFIG_VERSION}, debug=debug
+    )
+    if client is None:
+        raise CommandError("Could not build the account's IMAP client; see the log for details.")
+
+    with _config_lock:
+        entry["data"] = client.serialize()
+        service_factory.save_service_config(service_config | {"version": service_factory.CONFIG_VERSION})
+
+    return client
+
+
+def record_result(result: AccountResult):
+    """
+    Keeps the account's latest result, and its totals over every run, in the cache.
+    """
+    totals = persist.getitems(RESULTS_KEY, result.account).get("totals") or {"runs": 0, "purged": 0, "size": 0}
+    totals = {
+        "runs": totals["runs"] + 1,
+        "purged": totals["purged"] + result.purged,
+        "size": totals["size"] + (result.size if result.purged else 0)
+    }
+    persist.setitems(RESULTS_KEY, result.account, {"last": result._asdict() | {"time": time.time()}, "totals": totals})
+
+
+def purge_account(service_config: dict[str, typing.Any], entry: dict[str, typing.Any], args: argparse.Namespace,
+                  addresses: list[str], settings: dict[str, str | None], token: util.CancellationToken) -> AccountResult:
+    """
+    Runs the whole purge for one account on its own client and connections, reporting failures as
+    the account's result rather than raising them, so that other accounts carry on.
+    """
+    account = (entry.get("data") or {}).get("user") or str(entry.get("id"))
+    started = time.perf_counter()
+    planned = AccountResult(account, "planned")
+
+    try:
+        client = build_client(service_config, entry, debug=args.debug)
+        account = client.user
+        planned = planned._replace(account=account)
+
+        service = None
+        try:
+            client.authenticate()
+            emit("connected", account=account)
+
+            junk_folder = None if args.delete else args.junk_folder or settings.get("junk_folder")
+            service = CleanserService(client, junk_folder=junk_folder, connections=args.connections or int(settings.get("connections") or 1))
+
+            # only the default mailbox's index is cached; any other is indexed from scratch
+            cached = args.mailbox == DEFAULT_MAILBOX and not args.no_cache
+            index = SenderIndex.load(account) if cached else SenderIndex()
+
+            emit("sync", account=account, mailbox=args.mailbox, cached_messages=index.message_count)
+            service.sync_senders(index, args.mailbox, token=token)
+            if cached:
+                index.save(account)
+            emit("synced", account=account, messages=index.message_count, senders=len(index.senders))
+
+            senders, unmatched = match_senders(index.senders, addresses, args.pattern)
+            stats = index.stats()
+            empty = SenderIndex.Stats(0, 0, 0, 0)
+            for sender in sorted(senders):
+                emit("sender", account=account, sender=sender, messages=stats.get(sender, empty).count, size=stats.get(sender, empty).size)
+
+            uids = index.uids_for(senders)
+            planned = AccountResult(account, "planned", len(senders), len(uids), sum(stats.get(sender, empty).size for sender in senders))
+            emit(
+                "plan", account=account, senders=planned.senders, unmatched=unmatched, messages=planned.messages,
+                size=planned.size, dry_run=args.dry_run
+            )
+
+            if args.dry_run or not uids:
+                return planned._replace(seconds=time.perf_counter() - started)
+
+            def progress(done: int, total: int):
+                emit("progress", account=account, done=done, total=total)
+
+            service.cleanse_emails(uids, args.mailbox, progress=progress, token=token)
+
+            index.discard(senders)
+            if cached:
+                index.save(account)
+
+            result = planned._replace(status="purged", purged=len(uids), seconds=time.perf_counter() - started)
+            emit(
+                "purged", account=account, messages=result.purged, senders=result.senders,
+                folder=service.junk_folder, seconds=round(result.seconds, 3)
+            )
+            return result
+        finally:
+            if service is not None:
+                service.close()
+            # also closes the connection if authenticating failed
+            try:
+                client.logout()
+            except (imaplib.IMAP4.error, OSError, GenericIMAP.StateError):
+                pass
+    except util.CancellationToken.Cancelled:
+        emit("cancelled", account=account)
+        return planned._replace(status="cancelled", seconds=time.perf_counter() - started)
+    except Exception as err:
+        # anything, down to a malformed account entry, only fails this account
+        if not isinstance(err, CommandError):
+            logging.exception("Purge of %s failed" % account)
+        message = str(err) or type(err).__name__
+        emit("error", account=account, message=message)
+        return planned._replace(status="failed", seconds=time.perf_counter() - started, error=message)
+
+
+def purge(args: argparse.Namespace, token: util.CancellationToken) -> int:
+    addresses = read_senders(args.senders_file) if args.senders_file else []
+    if not addresses and not args.pattern and not args.dry_run:
+        raise CommandError("Nothing to purge: give a sender file or at least one pattern.")
+
+    settings = config.load_settings()
+    if not (args.junk_folder or settings.get("junk_folder")) and not args.delete and not args.dry_run:
+        raise CommandError("No junk folder is configured; pass --delete to delete the messages permanently.")
+
+    service_config, entries = load_accounts(service_factory.load_service_config(), args.account, args.all_accounts)
+
+    # every account has its own client and connections, so they take about as long together as
+    # the slowest one does alone
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs or len(entries), thread_name_prefix="account") as executor:
+        futures = [executor.submit(purge_account, service_config, entry, args, addresses, settings, token) for entry in entries]
+        results = [future.result() for future in futures]
+
+    for result in results:
+        record_result(result)
+
+    if len(results) > 1:
+        emit(
+            "summary", accounts=[result._asdict() for result in results], purged=sum(result.purged for result in results),
+            failed=sum(result.status == "failed" for result in results), seconds=round(time.perf_counter() - started, 3)
+        )
+
+    if any(result.status == "cancelled" for result in results):
+        return 130
+    if any(result.status == "failed" for result in results):
+        return 1
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="purgetool", description="Purges mail from chosen senders without the GUI.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    purge_parser = commands.add_parser("purge", help="move (or delete) every message from the given senders")
+    purge_parser.add_argument("--senders-file", metavar="PATH", help="file with an address per line, or - for stdin")
+    purge_parser.add_argument("--pattern", action="append", default=[], metavar="GLOB",
+                              help="shell-style sender pattern, e.g. '*@news.example.com'; can be repeated")
+    purge_parser.add_argument("--dry-run", action="store_true", help="only report what would be purged, or just sync without senders")
+    accounts = purge_parser.add_mutually_exclusive_group()
+    accounts.add_argument("--account", metavar="ID_OR_ADDRESS", help="a configured account other than the active one")
+    accounts.add_argument("--all-accounts", action="store_true", help="every configured account, concurrently")
+    purge_parser.add_argument("--jobs", type=int, metavar="N", help="accounts to work on at once with --all-accounts (default: all)")
+    purge_parser.add_argument("--mailbox", default=DEFAULT_MAILBOX, help="mailbox to purge from (default: %(default)s)")
+    purge_parser.add_argument("--junk-folder", metavar="FOLDER", help="folder to move the messages to, instead of the configured one")
+    purge_parser.add_argument("--delete", action="store_true", help="delete the messages permanently instead of moving them")
+    purge_parser.add_argument("--connections", type=int, metavar="N", help="connections to use, instead of the configured number")
+    purge_parser.add_argument("--timeout", type=float, metavar="SECONDS", help="stop between IMAP commands after this long")
+    purge_parser.add_argument("--no-cache", action="store_true", help="rescan the mailbox instead of updating the cached index")
+    purge_parser.add_argument("--debug", action="store_true", help=argparse.SUPPRESS)
+
+    return parser
+
+
+def wants_cli(argv: list[str]) -> bool:
+    return bool(argv) and argv[0] in COMMANDS + ("-h", "--help")
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+
+    logging.basicConfig(filename=os.path.join(config.USER_LOG_DIR, "run.log"), encoding='utf-8', level=logging.DEBUG)
+    stderr = logging.StreamHandler()
+    stderr.setLevel(logging.WARNING)
+    logging.getLogger().addHandler(stderr)
+
+    # SIGINT, SIGTERM (e.g. from a cron timeout) and --timeout stop between IMAP commands, leaving
+    # every message either purged or untouched; a second signal stops right away
+    token = util.CancellationToken()
+    if args.timeout is not None:
+        token.cancel_after(args.timeout)
+
+    def stop(signum, _):
+        token.cancel()
+        signal.signal(signum, signal.SIG_DFL)
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, stop)
+
+    try:
+        return purge(args, token)
+    except CommandError as err:
+        emit("error", message=str(err))
+        return 1
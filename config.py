@@ -1,4 +1,5 @@
 import appdirs
+import configparser
 import os
 import sys
 
@@ -7,8 +8,12 @@ DEBUG = "--debug" in sys.argv
 SCOPES = ["openid", "https://mail.google.com/", "https://www.googleapis.com/auth/userinfo.profile", "https://www.googleapis.com/auth/userinfo.email"]
 AUTH_SERVICE_URL = f"http://localhost:{os.environ.get('AUTH_SERVICE_PORT', '5000')}" if DEBUG else "https://auth.9tailedstudios.com"
 
+# RFC 7162 recommends keeping command lines under 8192 octets, and some servers reject longer ones
+IMAP_MAX_COMMAND_BYTES = 8192
+
 SETTINGS_DEFAULTS = {
-    "junk_folder": "Junk"
+    "junk_folder": "Junk",
+    "connections": "4"
 }
 
 APP_NAME = "purgetool"
@@ -27,3 +32,16 @@ for app_dir in [
 ]:
     if not os.path.isdir(app_dir):
         os.makedirs(app_dir)
+
+SETTINGS_FILE = os.path.join(USER_CONFIG_DIR, "settings.ini")
+
+
+def load_settings() -> dict[str, str | None]:
+    """
+    Reads settings.ini over the defaults. Empty values stand for None.
+    """
+    parser = configparser.ConfigParser()
+    parser.read(SETTINGS_FILE)
+    settings = SETTINGS_DEFAULTS | dict(parser.items(configparser.DEFAULTSECT))
+
+    return {key: None if value == "" else value for key, value in settings.items()}
@@ -1,7 +1,9 @@
+from google.auth.exceptions import RefreshError
 from google.oauth2.credentials import Credentials as BaseCredentials
-import requests
 
 import datetime
+import logging
+import threading
 
 import config
 
@@ -13,13 +15,47 @@ class Credentials(BaseCredentials):
     auth-flow-provider exists to keep the client secret hidden.
     """
 
+    # how long before the token expires keep_fresh refreshes it
+    REFRESH_AHEAD = datetime.timedelta(minutes=5)
+
+    # how soon keep_fresh tries again after a failure, doubled after every failure in a row
+    RETRY_DELAY = 30.0  # seconds
+    MAX_RETRY_DELAY = 30 * 60.0  # seconds
+
+    REFRESH_TIMEOUT = 30.0  # seconds
+
+    __timer: threading.Timer | None = None
+    __retry_delay: float | None = None
+    __refresh_error: RefreshError | None = None
+
     def refresh(self, request):
         if self._refresh_token:
-            auth_response = requests.post(f"{config.AUTH_SERVICE_URL}/flows/google/refresh", json={
-                "refresh_token": self._refresh_token
-            })
+            if self.__refresh_error is not None:
+                # the auth service won't change its mind about this refresh token
+                raise self.__refresh_error
+
+            import requests
+
+            try:
+                auth_response = requests.post(f"{config.AUTH_SERVICE_URL}/flows/google/refresh", json={
+                    "refresh_token": self._refresh_token
+                }, timeout=Credentials.REFRESH_TIMEOUT)
+                data = auth_response.json()
+            except (requests.RequestException, ValueError) as err:
+                raise RefreshError("Could not reach the auth service: %s" % str(err), retryable=True) from err
+
+            if not isinstance(data, dict) or "access_token" not in data:
+                # e.g. invalid_grant, passed on from Google when the refresh token was revoked
+                reason = data.get("error") if isinstance(data, dict) else None
+                status = auth_response.status_code
+                error = RefreshError(
+                    "Could not refresh the token: %s (HTTP %d)" % (reason or "no access token", status),
+                    retryable=status >= 500 or status == 429
+                )
+                if not error.retryable:
+                    self.__refresh_error = error
+                raise error
 
-            data = auth_response.json()
             self.token = data["access_token"]
 
             expiry = datetime.datetime.fromtimestamp(data["expiry_date"] // 1000, datetime.timezone.utc)
@@ -28,3 +64,53 @@ class Credentials(BaseCredentials):
             self.expiry = expiry
         else:
             super().refresh(request)
+
+    def keep_fresh(self):
+        """
+        Refreshes the token on a background thread REFRESH_AHEAD of every expiry, for as long as the
+        process runs, so that connections opened or reopened late in a long operation don't have to
+        wait for a refresh. Failures are retried with a growing delay, until the auth service
+        rejects the refresh token; refresh_error then holds why. Does nothing if already running,
+        or if the token can't be refreshed.
+        """
+        if self.__timer is not None or not self._refresh_token or self.expiry is None:
+            return
+
+        self.__schedule()
+
+    def __schedule(self, delay: float | None = None):
+        if delay is None:
+            now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+            delay = max((self.expiry - Credentials.REFRESH_AHEAD - now).total_seconds(), 0.0)
+
+        self.__timer = threading.Timer(delay, self.__refresh_in_background)
+        self.__timer.daemon = True
+        self.__timer.start()
+
+    def __refresh_in_background(self):
+        try:
+            self.refresh(None)
+        except Exception as err:
+            if isinstance(err, RefreshError) and not err.retryable:
+                logging.error("Stopped refreshing the access token: %s" % str(err))
+                return
+
+            if self.__retry_delay is None:
+                self.__retry_delay = Credentials.RETRY_DELAY
+            else:
+                self.__retry_delay = min(self.__retry_delay * 2, Credentials.MAX_RETRY_DELAY)
+
+            logging.warning("Could not refresh the access token, retrying in %d seconds: %s" % (self.__retry_delay, str(err)))
+            self.__schedule(self.__retry_delay)
+            return
+
+        self.__retry_delay = None
+        logging.info("Access token refreshed, expires at %s" % self.expiry.isoformat())
+        self.__schedule()
+
+    @property
+    def refresh_error(self) -> RefreshError | None:
+        """
+        Why the refresh token was rejected, if it was; the account has to be signed in again.
+        """
+        return self.__refresh_error
@@ -0,0 +1,245 @@
+import collections
+import contextlib
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+import typing
+
+from config import USER_LOG_DIR
+import util
+
+
+# the rolling metrics file: totals since startup, plus the most recent samples
+METRICS_PATH = os.path.join(USER_LOG_DIR, "metrics.json")
+FLUSH_INTERVAL = 5.0  # seconds
+
+MAX_SAMPLES = 1000
+
+
+class Command(typing.NamedTuple):
+    verb: str  # e.g. "SELECT" or "UID FETCH"
+    started: float  # Unix time
+    seconds: float
+    bytes_sent: int
+    bytes_received: int
+    response_size: int  # payload of the untagged responses, without the protocol around it
+
+
+class Phase(typing.NamedTuple):
+    name: str  # e.g. "discovery", "search", "move" or "populate"
+    started: float  # Unix time
+    seconds: float
+
+
+class Totals(typing.NamedTuple):
+    count: int
+    seconds: float
+    bytes_sent: int
+    bytes_received: int
+    response_size: int
+
+
+Listener = typing.Callable[[], None]
+
+_lock = threading.Lock()
+_commands: collections.deque[Command] = collections.deque(maxlen=MAX_SAMPLES)
+_phases: collections.deque[Phase] = collections.deque(maxlen=MAX_SAMPLES)
+_command_totals: dict[str, Totals] = {}
+_phase_totals: dict[str, Totals] = {}
+_listeners: list[Listener] = []
+_export_path: str | None = None
+_last_flush = 0.0
+_flush_lock = threading.Lock()
+
+
+def record_command(verb: str, seconds: float, bytes_sent: int, bytes_received: int, response_size: int):
+    """
+    Records one IMAP command, from when it was sent until its tagged response arrived.
+    """
+    sample = Command(verb, time.time() - seconds, seconds, bytes_sent, bytes_received, response_size)
+
+    with _lock:
+        _commands.append(sample)
+        _command_totals[verb] = _add(_command_totals.get(verb), seconds, bytes_sent, bytes_received, response_size)
+
+    _changed()
+
+
+def record_phase(name: str, seconds: float):
+    sample = Phase(name, time.time() - seconds, seconds)
+
+    with _lock:
+        _phases.append(sample)
+        _phase_totals[name] = _add(_phase_totals.get(name), seconds)
+
+    _changed()
+
+
+@contextlib.contextmanager
+def phase(name: str):
+    """
+    Times the enclosed block as one run of the phase `name`, whether or not it raises.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(name, time.perf_counter() - started)
+
+
+def timed(name: str):
+    """
+    Decorates a function or coroutine function so that every call is timed as a run of the phase
+    `name`.
+    """
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapped(*args, **kwargs):
+                with phase(name):
+                    return await fn(*args, **kwargs)
+        else:
+            @functools.wraps(fn)
+            def wrapped(*args, **kwargs):
+                with phase(name):
+                    return fn(*args, **kwargs)
+
+        return wrapped
+
+    return decorator
+
+
+def _add(totals: Totals | None, seconds: float, bytes_sent: int = 0, bytes_received: int = 0, response_size: int = 0) -> Totals:
+    if totals is None:
+        return Totals(1, seconds, bytes_sent, bytes_received, response_size)
+
+    return Totals(
+        totals.count + 1, totals.seconds + seconds, totals.bytes_sent + bytes_sent,
+        totals.bytes_received + bytes_received, totals.response_size + response_size
+    )
+
+
+def commands() -> list[Command]:
+    """
+    Returns the most recent commands, oldest first.
+    """
+    with _lock:
+        return list(_commands)
+
+
+def phases() -> list[Phase]:
+    with _lock:
+        return list(_phases)
+
+
+def command_totals() -> dict[str, Totals]:
+    """
+    Returns the totals of every command verb since startup (or the last reset).
+    """
+    with _lock:
+        return dict(_command_totals)
+
+
+def phase_totals() -> dict[str, Totals]:
+    with _lock:
+        return dict(_phase_totals)
+
+
+def summary() -> str:
+    """
+    A one-line summary of the IMAP traffic so far, e.g. for a status bar.
+    """
+    with _lock:
+        count = sum(totals.count for totals in _command_totals.values())
+        seconds = sum(totals.seconds for totals in _command_totals.values())
+        received = sum(totals.bytes_received for totals in _command_totals.values())
+
+    if not count:
+        return ""
+
+    return "%d commands, %s received, %.0f ms average" % (count, util.format_size(received), seconds / count * 1000)
+
+
+def snapshot() -> dict[str, typing.Any]:
+    """
+    Everything recorded so far, in a form that can be written as JSON.
+    """
+    with _lock:
+        return {
+            "updated": time.time(),
+            "commands": {verb: totals._asdict() for verb, totals in _command_totals.items()},
+            "phases": {name: totals._asdict() for name, totals in _phase_totals.items()},
+            "recent_commands": [sample._asdict() for sample in _commands],
+            "recent_phases": [sample._asdict() for sample in _phases]
+        }
+
+
+def flush(path: str = METRICS_PATH):
+    """
+    Writes the snapshot to `path`, replacing the previous one in a single step so that readers never
+    see a partial file.
+    """
+    temporary = path + ".tmp"
+    with open(temporary, "w", encoding="utf-8") as metrics_file:
+        json.dump(snapshot(), metrics_file)
+
+    os.replace(temporary, path)
+
+
+def export_to(path: str | None = METRICS_PATH):
+    """
+    Keeps the file at `path` up to date with the snapshot, rewriting it at most every FLUSH_INTERVAL
+    while samples come in. None stops exporting.
+    """
+    global _export_path
+    _export_path = path
+
+
+def add_listener(listener: Listener):
+    """
+    Has `listener` called, on whichever thread recorded it, after every new sample.
+    """
+    with _lock:
+        _listeners.append(listener)
+
+
+def remove_listener(listener: Listener):
+    with _lock:
+        if listener in _listeners:
+            _listeners.remove(listener)
+
+
+def reset():
+    global _last_flush
+
+    with _lock:
+        _commands.clear()
+        _phases.clear()
+        _command_totals.clear()
+        _phase_totals.clear()
+        _last_flush = 0.0
+
+
+def _changed():
+    global _last_flush
+
+    with _lock:
+        listeners = list(_listeners)
+
+    for listener in listeners:
+        listener()
+
+    # At most one thread writes the file, at most every FLUSH_INTERVAL; the others carry on.
+    path = _export_path
+    now = time.monotonic()
+    if path and now - _last_flush >= FLUSH_INTERVAL and _flush_lock.acquire(blocking=False):
+        try:
+            _last_flush = now
+            flush(path)
+        except OSError:
+            pass
+        finally:
+            _flush_lock.release()
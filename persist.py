@@ -1,6 +1,8 @@
 import json
 import os
 import re
+import sqlite3
+import threading
 import time
 import typing
 import warnings
@@ -10,41 +12,124 @@ from config import USER_CACHE_DIR
 
 VALID_KEY_RE = r'^[a-zA-Z0-9_\-]+$'
 
+CACHE_DB_PATH = os.path.join(USER_CACHE_DIR, "cache.sqlite3")
 
-def setvalue(key: str, value: typing.Any):
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    modified REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS items (
+    key TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    item TEXT NOT NULL,
+    modified REAL NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (key, scope, item)
+);
+"""
+
+# one connection shared by every thread; sqlite3 serializes access to it, the lock keeps each
+# caller's statements in their own transaction
+_connection: sqlite3.Connection | None = None
+_lock = threading.RLock()
+
+
+def _connect() -> sqlite3.Connection:
+    global _connection
+
+    if _connection is None:
+        connection = sqlite3.connect(CACHE_DB_PATH, check_same_thread=False)
+        # with WAL, a crash mid-write leaves the previous state intact and readers don't block writers
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(SCHEMA)
+        _connection = connection
+
+    return _connection
+
+
+def _validate_key(key: str):
     if not re.match(VALID_KEY_RE, key):
         raise ValueError("key must contain only alphanumeric characters, underscores, and hyphens.")
 
-    entry_data = {
-        "modified": time.time(),
-        "data": value
-    }
 
-    with open(os.path.join(USER_CACHE_DIR, "cache-%s.json" % key), "w", encoding="utf-8") as fp:
-        json.dump(entry_data, fp)
+def _decode(key: str, data: str) -> typing.Any | None:
+    try:
+        return json.loads(data)
+    except json.decoder.JSONDecodeError:
+        warnings.warn("Cache entry for key '%s' exists, but the data is not valid JSON." % key)
+        return None
+
+
+def setvalue(key: str, value: typing.Any):
+    _validate_key(key)
+
+    with _lock, _connect() as connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO entries (key, modified, data) VALUES (?, ?, ?)",
+            (key, time.time(), json.dumps(value))
+        )
 
 
 def getvalue(key: str, expire_at: int | None = None) -> typing.Any | None:
-    try:
-        with open(os.path.join(USER_CACHE_DIR, "cache-%s.json" % key), "r", encoding="utf-8") as fp:
-            cache_entry = json.load(fp)
-        
-        if not expire_at:
-            return cache_entry["data"]
-        else:
-            if cache_entry["modified"] >= expire_at:
-                return None
-            else:
-                return cache_entry["data"]
-    except FileNotFoundError:
+    _validate_key(key)
+
+    with _lock:
+        row = _connect().execute("SELECT modified, data FROM entries WHERE key = ?", (key,)).fetchone()
+
+    if row is None:
         return None
-    except (json.decoder.JSONDecodeError, KeyError, TypeError) as exc:
-        warnings.warn("Cache entry for key '%s' exists, but the data is malformed. This could mean the data is not valid JSON, does not have the expected keys, or contains an invalid "
-                      "'modified' value.")
+
+    modified, data = row
+    if expire_at and modified >= expire_at:
         return None
 
+    return _decode(key, data)
+
+
+def getitems(key: str, scope: str) -> dict[str, typing.Any]:
+    """
+    Returns every item stored under `key` for `scope` (e.g. an account), keyed by item name.
+    """
+    _validate_key(key)
+
+    with _lock:
+        rows = _connect().execute("SELECT item, data FROM items WHERE key = ? AND scope = ?", (key, scope)).fetchall()
+
+    return {item: _decode(key, data) for item, data in rows}
+
+
+def setitems(key: str, scope: str, values: dict[str, typing.Any], removed: typing.Iterable[str] = (), replace: bool = False):
+    """
+    Stores `values` and deletes the `removed` items in one transaction, leaving every other item
+    of the scope untouched unless `replace` is set.
+    """
+    _validate_key(key)
+
+    modified = time.time()
+    with _lock, _connect() as connection:
+        if replace:
+            connection.execute("DELETE FROM items WHERE key = ? AND scope = ?", (key, scope))
+        else:
+            connection.executemany(
+                "DELETE FROM items WHERE key = ? AND scope = ? AND item = ?",
+                ((key, scope, item) for item in removed)
+            )
+
+        connection.executemany(
+            "INSERT OR REPLACE INTO items (key, scope, item, modified, data) VALUES (?, ?, ?, ?, ?)",
+            ((key, scope, item, modified, json.dumps(value)) for item, value in values.items())
+        )
+
 
 def clear_all():
+    with _lock, _connect() as connection:
+        connection.execute("DELETE FROM entries")
+        connection.execute("DELETE FROM items")
+
+    # entries from before the cache moved to SQLite
     values = os.listdir(USER_CACHE_DIR)
     for item in map(lambda value: os.path.join(USER_CACHE_DIR, value), values):
         if os.path.isfile(item) and item.endswith(".json"):
@@ -0,0 +1,26 @@
+import unittest
+
+from api.index import SenderIndex
+
+
+def messages(sender: str, *uids: int) -> list[SenderIndex.Message]:
+    return [SenderIndex.Message(uid, sender, 100, uid) for uid in uids]
+
+
+class SenderIndexTest(unittest.TestCase):
+    def test_uid_sent_again_out_of_order_replaces_the_first(self):
+        index = SenderIndex(1)
+        index.update(messages("a", 1, 2, 5))
+        index.update(messages("b", 4))  # out of order, after UID 5
+        index.update(messages("c", 4))  # e.g. rescanned under a changed sender
+
+        self.assertEqual(index.uids_for(["b"]), set())
+        self.assertEqual(index.uids_for(["c"]), {4})
+        self.assertEqual(index.senders, {"a", "c"})
+        self.assertEqual(index.stats()["c"].count, 1)
+        self.assertEqual(sum(stats.count for stats in index.stats().values()), 4)
+        self.assertEqual(index.message_count, 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from api.index import SenderIndex
+from api.service import CleanserService
+from benchmarks.imapserver import FakeIMAPServer, SyntheticAccount
+from benchmarks.service import LocalIMAP
+
+
+class SyncSendersTest(unittest.TestCase):
+    def setUp(self):
+        self.account = SyntheticAccount(messages=40, senders=5)
+        # the most common sender has a From field that parses to no address
+        self.account.sender_headers[0] = b"From: undisclosed-recipients:;\r\n"
+
+        self.server = FakeIMAPServer(self.account)
+        self.loop = asyncio.new_event_loop()
+        port = self.loop.run_until_complete(self.server.start())
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+        self.client = LocalIMAP("127.0.0.1", port)
+        self.client.authenticate()
+        self.service = CleanserService(self.client)
+
+    def tearDown(self):
+        self.client.logout()
+        asyncio.run_coroutine_threadsafe(self.server.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def test_unparseable_senders_keep_the_index_complete(self):
+        inbox = self.account.mailbox("INBOX")
+        index = self.service.sync_senders(SenderIndex(), "INBOX")
+
+        self.assertEqual(index.message_count, len(inbox))
+        self.assertNotIn(SenderIndex.UNKNOWN_SENDER, index.senders)
+        self.assertNotIn(SenderIndex.UNKNOWN_SENDER, index.stats())
+
+        def append(sender: int):
+            self.loop.call_soon_threadsafe(inbox.append, sender, 1000, time.time())
+
+        append(0)
+        append(1)
+        asyncio.run_coroutine_threadsafe(asyncio.sleep(0), self.loop).result()
+        self.server.stats.reset()
+
+        index = self.service.sync_senders(index, "INBOX")
+
+        self.assertEqual(index.message_count, len(inbox))
+        self.assertEqual(self.server.stats.commands["UID SEARCH"], 0)
+        self.assertEqual(index.highest_uid, inbox.uidnext - 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,8 @@
 import configparser
 import functools
 import imaplib
+import importlib.util
 import logging
-import json
 import os
 import sys
 import tkinter
@@ -10,11 +10,11 @@ import tkinter.ttk as ttk
 import tkinter.messagebox
 import typing
 import uuid
-import warnings
 
-from api import CleanserService, GenericIMAP, service_factory
+from api import CleanserService, GenericIMAP, SenderIndex, service_factory
 from . import concurrency
 import config
+import metrics
 import persist
 from .auth import AuthenticationOptions
 from .selector import Selector
@@ -27,6 +27,7 @@ logging.getLogger().addHandler(logging.StreamHandler())
 
 class MenuActions:
     class File:
+        REFRESH = "Refresh Senders"
         CACHE_CLEAR = "Clear Cached Data"
         PREFERENCES = "Preferences"
         EXIT = "Exit"
@@ -38,6 +39,7 @@ class MenuActions:
 
 
     NONTRIVIAL_ACTIONS = [
+        ("file", File.REFRESH),
         ("file", File.CACHE_CLEAR),
         ("file", File.PREFERENCES),
         ("user", User.ADD_ACCOUNT),
@@ -49,6 +51,7 @@ class MenuActions:
 class MainApplication(ttk.Frame):
     selector: Selector
     status: ttk.Label
+    __metrics: ttk.Label
 
     __settings: dict[str, str | None]
 
@@ -71,7 +74,7 @@ class MainApplication(ttk.Frame):
                 "active": None
             }
         )
-        self.service_config["version"] = service_config.get("version", "1")
+        self.service_config["version"] = service_config.get("version", "1") if service_config else service_factory.CONFIG_VERSION
         self.__settings = settings
         self.__running = tkinter.BooleanVar(value=True)
         self.__menus = {}
@@ -81,8 +84,15 @@ class MainApplication(ttk.Frame):
     def __setup_ui(self):
         container = ttk.Frame(self)
 
-        self.status = ttk.Label(container, text="Setting up...", anchor='w', style="Padded.TLabel")
-        self.status.pack(side=tkinter.BOTTOM, fill=tkinter.X, padx=5)
+        status_bar = ttk.Frame(container)
+        self.status = ttk.Label(status_bar, text="Setting up...", anchor='w', style="Padded.TLabel")
+        self.__metrics = ttk.Label(status_bar, anchor='e', style="Padded.TLabel", foreground="gray40")
+        self.__metrics.pack(side=tkinter.RIGHT, padx=5)
+        self.status.pack(side=tkinter.LEFT, fill=tkinter.X, expand=tkinter.YES, padx=5)
+        status_bar.pack(side=tkinter.BOTTOM, fill=tkinter.X)
+
+        # commands are recorded on worker threads; the label is redrawn at most once per frame
+        metrics.add_listener(lambda: concurrency.post(self.__show_metrics, key=self.__metrics))
 
         self.selector = Selector(container)
         self.selector.bind("<<Status>>", self.on_selector_status)
@@ -94,6 +104,7 @@ class MainApplication(ttk.Frame):
         self.__menubar = menu_bar = tkinter.Menu(self.master)
         file_menu = tkinter.Menu(menu_bar, tearoff=0)
         user_menu = tkinter.Menu(menu_bar, tearoff=0)
+        file_menu.add_command(label=MenuActions.File.REFRESH, command=self.refresh_senders)
         file_menu.add_command(label=MenuActions.File.CACHE_CLEAR, command=functools.partial(
             self.confirm,
             "Confirm Cache Clear",
@@ -159,8 +170,8 @@ class MainApplication(ttk.Frame):
             self.set_client(client)
             self.selector.set_enabled(True)
             initialize_task = concurrency.DeferredTask(self.initialize)
-            initialize_task.then(functools.partial(concurrency.main, self.__menubar.entryconfig, "File", state=tkinter.NORMAL))
-            initialize_task.then(functools.partial(concurrency.main, self.__menubar.entryconfig, "User", state=tkinter.NORMAL))
+            initialize_task.then(functools.partial(concurrency.post, self.__menubar.entryconfig, "File", state=tkinter.NORMAL))
+            initialize_task.then(functools.partial(concurrency.post, self.__menubar.entryconfig, "User", state=tkinter.NORMAL))
             initialize_task.run()
         else:
             self.__menubar.entryconfig("File", state=tkinter.NORMAL)
@@ -172,6 +183,9 @@ class MainApplication(ttk.Frame):
         except FileNotFoundError:
             pass
 
+        if self.__service:
+            self.__service.close()
+
         if self.__client:
             try:
                 self.__client.logout()
@@ -182,6 +196,7 @@ class MainApplication(ttk.Frame):
         self.__client = None
         self.__service = None
         self.selector.service = None
+        self.selector.index = None
 
         self.__menus["user"].entryconfig(MenuActions.User.ADD_ACCOUNT, state=tkinter.NORMAL)
         self.__menus["user"].entryconfig(MenuActions.User.SIGN_OUT, state=tkinter.DISABLED)
@@ -200,52 +215,46 @@ class MainApplication(ttk.Frame):
         new_settings = dialog.get_new_settings()
         if new_settings:
             self.__service.junk_folder = new_settings["junk_folder"]
+            self.__service.connections = int(new_settings["connections"])
             self.__settings = new_settings
 
             writer = configparser.ConfigParser()
             writer[configparser.DEFAULTSECT] = new_settings
             
             try:
-                with open(os.path.join(config.USER_CONFIG_DIR, "settings.ini"), "w") as fp:
+                with open(config.SETTINGS_FILE, "w") as fp:
                     writer.write(fp)
             except IOError:
                 tkinter.messagebox.showerror("Error", "Could not save preferences.")
 
     def set_client(self, client: GenericIMAP):
         self.__client = client
-        self.__service = CleanserService(self.__client, junk_folder=self.__settings.get("junk_folder"))
+        self.__service = CleanserService(
+            self.__client, junk_folder=self.__settings.get("junk_folder"), connections=int(self.__settings.get("connections") or 1)
+        )
         self.selector.service = self.__service
     
     def on_selector_status(self, _):
         self.set_status(self.selector.status)
     
-    def load_unique_senders(self, use_cache: bool = True) -> set[str]:
-        unique_senders_store = persist.getvalue("unique-senders")  # even if not using cache, we will need to merge with this existing value
-        if not unique_senders_store:
-            unique_senders_store = {}
-
-        if use_cache:
-            if unique_senders_store:
-                unique_senders = unique_senders_store.get(self.__client.user)
-            else:
-                unique_senders = None
-            
-            if unique_senders:
-                return set(unique_senders)
+    def load_unique_senders(self, use_cache: bool = True, on_senders: typing.Callable[[list[str]], None] | None = None) -> SenderIndex:
+        index = SenderIndex.load(self.__client.user) if use_cache else SenderIndex()
+        if on_senders is not None and index.message_count:
+            # cached senders can be shown right away, while checking for new mail
+            on_senders(list(index.senders))
 
-        unique_senders = self.__service.get_unique_senders()
-        unique_senders_store[self.__client.user] = list(unique_senders)
-        
-        persist.setvalue("unique-senders", unique_senders_store)
+        # with a valid cached index, this only fetches messages that arrived since the last sync
+        self.__service.sync_senders(index, on_senders=on_senders)
+        index.save(self.__client.user)
 
-        return unique_senders
-    
-    def populate_unique_senders(self, senders: set[str]):
-        self.selector.clear_senders()
-        self.selector.populate_senders(sorted(senders, key=lambda x: x.lower()))
+        return index
     
+    def __show_metrics(self):
+        self.__metrics.configure(text=metrics.summary())
+
     def set_status(self, status: str):
-        concurrency.main(self.status.configure, text=status)
+        # only the latest status is worth drawing
+        concurrency.post(self.status.configure, text=status, key=self.status)
     
     def setup_imap_and_load_data(self):
         self.set_status("Connecting...")
@@ -254,13 +263,13 @@ class MainApplication(ttk.Frame):
             imap_service = service_factory.create_service(self.service_config, debug=self.__debug)
         except GenericIMAP.OperationError as err:
             self.set_status("Failed to connect to IMAP server.")
-            concurrency.main(self.__menus["user"].entryconfigure, MenuActions.User.ADD_ACCOUNT, state=tkinter.NORMAL)
+            concurrency.post(self.__menus["user"].entryconfigure, MenuActions.User.ADD_ACCOUNT, state=tkinter.NORMAL)
             concurrency.main(tkinter.messagebox.showerror, "Setup Error", str(err))
             return
         
         if not imap_service:
             self.set_status("Not logged in.")
-            concurrency.main(self.__menus["user"].entryconfigure, MenuActions.User.ADD_ACCOUNT, state=tkinter.NORMAL)
+            concurrency.post(self.__menus["user"].entryconfigure, MenuActions.User.ADD_ACCOUNT, state=tkinter.NORMAL)
             concurrency.main(self.sign_in)
             return
 
@@ -279,9 +288,10 @@ class MainApplication(ttk.Frame):
         # Google credentials were refreshed during the construction
         service_factory.save_service_config(self.service_config)
         self.set_client(imap_service)
+        imap_service.verify_saved_user()
         
         self.initialize()
-        concurrency.main(self.__menus["user"].entryconfigure, MenuActions.User.SIGN_OUT, state=tkinter.NORMAL)
+        concurrency.post(self.__menus["user"].entryconfigure, MenuActions.User.SIGN_OUT, state=tkinter.NORMAL)
 
     def initialize(self):
         self.set_status("Authenticating...")
@@ -290,16 +300,23 @@ class MainApplication(ttk.Frame):
         self.load_and_populate_unique_senders()
         self.set_status("Done.")
         
-        concurrency.main(self.__menus["user"].entryconfigure, MenuActions.User.ADD_ACCOUNT, state=tkinter.DISABLED)
-        concurrency.main(self.__menus["user"].entryconfigure, MenuActions.User.SIGN_OUT, state=tkinter.NORMAL)
+        concurrency.post(self.__menus["user"].entryconfigure, MenuActions.User.ADD_ACCOUNT, state=tkinter.DISABLED)
+        concurrency.post(self.__menus["user"].entryconfigure, MenuActions.User.SIGN_OUT, state=tkinter.NORMAL)
     
     def load_and_populate_unique_senders(self):
-        senders = self.load_unique_senders()
-        concurrency.main(self.populate_unique_senders, senders)
+        concurrency.main(self.selector.start_loading)
+
+        index = None
+        try:
+            index = self.load_unique_senders(on_senders=self.selector.add_senders)
+        finally:
+            concurrency.main(self.selector.finish_loading, index)
 
     def cache_clear(self):
         persist.clear_all()
+        self.refresh_senders()
 
+    def refresh_senders(self):
         if self.__service:
             self.disable_actions()
 
@@ -345,38 +362,36 @@ class MainApplication(ttk.Frame):
         return self.__running
 
 
-def _patch_nones(settings: dict[str, str]) -> dict[str, str | None]:
-    output = {}
-    for key, value in settings.items():
-        output[key] = None if value == "" else value
-    
-    return output
+THEME = "scidgreen"
 
 
-def main():
-    import tkinter.ttk as ttk
-    import ttkthemes
-
-    parser = configparser.ConfigParser()
-    successful = parser.read(os.path.join(config.USER_CONFIG_DIR, "settings.ini"))
-    if len(successful) < 0:
-        settings = config.SETTINGS_DEFAULTS.copy()
-    else:
-        settings = config.SETTINGS_DEFAULTS | dict(parser.items(configparser.DEFAULTSECT))
-    
-    settings = _patch_nones(settings)
+def create_root() -> tkinter.Tk:
+    """
+    Creates the main window in the app's theme. The scid themes are plain Tcl, so they are loaded
+    from ttkthemes' files directly: importing ttkthemes would also import Pillow, which they don't
+    need, before the window can appear.
+    """
+    root = tkinter.Tk()
 
+    spec = importlib.util.find_spec("ttkthemes")
     try:
-        with open(service_factory.SERVICE_CONFIG_FILE, "r") as fp:
-            service_config = json.load(fp)
-    except FileNotFoundError:
-        warnings.warn("Service configuration file does not exist.")
-        service_config = None
-    except json.decoder.JSONDecodeError:
-        warnings.warn("Service configuration file exists, but is not valid JSON.")
-        service_config = None
-
-    root = ttkthemes.ThemedTk(theme="scidgreen")
+        if spec is None or not spec.submodule_search_locations:
+            raise tkinter.TclError("ttkthemes is not installed")
+
+        root.tk.call("source", os.path.join(spec.submodule_search_locations[0], "png", "pkgIndex.tcl"))
+        root.tk.call("package", "require", "ttk::theme::scid")
+        root.tk.call("ttk::setTheme", THEME)
+    except tkinter.TclError:
+        import ttkthemes
+
+        ttkthemes.ThemedStyle(root).set_theme(THEME)
+
+    return root
+
+
+def create_window(settings: dict[str, str | None], service_config: dict[str, typing.Any] | None,
+                  debug: bool = False) -> tuple[tkinter.Tk, MainApplication]:
+    root = create_root()
     root.wm_title("purgetool")
     root.geometry("400x450")
 
@@ -385,9 +400,7 @@ def main():
     style.configure("TButton", font=("Roboto", 10))
     style.configure("Large.TButton", font=("Roboto", 14))
 
-    debug_mode = "--debug" in sys.argv
-
-    app = MainApplication(root, settings, service_config=service_config, debug=debug_mode)
+    app = MainApplication(root, settings, service_config=service_config, debug=debug)
     
     app.pack(fill=tkinter.BOTH, expand=tkinter.YES)
     
@@ -396,11 +409,28 @@ def main():
     root.update()
     root.after(1, root.deiconify)
 
+    return root, app
+
+
+def main():
+    settings = config.load_settings()
+    service_config = service_factory.load_service_config()
+
+    root, app = create_window(settings, service_config, debug="--debug" in sys.argv)
+
+    concurrency.install(root)
+    metrics.export_to(metrics.METRICS_PATH)
+
     deferred = concurrency.DeferredTask(app.setup_imap_and_load_data)
     deferred.run()
 
     root.protocol("WM_DELETE_WINDOW", app.try_quit)
-    while app.running.get():
-        concurrency.update_app(root)
+    app.running.trace_add("write", lambda *_: app.running.get() or root.quit())
+    root.mainloop()
     
     root.destroy()
+
+    try:
+        metrics.flush()
+    except OSError:
+        logging.exception("Could not write the metrics file")
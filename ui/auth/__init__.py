@@ -1,3 +1,5 @@
+from __future__ import annotations
+
 import enum
 import functools
 import tkinter
@@ -5,9 +7,6 @@ import tkinter.ttk as ttk
 import tkinter.messagebox
 import typing
 
-from PIL import Image, ImageTk
-
-import auth.google
 from api import imap, service_factory
 import config
 import context
@@ -15,6 +14,9 @@ from ui import concurrency
 
 from .manual_imap import ManualIMAPDialog
 
+if typing.TYPE_CHECKING:
+    from PIL import ImageTk
+
 
 class AuthenticationType(enum.StrEnum):
     GOOGLE = "google"
@@ -41,6 +43,9 @@ class AuthenticationOptions(tkinter.Toplevel):
         self.title("Sign In")
         self.protocol("WM_DELETE_WINDOW", self.__close_win)
 
+        # Pillow is only needed once this dialog opens, not to start the app
+        from PIL import Image, ImageTk
+
         google_icon = Image.open(context.get_resource("google_icon.png"))
         google_icon = google_icon.resize((32, 32))
 
@@ -91,6 +96,8 @@ class AuthenticationOptions(tkinter.Toplevel):
             button.configure(state=tkinter.NORMAL if enabled else tkinter.DISABLED)
 
     def __google_auth(self) -> bool:
+        import auth.google
+
         try:
             google_creds = auth.google.run_authorization_flow()
         except auth.google.AuthorizationError as err:
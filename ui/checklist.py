@@ -1,82 +1,257 @@
+import heapq
 import tkinter
+import tkinter.font
 import tkinter.ttk as ttk
 import typing
 
+import metrics
+
 
-# Took inspiration from https://stackoverflow.com/questions/68036371/tkinter-canvas-scroll-slow-rendering
-# in order to provide comfortable scrolling behavior.
 class Checklist(tkinter.Frame):
-    _items: list[tuple[tkinter.Checkbutton, tkinter.BooleanVar]]
+    """
+    A scrollable list of checkable items. Only the rows in view are drawn, on a canvas, and the check
+    state is kept as a set of items that differ from a select-all flag, so the cost of populating,
+    scrolling or (de)selecting everything doesn't grow with the number of items.
+    """
+
+    _items: list[str]
+    _details: list[str | None]
+    _positions: dict[str, int]  # item -> row
+    _toggled: set[str]  # items whose state differs from __all_checked
+    __all_checked: bool
     __enabled: bool
 
-    _scroll_window: tkinter.Text
-    _vscroll: tkinter.Scrollbar
+    __top: int
+    __row_height: int
+    __redraw_pending: bool
+
+    _canvas: tkinter.Canvas
+    _vscroll: ttk.Scrollbar
+    __font: tkinter.font.Font
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._items = []
+        self._details = []
+        self._positions = {}
+        self._toggled = set()
+        self.__all_checked = False
         self.__enabled = True
 
+        self.__top = 0
+        self.__redraw_pending = False
+
         self.__setup_ui()
-    
+
     def __setup_ui(self):
-        self._scroll_window = tkinter.Text(self, state="disabled", cursor="arrow")
-        self._vscroll = ttk.Scrollbar(self, orient=tkinter.VERTICAL)
+        self.__font = tkinter.font.nametofont("TkDefaultFont")
+        self.__row_height = self.__font.metrics("linespace") + 8
 
-        self._scroll_window.bind_all("<MouseWheel>", self.handle_mousewheel)
-        self._scroll_window.config(yscrollcommand=self._vscroll.set)
+        self._canvas = tkinter.Canvas(self, bg="white", highlightthickness=0, cursor="arrow")
+        self._vscroll = ttk.Scrollbar(self, orient=tkinter.VERTICAL, command=self.yview)
 
-        self._vscroll.config(command=self._scroll_window.yview)
+        self._canvas.bind_all("<MouseWheel>", self.handle_mousewheel)
+        self._canvas.bind("<Button-4>", lambda _: self.yview("scroll", -1, "units"))
+        self._canvas.bind("<Button-5>", lambda _: self.yview("scroll", 1, "units"))
+        self._canvas.bind("<Button-1>", self.__handle_click)
+        self._canvas.bind("<Configure>", lambda _: self.__schedule_redraw())
 
         self._vscroll.pack(side=tkinter.RIGHT, fill=tkinter.BOTH)
-        self._scroll_window.pack(side=tkinter.LEFT, fill=tkinter.BOTH, expand=tkinter.YES)
-    
+        self._canvas.pack(side=tkinter.LEFT, fill=tkinter.BOTH, expand=tkinter.YES)
+
     def handle_mousewheel(self, event):
-        self._scroll_window.yview_scroll(int(-event.delta / abs(event.delta)), "units")
-    
-    def append(self, item: str):
-        is_checked = tkinter.BooleanVar()
-        check = tkinter.Checkbutton(self._scroll_window, text=item, bg=self._scroll_window.cget("bg"), variable=is_checked)
-        
-        self._scroll_window.window_create("end", window=check)
-
-        self._scroll_window.config(state="normal")
-        self._scroll_window.insert("end", "\n")
-        self._scroll_window.config(state="disabled")
-        self._items.append((check, is_checked))
-    
-    def remove(self, items: typing.Container[str]):
-        to_destroy = [item[0] for item in self._items if item[0].cget("text") in items]
-        self._items = [item for item in self._items if item[0].cget("text") not in items]
-
-        self._scroll_window.configure(state="normal")
-        for check in to_destroy:
-            entry_index = self._scroll_window.index(str(check))  # the str() cast is ugly, but it gives us tkinter's name for the checkbox
-            line = entry_index.split(".")[0]
-            end_index = "%d.0" % (int(line) + 1)
-            self._scroll_window.delete(entry_index, end_index)
-        self._scroll_window.configure(state="disabled")
-    
-    def clear(self):
-        for item, _ in self._items:
-            item.destroy()
+        self.yview("scroll", int(-event.delta / abs(event.delta)), "units")
+
+    def yview(self, *args):
+        visible = self.__visible_rows()
+        max_top = max(0, len(self._items) - visible)
+
+        if args[0] == "moveto":
+            top = round(float(args[1]) * len(self._items))
+        elif args[0] == "scroll":
+            step = visible if args[2] == "pages" else 3
+            top = self.__top + int(args[1]) * step
+        else:
+            return
+
+        self.__top = max(0, min(top, max_top))
+        self.__schedule_redraw()
+
+    def append(self, item: str, detail: str | None = None, checked: bool = False):
+        row = self._positions.get(item)
+        if row is None:
+            self._positions[item] = len(self._items)
+            self._items.append(item)
+            self._details.append(detail)
+        else:
+            self._details[row] = detail
+
+        self.__set_checked(item, checked)
+        self.__schedule_redraw()
+
+    def merge(self, entries: typing.Iterable[tuple[str, str | None]], key: typing.Callable[[str], typing.Any], reverse: bool = False):
+        """
+        Inserts (item, detail) pairs into a list that is already ordered by `key`, keeping it
+        ordered. Only the rows from the first insertion point onwards are moved and re-indexed.
+        """
+        new = sorted((entry for entry in entries if entry[0] not in self._positions), key=lambda entry: key(entry[0]), reverse=reverse)
+        if not new:
+            return
+
+        for item, _ in new:
+            self.__set_checked(item, False)
+
+        # the first row that sorts after the first new entry
+        first_key = key(new[0][0])
+        low, high = 0, len(self._items)
+        while low < high:
+            middle = (low + high) // 2
+            middle_key = key(self._items[middle])
+            if (middle_key < first_key) if reverse else (middle_key > first_key):
+                high = middle
+            else:
+                low = middle + 1
+
+        tail = list(zip(self._items[low:], self._details[low:]))
+        del self._items[low:]
+        del self._details[low:]
+        for row, (item, detail) in enumerate(heapq.merge(tail, new, key=lambda entry: key(entry[0]), reverse=reverse), low):
+            self._items.append(item)
+            self._details.append(detail)
+            self._positions[item] = row
+
+        self.__schedule_redraw()
+
+    def remove(self, items: typing.Iterable[str]):
+        """
+        Removes every one of `items` that is in the list. Only the rows from the first removed one
+        onwards are moved and re-indexed.
+        """
+        removed = {item for item in items if item in self._positions}
+        if not removed:
+            return
+
+        first = min(self._positions[item] for item in removed)
+        kept = [(item, detail) for item, detail in zip(self._items[first:], self._details[first:]) if item not in removed]
+
+        del self._items[first:]
+        del self._details[first:]
+        for row, (item, detail) in enumerate(kept, first):
+            self._items.append(item)
+            self._details.append(detail)
+            self._positions[item] = row
+
+        for item in removed:
+            del self._positions[item]
+        self._toggled -= removed
+
+        self.__schedule_redraw()
 
-        self._scroll_window.configure(state=tkinter.NORMAL)
-        self._scroll_window.delete("1.0", "end")
-        self._scroll_window.configure(state=tkinter.DISABLED)
+    def clear(self):
         self._items = []
-    
+        self._details = []
+        self._positions = {}
+        self._toggled = set()
+        self.__all_checked = False
+        self.__top = 0
+        self.__schedule_redraw()
+
+    def set_all_checked(self, checked: bool):
+        self.__all_checked = checked
+        self._toggled = set()
+        self.__schedule_redraw()
+
     def get_checked(self) -> set[str]:
-        return {button.cget("text") for button, is_checked in self._items if is_checked.get()}
-    
+        if self.__all_checked:
+            return {item for item in self._items if item not in self._toggled}
+        return set(self._toggled)
+
     def get_items(self) -> set[str]:
-        return {button.cget("text") for button, _ in self._items}
-    
+        return set(self._items)
+
+    def see(self, item: str):
+        """
+        Scrolls the list so `item` is in view.
+        """
+        row = self._positions.get(item)
+        if row is None:
+            return
+
+        visible = self.__visible_rows()
+        if row < self.__top:
+            self.__top = row
+        elif row >= self.__top + visible:
+            self.__top = row - visible + 1
+        self.__schedule_redraw()
+
+    def __contains__(self, item: str) -> bool:
+        return item in self._positions
+
+    def is_checked(self, item: str) -> bool:
+        return (item in self._toggled) != self.__all_checked
+
     def set_enabled(self, enabled: bool):
         self.__enabled = enabled
-        for check in map(lambda x: x[0], self._items):
-            check.configure(state='normal' if enabled else 'disabled')
+        self.__schedule_redraw()
+
+    def __set_checked(self, item: str, checked: bool):
+        if checked != self.__all_checked:
+            self._toggled.add(item)
+        else:
+            self._toggled.discard(item)
+
+    def __handle_click(self, event):
+        if not self.__enabled:
+            return
+
+        row = self.__top + int(self._canvas.canvasy(event.y)) // self.__row_height
+        if row < len(self._items):
+            item = self._items[row]
+            self.__set_checked(item, not self.is_checked(item))
+            self.__schedule_redraw()
+
+    def __visible_rows(self) -> int:
+        return max(1, self._canvas.winfo_height() // self.__row_height)
+
+    def __schedule_redraw(self):
+        # many changes in a row (e.g. appending every sender) are drawn once, when Tk is next idle
+        if not self.__redraw_pending:
+            self.__redraw_pending = True
+            self.after_idle(self.__redraw)
+
+    @metrics.timed("draw")
+    def __redraw(self):
+        self.__redraw_pending = False
+
+        canvas = self._canvas
+        canvas.delete("all")
+
+        total = len(self._items)
+        visible = self.__visible_rows()
+        self.__top = max(0, min(self.__top, total - visible))
+
+        foreground = "black" if self.__enabled else "gray60"
+        box = self.__row_height - 12
+        for position, row in enumerate(range(self.__top, min(total, self.__top + visible + 1))):
+            item = self._items[row]
+            y = position * self.__row_height + 6
+
+            canvas.create_rectangle(6, y, 6 + box, y + box, outline=foreground, fill="white")
+            if self.is_checked(item):
+                canvas.create_line(8, y + box // 2, 5 + box // 2, y + box - 3, 4 + box, y + 2, fill=foreground, width=2)
+
+            text_x = 14 + box
+            label = canvas.create_text(text_x, y + box // 2, text=item, anchor="w", font=self.__font, fill=foreground)
+
+            detail = self._details[row]
+            if detail:
+                detail_x = canvas.bbox(label)[2] + 10
+                canvas.create_text(detail_x, y + box // 2, text=detail, anchor="w", font=self.__font, fill="gray40")
 
+        if total:
+            self._vscroll.set(self.__top / total, min(1.0, (self.__top + visible) / total))
+        else:
+            self._vscroll.set(0.0, 1.0)
 
     @property
     def enabled(self) -> bool:
@@ -1,16 +1,29 @@
 from __future__ import annotations
 
+import collections
+import concurrent.futures
 import functools
 import inspect
+import logging
+import os
+import queue
 import threading
 import time
 import tkinter
-from typing import Any, Callable
+from typing import Any, Callable, Hashable
+
+import util
 
 
 _completed_lock = threading.Lock()
 completed = []
 
+# how often the queues are checked where Tk can't watch a wakeup pipe (i.e. on Windows)
+POLL_INTERVAL_MS = 10
+
+_root: tkinter.Tk | None = None
+_wakeup_fds: tuple[int, int] | None = None
+
 
 def has_positional_arg(signature: inspect.Signature) -> bool:
     viable_params = filter(lambda x: x.kind not in [inspect.Parameter.KEYWORD_ONLY, inspect.Parameter.VAR_KEYWORD], signature.parameters.values())
@@ -21,44 +34,153 @@ def has_positional_arg(signature: inspect.Signature) -> bool:
         return False
 
 
+def accepts_token(signature: inspect.Signature) -> bool:
+    parameter = signature.parameters.get("token")
+    return parameter is not None and parameter.kind in [inspect.Parameter.POSITIONAL_OR_KEYWORD, inspect.Parameter.KEYWORD_ONLY]
+
+
+class WorkerPool:
+    """
+    A bounded set of daemon threads that run submitted callables in order. Unlike
+    concurrent.futures.ThreadPoolExecutor, its threads don't hold up interpreter exit while a
+    long task (e.g. a scan) is still running when the window closes.
+    """
+
+    __size: int
+    __queue: queue.SimpleQueue
+    __threads: list[threading.Thread]
+    __lock: threading.Lock
+
+    def __init__(self, size: int):
+        self.__size = size
+        self.__queue = queue.SimpleQueue()
+        self.__threads = []
+        self.__lock = threading.Lock()
+
+    def submit(self, fn: Callable, *args, **kwargs) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        self.__queue.put((future, fn, args, kwargs))
+
+        with self.__lock:
+            # threads are started as tasks come in, up to the limit, and then reused
+            if len(self.__threads) < self.__size:
+                thread = threading.Thread(target=self.__work, name="worker-%d" % len(self.__threads), daemon=True)
+                self.__threads.append(thread)
+                thread.start()
+
+        return future
+
+    def __work(self):
+        while True:
+            future, fn, args, kwargs = self.__queue.get()
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except BaseException as exc:
+                    future.set_exception(exc)
+
+    @property
+    def size(self) -> int:
+        return self.__size
+
+
+# a handful of tasks (loading, purging, signing in) run at once; everything else waits its turn
+WORKER_THREADS = 8
+
+_pool = WorkerPool(WORKER_THREADS)
+
+
 class DeferredTask:
-    def __init__(self, executor: Callable):
+    """
+    Runs a callable on the shared worker pool, then runs the tasks added with then() once it
+    succeeds. A callable with a `token` parameter is passed the task's CancellationToken and
+    should check it between units of work; cancel() and `timeout` (counted from when the task
+    starts) both act through it.
+    """
+
+    def __init__(self, executor: Callable, timeout: float | None = None):
         self.__resolved = False
+        self.__cancelled = False
+        self.__result = None
+        self.__exception = None
 
         self.__executor = executor
+        self.__timeout = timeout
+        self.__token = util.CancellationToken()
+        self.__future = None
+        self.__done = threading.Condition()
         self.__lock = threading.Lock()
         self.__after = []
     
-    def run(self, *args):
-        t = threading.Thread(target=self._run, args=args, daemon=True)
-        t.start()
+    def run(self, *args) -> DeferredTask:
+        kwargs = {"token": self.__token} if accepts_token(inspect.signature(self.__executor)) else {}
+        self.__future = _pool.submit(self._run, *args, **kwargs)
+        return self
     
-    def _run(self, *args):
-        self.__result = self.__executor(*args)
-        self.__resolved = True
-
-        global completed
-        global _completed_lock
-        with _completed_lock:
-            completed.append(self)
+    def _run(self, *args, **kwargs):
+        if self.__timeout is not None:
+            self.__token.cancel_after(self.__timeout)
+
+        succeeded = False
+        try:
+            self.__token.raise_if_cancelled()
+            self.__result = self.__executor(*args, **kwargs)
+            succeeded = True
+        except util.CancellationToken.Cancelled:
+            self.__cancelled = True
+        except Exception as exc:
+            self.__exception = exc
+            logging.exception("Deferred task failed")
+
+        with self.__done:
+            self.__resolved = True
+            self.__done.notify_all()
+
+        if succeeded:
+            global completed
+            global _completed_lock
+            with _completed_lock:
+                completed.append(self)
+
+            _notify()
     
     def _complete(self):
-        for next_task in self.__after:
-            signature = inspect.signature(next_task.__executor)
-            if has_positional_arg(signature):
-                next_task.run(self.__result)
-            else:
-                next_task.run()
+        with self.__done:
+            after, self.__after = self.__after, None
+
+        for next_task in after:
+            next_task.__run_with(self.__result)
+
+    def __run_with(self, result):
+        if has_positional_arg(inspect.signature(self.__executor)):
+            self.run(result)
+        else:
+            self.run()
     
     def then(self, callback) -> DeferredTask:
         deferred = DeferredTask(callback)
 
-        if self.__resolved:
-            deferred.run(self.__result)
-        else:
-            self.__after.append(deferred)
+        with self.__done:
+            if self.__after is not None:
+                self.__after.append(deferred)
+                return deferred
 
+        # already completed
+        deferred.__run_with(self.__result)
         return deferred
+
+    def cancel(self):
+        """
+        Asks the task to stop. A task that hasn't started yet never will; a running one stops the
+        next time it checks its token.
+        """
+        self.__token.cancel()
+
+        if self.__future is not None and self.__future.cancel():
+            with self.__done:
+                self.__cancelled = True
+                self.__resolved = True
+                self.__done.notify_all()
     
     @property
     def result(self):
@@ -66,31 +188,36 @@ class DeferredTask:
             return self.__result
         else:
             return None
+
+    @property
+    def exception(self) -> Exception | None:
+        return self.__exception
+
+    @property
+    def cancelled(self) -> bool:
+        return self.__cancelled
+
+    @property
+    def token(self) -> util.CancellationToken:
+        return self.__token
     
     @property
     def lock(self) -> threading.Lock:
         return self.__lock
     
-    def wait(self) -> Any:
-        while not self.__resolved:
-            time.sleep(0.001)
+    def wait(self, timeout: float | None = None) -> Any:
+        with self.__done:
+            self.__done.wait_for(lambda: self.__resolved, timeout)
         
         return self.result
     
 
-main_queue = []
-task_results = {}
-_main_queue_lock = threading.Lock()
-_task_results_lock = threading.Lock()
-
-task_id = 0
-
+# calls waiting for the main thread, in the order they were queued
+main_queue: collections.deque[tuple[Callable, tuple, dict]] = collections.deque()
 
-def next_task_id():
-    global task_id
-    use_id = task_id
-    task_id += 1
-    return use_id
+# the latest call posted under each coalescing key that hasn't run yet
+_coalesced: dict[Hashable, tuple[Callable, tuple, dict]] = {}
+_coalesced_lock = threading.Lock()
 
 
 def process():
@@ -102,26 +229,22 @@ def process():
             deferred._complete()
 
         completed = []
-    
-    global main_queue
 
-    with _main_queue_lock:
-        to_process = main_queue
-        main_queue = []
-    
-    for callback, args, kwargs in to_process:
-        callback(*args, **kwargs)
+    # only what is already queued, so that busy workers can't keep the event loop from drawing
+    for _ in range(len(main_queue)):
+        callback, args, kwargs = main_queue.popleft()
+        try:
+            callback(*args, **kwargs)
+        except Exception:
+            logging.exception("Main thread call failed")
 
 
-def _exec(task_id: int, event: threading.Event, executor, *args, **kwargs):
-    result = executor(*args, **kwargs)
+def _run_coalesced(key: Hashable):
+    with _coalesced_lock:
+        executor, args, kwargs = _coalesced.pop(key)
 
-    global task_results
-    global _task_results_lock
-    with _task_results_lock:
-        task_results[task_id] = result
+    executor(*args, **kwargs)
 
-    event.set()
 
 def with_event(event: threading.Event, executor, *args, **kwargs):
     @functools.wraps(executor)
@@ -135,45 +258,129 @@ def event_timer(event: threading.Event, seconds: int):
     time.sleep(seconds)
     event.set()
 
-def main(executor, *args, **kwargs):
+def post(executor, *args, key: Hashable | None = None, **kwargs):
+    """
+    Runs `executor` on the main thread without waiting for it. Calls posted under the same `key`
+    before the main thread gets to them are merged, and only the latest one runs, e.g. so that a
+    burst of status updates redraws the label once.
+    """
     if threading.current_thread() is threading.main_thread():
         executor(*args, **kwargs)
+        return
+
+    if key is None:
+        main_queue.append((executor, args, kwargs))
     else:
-        event = threading.Event()
+        with _coalesced_lock:
+            pending = key in _coalesced
+            _coalesced[key] = (executor, args, kwargs)
 
-        global main_queue
-        global _main_queue_lock
-    
-        task_id = next_task_id()
+        # the call keeps the place in the queue of the first one merged into it
+        if not pending:
+            main_queue.append((_run_coalesced, (key,), {}))
 
-        if has_positional_arg(inspect.signature(executor)):
-            queue_args = (task_id, event, executor) + args
-        else:
-            queue_args = (task_id, event, executor)
+    _notify()
 
-        with _main_queue_lock:
-            main_queue.append((_exec, queue_args, kwargs))
-    
-        event.wait()
-        
-        global task_results
-        global _task_results_lock
-        with _task_results_lock:
-            return task_results.pop(task_id)
+def main(executor, *args, **kwargs):
+    """
+    Runs `executor` on the main thread and waits for its result. Exceptions it raises are raised
+    in the calling thread.
+    """
+    if threading.current_thread() is threading.main_thread():
+        return executor(*args, **kwargs)
+
+    if not has_positional_arg(inspect.signature(executor)):
+        args = ()
+
+    event = threading.Event()
+    outcome = []
+
+    def run():
+        try:
+            outcome.append((executor(*args, **kwargs), None))
+        except BaseException as exc:
+            # raised in the waiting thread rather than logged here
+            outcome.append((None, exc))
+        finally:
+            event.set()
+
+    main_queue.append((run, (), {}))
+    _notify()
+    event.wait()
+
+    result, exception = outcome[0]
+    if exception is not None:
+        raise exception
+    return result
+
+
+def install(root: tkinter.Tk):
+    """
+    Has the Tk event loop (mainloop, or a wait_window inside it) run work queued by other threads
+    as soon as it is queued, without polling where the platform allows it.
+    """
+    global _root
+    global _wakeup_fds
+
+    _root = root
+
+    if hasattr(root.tk, "createfilehandler"):
+        read_fd, write_fd = os.pipe()
+        os.set_blocking(read_fd, False)
+        os.set_blocking(write_fd, False)
+
+        _wakeup_fds = (read_fd, write_fd)
+        root.tk.createfilehandler(read_fd, tkinter.READABLE, _on_wakeup)
+    else:
+        root.after(POLL_INTERVAL_MS, _poll)
+
+    # anything queued before the handler existed
+    root.after_idle(process)
+
+
+def _notify():
+    if _wakeup_fds is None:
+        return
+
+    try:
+        os.write(_wakeup_fds[1], b"\0")
+    except BlockingIOError:
+        # the pipe is full, so the main thread is due to wake up anyway
+        pass
+
+
+def _on_wakeup(fd: int, _):
+    try:
+        while os.read(fd, 4096):
+            pass
+    except BlockingIOError:
+        pass
+
+    process()
 
 
-def update_app(root: tkinter.Tk):
+def _poll():
     process()
-    root.update()
-    root.update_idletasks()
+    _root.after(POLL_INTERVAL_MS, _poll)
 
 
 def wait_window(window: tkinter.Toplevel, root: tkinter.Tk, is_running: tkinter.BooleanVar | None = None):
+    """
+    Runs the event loop until `window` is closed, or until `is_running` is set to False, in which
+    case the window is closed.
+    """
+    def close_if_stopped(*_):
+        if not is_running.get():
+            try:
+                window.destroy()
+            except tkinter.TclError:
+                pass
+
+    trace = is_running.trace_add("write", close_if_stopped) if is_running else None
     try:
-        check_running = True
-        while check_running:
-            window.state()
-            update_app(root)
-            check_running = is_running.get() if is_running else True
+        root.wait_window(window)
     except tkinter.TclError:
         pass
+    finally:
+        if trace:
+            is_running.trace_remove("write", trace)
@@ -2,26 +2,60 @@ import imaplib
 import tkinter
 import tkinter.ttk as ttk
 import tkinter.messagebox
+import threading
+import time
 import typing
 
 from api.service import CleanserService
 from api.imap import GenericIMAP
+from api.index import SenderIndex
 from .checklist import Checklist
-import persist
 from ui import concurrency
+import metrics
+import util
 
 
 class Selector(ttk.Frame):
+    # label -> (sort key taking the sender and its stats, whether to sort descending)
+    SORT_ORDERS: dict[str, tuple[typing.Callable[[str, SenderIndex.Stats | None], typing.Any], bool]] = {
+        "Name": (lambda sender, _: sender.lower(), False),
+        "Messages": (lambda _, stats: stats.count if stats else 0, True),
+        "Size": (lambda _, stats: stats.size if stats else 0, True),
+        "Newest": (lambda _, stats: stats.newest if stats else 0, True),
+        "Oldest": (lambda _, stats: stats.oldest if stats else 0, False)
+    }
+
+    # how often senders streamed in while loading are added to the list
+    FRAME_INTERVAL_MS = 100
+
     __service: CleanserService
+    __index: SenderIndex | None
+    __sender_list: list[str]
+
+    __pending: list[str]
+    __pending_lock: threading.Lock
+    __flush_job: str | None
 
     __senders: Checklist
+    __sort_order: tkinter.StringVar
+    __select_all: tkinter.BooleanVar
+    __select_all_check: ttk.Checkbutton
     __purge: ttk.Button
+    __purge_task: concurrency.DeferredTask | None
+    __purged: int
     __busy: bool
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.__service = None
+        self.__index = None
+        self.__sender_list = []
+        self.__pending = []
+        self.__pending_lock = threading.Lock()
+        self.__flush_job = None
         self.__status = None
+        self.__purge_task = None
+        self.__purged = 0
         self.__busy = False
         self.__setup_ui()
     
@@ -31,16 +65,28 @@ class Selector(ttk.Frame):
 
         ttk.Label(self, text="Senders to Purge", style="Padded.TLabel").grid(column=0, row=0, padx=5, sticky='nsw')
 
+        self.__select_all = tkinter.BooleanVar(value=False)
+        self.__select_all_check = ttk.Checkbutton(self, text="Select all", variable=self.__select_all,
+                                                  command=lambda: self.__senders.set_all_checked(self.__select_all.get()))
+        self.__select_all_check.grid(column=1, row=0, padx=10, sticky='e')
+
+        ttk.Label(self, text="Sort by").grid(column=2, row=0, sticky='e')
+        self.__sort_order = tkinter.StringVar(value="Name")
+        sort_box = ttk.Combobox(self, textvariable=self.__sort_order, values=list(self.SORT_ORDERS), state="readonly", width=10)
+        sort_box.bind("<<ComboboxSelected>>", lambda _: self.__show_senders())
+        sort_box.grid(column=3, row=0, padx=5, sticky='e')
+
         self.__senders = Checklist(self, borderwidth=1)
-        self.__senders.grid(column=0, row=1, sticky='nesw')
+        self.__senders.grid(column=0, row=1, columnspan=4, sticky='nesw')
 
         self.__purge = ttk.Button(self, text="Purge E-mails")
         self.__purge.configure(command=self.start_purge, state=tkinter.DISABLED)
-        self.__purge.grid(column=0, row=2, pady=7)
+        self.__purge.grid(column=0, row=2, columnspan=4, pady=7)
 
     def emit_status(self, status: str):
         self.__status = status
-        concurrency.main(self.event_generate, "<<Status>>")
+        # the handler reads the status when it runs, so one event per burst of updates is enough
+        concurrency.post(self.event_generate, "<<Status>>", key=(self, "<<Status>>"))
     
     def start_purge(self):
         senders = len(self.__senders.get_checked())
@@ -49,70 +95,169 @@ class Selector(ttk.Frame):
             message += " NOTE: No junk folder is configured - e-mails will be deleted permanently!"
         confirmed = tkinter.messagebox.askyesno("Confirm", message)
         if confirmed:
-            task = concurrency.DeferredTask(self.perform_purge)
-            task.run()
+            self.__purge_task = concurrency.DeferredTask(self.perform_purge)
+            self.__purge_task.run()
 
-    def perform_purge(self):
-        concurrency.main(self.__senders.set_enabled, False)
-        concurrency.main(self.__purge.configure, text="PURGING...", state="disabled")
+    def cancel_purge(self):
+        if self.__purge_task:
+            self.__purge.configure(text="Cancelling...", state="disabled")
+            self.__purge_task.cancel()
+
+    def perform_purge(self, token: util.CancellationToken | None = None):
+        concurrency.post(self.set_enabled, False)
+        concurrency.post(self.__purge.configure, text="Cancel", state="normal", command=self.cancel_purge)
         self.emit_status("Finding e-mails to purge...")
 
         self.__busy = True
+        self.__purged = 0
+
+        # whatever happens, the selector mustn't be left disabled
+        try:
+            self.__purge_senders(token)
+        finally:
+            self.__end_purge()
 
+    def __purge_senders(self, token: util.CancellationToken | None):
         senders = concurrency.main(self.__senders.get_checked)
         try:
-            to_purge = self.service.find_emails_to_cleanse(senders)
-        except imaplib.IMAP4.error:
+            to_purge = self.service.find_emails_to_cleanse(senders, index=self.__index, token=token)
+        except util.CancellationToken.Cancelled:
+            self.emit_status("Purge cancelled.")
+            return
+        except (imaplib.IMAP4.error, CleanserService.ServiceError, GenericIMAP.OperationError):
             import traceback
             traceback.print_exc()
 
             self.emit_status("Aggregation query failed. It is possible that a selected address is invalid.")
-            self.__end_purge()
             return
         
         if len(to_purge) == 0:
             self.emit_status("Found no e-mails to purge!")
-            self.__end_purge()
             return
 
         self.emit_status("Purging %d e-mails..." % len(to_purge))
         try:
-            self.service.cleanse_emails(to_purge)
+            self.service.cleanse_emails(to_purge, progress=self.__purge_progress, token=token)
+        except util.CancellationToken.Cancelled:
+            # stopped between commands, so every message was either purged or left alone
+            self.emit_status("Purge cancelled after %d of %d e-mails." % (self.__purged, len(to_purge)))
+            return
         except (imaplib.IMAP4.error, GenericIMAP.OperationError) as err:
             self.emit_status("Could not move e-mails to the Junk folder. Reason: %s" % str(err))
-            self.__end_purge()
             return
 
         self.emit_status("E-mails purged.")
         concurrency.main(self.__remove_senders)
 
-        self.__end_purge()
+    def __purge_progress(self, done: int, total: int):
+        self.__purged = done
+        self.emit_status("Purging e-mails... %d of %d done." % (done, total))
 
     def __end_purge(self):
-        concurrency.main(self.__purge.configure, text="Purge E-mails", state="normal")
-        concurrency.main(self.__senders.set_enabled, True)
+        concurrency.post(self.__purge.configure, text="Purge E-mails", state="normal", command=self.start_purge)
+        concurrency.post(self.set_enabled, True)
+        self.__purge_task = None
         self.__busy = False
     
     def __remove_senders(self):
-        self.__senders.remove(self.__senders.get_checked())
+        checked = self.__senders.get_checked()
+        self.__senders.remove(checked)
+        self.__sender_list = [sender for sender in self.__sender_list if sender not in checked]
+
+        user = self.service.imap.user
+        index = self.__index or SenderIndex.load(user)
+        index.discard(checked)
+        index.save(user)
+
+    def start_loading(self):
+        """
+        Clears the list and starts adding the senders passed to add_senders, a frame at a time.
+        """
+        self.clear_senders()
+        self.__index = None
+
+        if self.__flush_job is None:
+            self.__flush_job = self.after(self.FRAME_INTERVAL_MS, self.__flush_senders)
+
+    def add_senders(self, senders: typing.Iterable[str]):
+        """
+        Queues senders to be shown with the next frame. Safe to call from any thread.
+        """
+        with self.__pending_lock:
+            self.__pending.extend(senders)
 
-        sender_store = persist.getvalue("unique-senders")
-        if sender_store:
-            items = self.__senders.get_items()
-            user = self.service.imap.user
-            sender_store[user] = list(items)
-            persist.setvalue("unique-senders", sender_store)
+    def finish_loading(self, index: SenderIndex | None):
+        """
+        Stops adding streamed senders and shows exactly the senders in `index`, sorted using its
+        statistics. If loading failed, the senders streamed so far are kept.
+        """
+        if self.__flush_job is not None:
+            self.after_cancel(self.__flush_job)
+            self.__flush_job = None
 
-    def populate_senders(self, senders: typing.Iterable[str]):
-        for sender in senders:
-            self.__senders.append(sender)
+        if index is None:
+            self.__flush_senders()
+            return
+
+        with self.__pending_lock:
+            self.__pending = []
+
+        self.__index = index
+        self.__sender_list = list(index.senders)
+        self.__show_senders()
+
+    def __flush_senders(self):
+        with self.__pending_lock:
+            pending, self.__pending = self.__pending, []
+
+        if pending:
+            self.__sender_list.extend(pending)
+
+            # stats aren't available until the index is done syncing, so new senders go by name or arrival order
+            key, descending = self.SORT_ORDERS[self.__sort_order.get()]
+            with metrics.phase("populate"):
+                self.__senders.merge(((sender, None) for sender in pending), key=lambda sender: key(sender, None), reverse=descending)
+
+        if self.__flush_job is not None:
+            self.__flush_job = self.after(self.FRAME_INTERVAL_MS, self.__flush_senders)
+
+    @metrics.timed("populate")
+    def __show_senders(self):
+        checked = self.__senders.get_checked()
+        stats = self.__index.stats() if self.__index else {}
+
+        key, descending = self.SORT_ORDERS[self.__sort_order.get()]
+        self.__sender_list.sort(key=lambda sender: key(sender, stats.get(sender)), reverse=descending)
+
+        self.__senders.clear()
+        for sender in self.__sender_list:
+            self.__senders.append(sender, self.__describe(stats.get(sender)), checked=sender in checked)
+
+    @staticmethod
+    def __describe(stats: SenderIndex.Stats | None) -> str | None:
+        if not stats:
+            return None
+
+        newest = time.strftime("%Y-%m-%d", time.localtime(stats.newest))
+        return "%d message%s, %s, latest %s" % (stats.count, "" if stats.count == 1 else "s", util.format_size(stats.size), newest)
 
     def clear_senders(self):
+        if self.__flush_job is not None:
+            self.after_cancel(self.__flush_job)
+            self.__flush_job = None
+
+        # workers may be adding senders, so the buffer is emptied rather than the lock replaced
+        with self.__pending_lock:
+            self.__pending = []
+
+        self.__sender_list = []
+        self.__select_all.set(False)
         self.__senders.clear()
 
     def set_enabled(self, enabled: bool):
         state = tkinter.NORMAL if enabled else tkinter.DISABLED
         self.__senders.set_enabled(enabled)
+        self.__select_all_check.configure(state=state)
         self.__purge.configure(state=state)
 
     @property
@@ -123,6 +268,14 @@ class Selector(ttk.Frame):
     def busy(self) -> bool:
         return self.__busy
     
+    @property
+    def index(self) -> SenderIndex | None:
+        return self.__index
+
+    @index.setter
+    def index(self, index: SenderIndex | None):
+        self.__index = index
+
     @property
     def service(self) -> CleanserService | None:
         return self.__service
@@ -130,4 +283,4 @@ class Selector(ttk.Frame):
     @service.setter
     def service(self, service: CleanserService | None):
         self.__service = service
-        concurrency.main(self.__purge.configure, state=tkinter.DISABLED if not service else tkinter.NORMAL)
+        concurrency.post(self.__purge.configure, state=tkinter.DISABLED if not service else tkinter.NORMAL)
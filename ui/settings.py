@@ -3,10 +3,15 @@ import tkinter.ttk as ttk
 import tkinter.messagebox
 
 
+# the most any supported provider allows; the pool caps it further per server
+MAX_CONNECTIONS = 15
+
+
 class SettingsDialog(tkinter.Toplevel):
     __use_junk_folder: tkinter.BooleanVar
     __junk_folder: tkinter.StringVar
     __junk_folder_field: ttk.Entry
+    __connections: tkinter.StringVar
 
     __settings: dict[str, str] | None
 
@@ -25,6 +30,7 @@ class SettingsDialog(tkinter.Toplevel):
 
         ttk.Label(container, text="Use Junk Folder?").grid(row=0, column=0, sticky="e", padx=(0, 5))
         ttk.Label(container, text="Junk Folder").grid(row=1, column=0, sticky="e", padx=(0, 5))
+        ttk.Label(container, text="Connections").grid(row=2, column=0, sticky="e", padx=(0, 5))
 
         junk_folder_check = ttk.Checkbutton(container, variable=self.__use_junk_folder)
         junk_folder_check.grid(row=0, column=1, sticky="w")
@@ -34,6 +40,10 @@ class SettingsDialog(tkinter.Toplevel):
         )
         junk_folder.grid(row=1, column=1, sticky="nesw")
 
+        self.__connections = tkinter.StringVar(value=settings.get("connections") or "1")
+        connections = ttk.Spinbox(container, from_=1, to=MAX_CONNECTIONS, textvariable=self.__connections, width=5)
+        connections.grid(row=2, column=1, sticky="w", pady=(5, 0))
+
         button_box = ttk.Frame(container)
         ok = ttk.Button(button_box, text="OK", command=self.success)
         cancel = ttk.Button(button_box, text="Cancel", command=self.destroy)
@@ -41,7 +51,7 @@ class SettingsDialog(tkinter.Toplevel):
         ok.pack(side=tkinter.RIGHT, padx=(5, 0))
         cancel.pack(side=tkinter.RIGHT)
 
-        button_box.grid(row=2, column=0, columnspan=2, sticky="nesw", pady=(5, 0))
+        button_box.grid(row=3, column=0, columnspan=2, sticky="nesw", pady=(5, 0))
 
         container.pack(fill=tkinter.BOTH, expand=tkinter.YES)
 
@@ -57,12 +67,17 @@ class SettingsDialog(tkinter.Toplevel):
             valid_junk_folder = junk_folder.strip() == junk_folder
             if not valid_junk_folder:
                 error = "Junk folder name must not begin or end with whitespace."
+
+        connections = self.__connections.get().strip()
+        if not connections.isdigit() or not 1 <= int(connections) <= MAX_CONNECTIONS:
+            error = "Connections must be a whole number between 1 and %d." % MAX_CONNECTIONS
         
         if error:
             tkinter.messagebox.showerror("Error", error)
         else:
             self.__settings = {
-                "junk_folder": junk_folder or ""
+                "junk_folder": junk_folder or "",
+                "connections": connections
             }
             self.destroy()
     
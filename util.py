@@ -1,4 +1,6 @@
 import functools
+import threading
+import time
 import typing
 
 
@@ -20,6 +22,161 @@ def produce_batches(iterable: typing.Iterable[T], batch_size: int) -> typing.Gen
         yield batch
 
 
+def _iter_ranges(ids: typing.Iterable[int]) -> typing.Generator[str, None, None]:
+    start = end = None
+    for item in sorted(set(ids)):
+        if end is not None and item == end + 1:
+            end = item
+            continue
+
+        if start is not None:
+            yield str(start) if start == end else "%d:%d" % (start, end)
+        start = end = item
+
+    if start is not None:
+        yield str(start) if start == end else "%d:%d" % (start, end)
+
+
+def to_sequence_set(ids: typing.Iterable[int]) -> str:
+    """
+    Encodes message numbers or UIDs as an IMAP sequence set, collapsing runs of consecutive
+    IDs into ranges, e.g. [1, 2, 3, 5, 7, 8] becomes "1:3,5,7:8".
+    """
+    return ",".join(_iter_ranges(ids))
+
+
+def split_sequence_set(ids: typing.Iterable[int], max_bytes: int) -> typing.Generator[tuple[str, int], None, None]:
+    """
+    Like to_sequence_set, but splits the result into sequence sets of at most `max_bytes` each,
+    yielding every one along with the number of IDs it covers.
+    """
+    if max_bytes <= 0:
+        raise ValueError("max_bytes must be greater than or equal to one.")
+
+    parts = []
+    size = 0
+    count = 0
+    for part in _iter_ranges(ids):
+        if parts and size + 1 + len(part) > max_bytes:
+            yield ",".join(parts), count
+            parts, size, count = [], 0, 0
+
+        size += len(part) + (1 if parts else 0)
+        parts.append(part)
+
+        low, _, high = part.partition(":")
+        count += int(high) - int(low) + 1 if high else 1
+
+    if parts:
+        yield ",".join(parts), count
+
+
+def parse_sequence_set(sequence_set: str | bytes) -> list[int]:
+    if isinstance(sequence_set, bytes):
+        sequence_set = sequence_set.decode("ascii")
+
+    ids = []
+    for part in sequence_set.split(","):
+        part = part.strip()
+        if not part:
+            continue
+
+        if ":" in part:
+            low, high = sorted(int(bound) for bound in part.split(":", 1))
+            ids.extend(range(low, high + 1))
+        else:
+            ids.append(int(part))
+
+    return ids
+
+
+class ChunkSizer:
+    """
+    Picks the size of the next chunk of a streamed operation based on the round-trip time and
+    response size observed for the previous chunk. Chunks grow until a response takes roughly
+    `target_seconds` or would exceed `max_bytes`, and shrink again when responses get slower.
+    """
+
+    __size: int
+    __minimum: int
+    __maximum: int
+    __target_seconds: float
+    __max_bytes: int
+
+    def __init__(self, initial: int = 500, minimum: int = 50, maximum: int = 100_000, target_seconds: float = 1.0,
+                 max_bytes: int = 4 * 1024 * 1024):
+        if minimum <= 0 or maximum < minimum:
+            raise ValueError("minimum must be positive and no greater than maximum.")
+
+        self.__minimum = minimum
+        self.__maximum = maximum
+        self.__size = min(max(initial, minimum), maximum)
+        self.__target_seconds = target_seconds
+        self.__max_bytes = max_bytes
+
+    def observe(self, count: int, size_bytes: int, elapsed: float):
+        if count <= 0:
+            return
+
+        # never grow by more than 2x at once, a single fast response is not a trend
+        proposed = count * min(self.__target_seconds / max(elapsed, 0.001), 2.0)
+
+        bytes_per_item = size_bytes / count
+        if bytes_per_item > 0:
+            proposed = min(proposed, self.__max_bytes / bytes_per_item)
+
+        self.__size = int(min(max(proposed, self.__minimum), self.__maximum))
+
+    @property
+    def size(self) -> int:
+        return self.__size
+
+
+class CancellationToken:
+    """
+    Lets one thread ask a long-running operation in another to stop. Operations call
+    raise_if_cancelled between units of work, so they only ever stop at a point where the work done
+    so far is consistent.
+    """
+
+    __event: threading.Event
+    __deadline: float | None
+
+    class Cancelled(Exception):
+        """
+        Raised by raise_if_cancelled once the token was cancelled or timed out.
+        """
+
+    def __init__(self):
+        self.__event = threading.Event()
+        self.__deadline = None
+
+    def cancel(self):
+        self.__event.set()
+
+    def cancel_after(self, seconds: float):
+        self.__deadline = time.monotonic() + seconds
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise CancellationToken.Cancelled("The operation was cancelled.")
+
+    @property
+    def cancelled(self) -> bool:
+        if self.__deadline is not None and time.monotonic() >= self.__deadline:
+            self.__event.set()
+        return self.__event.is_set()
+
+
+def format_size(size: int) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return ("%d %s" if unit == "B" else "%.1f %s") % (size, unit)
+        size /= 1024
+
+    return "%.1f TB" % size
+
+
 _version_registry = {}
 
 